@@ -1,11 +1,11 @@
 import base64
+import hashlib
 import json
 import time
 import os
 from typing import Optional
 from dotenv import load_dotenv
 import pandas as pd
-import requests
 import scanpy as sc
 import matplotlib.pyplot as plt
 from celery import Celery
@@ -19,12 +19,13 @@ import matplotlib.pyplot as plt
 import oss2 # <-- 新增：OSS SDK
 from database import SessionLocal
 import crud
+import demos_client
 # 创建结果保存目录
 os.makedirs("analysis_results", exist_ok=True)
-DEMO_URL=os.getenv("DEMO_URL",  "http://localhost:8100")
-# API服务器的地址和端口
-API_URL = DEMO_URL+"/api/get_similarity"
-ATLAS_API_URL = DEMO_URL+"/api/get_method"
+# API服务器的接口，地址 DEMO_URL 和超时、重试等设置见 demos_client
+API_PATH = "/api/get_similarity"
+ATLAS_API_PATH = "/api/get_method"
+RANK_API_PATH = "/api/rank_similarity"
 REDIS_URL = os.getenv("REDIS_URL","redis://localhost:6379/0")
 # Celery 配置
 celery_app = Celery(
@@ -72,6 +73,61 @@ def upload_plot_to_oss(fig, object_name: str) -> str:
     return public_url
  
 
+# demos 服务与后端共享 /uploads 目录时按路径读取文件，否则按内容哈希使用之前上传过的文件
+# H5AD_REFERENCE_MODE=0 时总是上传文件
+H5AD_REFERENCE_MODE = os.getenv("H5AD_REFERENCE_MODE", "1") == "1"
+_file_hashes = {}
+
+
+def file_sha256(path: str) -> str:
+    """文件内容的 SHA-256，按 (路径, 大小, 修改时间) 缓存，文件被覆盖后重新计算"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        content_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(8 * 1024 * 1024):
+                content_hash.update(chunk)
+        _file_hashes[key] = content_hash.hexdigest()
+    return _file_hashes[key]
+
+
+def _upload_required(response) -> bool:
+    """demos 服务中没有按引用传递的文件，需要上传"""
+    if response.status_code != 404:
+        return False
+    try:
+        detail = response.json().get("detail")
+    except ValueError:
+        return False
+    return isinstance(detail, dict) and detail.get("error") == "upload_required"
+
+
+def _post_similarity(h5ad_file_path: str, tissue_info: str, analysis_param: str, sweep_dict: Optional[dict]):
+    """由 demos 服务计算完整的相似度矩阵：先按引用传递 h5ad 文件，demos 服务没有该文件时再上传"""
+    data = {
+    'tissue': tissue_info,
+    'feature_name': analysis_param, # 假设 analysis_param 是一个字符串
+    'use_sim_cache': str(True), #布尔值转为字符串发送
+    # 'query_dataset': (h5ad_file_name.split(tissue_info.capitalize())[1] +
+    #                      (tissue_info.capitalize() + h5ad_file_name.split(tissue_info.capitalize())[2] if len(h5ad_file_name.split(tissue_info.capitalize())) >= 3 else '')
+    #                      ).split('_')[0],
+}
+    if sweep_dict is not None:
+        data['sweep_dict_json']=json.dumps(sweep_dict)
+    if H5AD_REFERENCE_MODE:
+        reference = {'content_hash': file_sha256(h5ad_file_path), 'h5ad_path': os.path.abspath(h5ad_file_path)}
+        response = demos_client.post(API_PATH, data={**data, **reference})
+        if not _upload_required(response):
+            return response
+        print(f"demos 服务中没有 {h5ad_file_path}，改为上传文件")
+    # 按 DEMOS_UPLOAD_COMPRESSION 压缩后上传，demos 服务边接收边解压
+    h5ad_file, encoding = demos_client.compressed_file(h5ad_file_path)
+    with h5ad_file:
+        files = {'h5ad_file': (os.path.basename(h5ad_file_path), h5ad_file, 'application/octet-stream')}
+        return demos_client.post(API_PATH, files=files, data={**data, 'h5ad_encoding': encoding})
+
+
 @celery_app.task(bind=True)
 def run_analysis_task(self, h5ad_file_path: str,  csv_file_path: Optional[str], analysis_param: str, dataset_id: int,tissue_info:str):
     """
@@ -91,21 +147,30 @@ def run_analysis_task(self, h5ad_file_path: str,  csv_file_path: Optional[str],
         print("No optional CSV provided for this analysis.")
 
     self.update_state(state='PROGRESS', meta={'status': f'Running analysis with param: {analysis_param}...'})
-    files = {
-    'h5ad_file': (os.path.basename(h5ad_file_path), open(h5ad_file_path, 'rb'), 'application/octet-stream')
-}
+    # 已有该数据集的完整相似度矩阵时，只需按新的 analysis_param 重新排序，不再上传文件重新计算
+    db = SessionLocal()
+    try:
+        stored_matrix = crud.get_similarity_matrix(db, dataset_id)
+        matrix_json = stored_matrix.matrix_json if stored_matrix is not None else None
+    finally:
+        db.close()
     h5ad_file_name=os.path.basename(h5ad_file_path)
-    data = {
-    'tissue': tissue_info,
-    'feature_name': analysis_param, # 假设 analysis_param 是一个字符串
-    'use_sim_cache': str(True), #布尔值转为字符串发送
-    # 'query_dataset': (h5ad_file_name.split(tissue_info.capitalize())[1] +
-    #                      (tissue_info.capitalize() + h5ad_file_name.split(tissue_info.capitalize())[2] if len(h5ad_file_name.split(tissue_info.capitalize())) >= 3 else '')
-    #                      ).split('_')[0],
-}
-    if sweep_dict is not None:
-        data['sweep_dict_json']=json.dumps(sweep_dict)
-    response = requests.post(API_URL, files=files, data=data)
+    if matrix_json is not None:
+        print(f"使用已保存的相似度矩阵重新排序: dataset_id={dataset_id}")
+        data = {
+            'tissue': tissue_info,
+            'feature_name': analysis_param,
+            'similarity_matrix_json': matrix_json,
+        }
+        if sweep_dict is not None:
+            data['sweep_dict_json']=json.dumps(sweep_dict)
+        response = demos_client.post(RANK_API_PATH, data=data)
+        # 已保存的矩阵无法用于排序（例如缺少 analysis_param 这一指标）时，重新计算并覆盖保存的矩阵
+        if response.status_code == 400:
+            print(f"已保存的相似度矩阵无法排序 ({response.text})，重新计算: dataset_id={dataset_id}")
+            matrix_json = None
+    if matrix_json is None:
+        response = _post_similarity(h5ad_file_path, tissue_info, analysis_param, sweep_dict)
 
     # 检查请求是否成功
     response.raise_for_status()
@@ -113,6 +178,13 @@ def run_analysis_task(self, h5ad_file_path: str,  csv_file_path: Optional[str],
     # 解析返回的JSON数据
     results = response.json()
     print("成功接收到API的响应！")
+    if matrix_json is None and results.get("similarity_matrix") is not None:
+        db = SessionLocal()
+        try:
+            crud.save_similarity_matrix(db, dataset_id, json.dumps(results["similarity_matrix"]))
+        finally:
+            db.close()
+
 
     # 处理返回的数据
     print("\n--- 元数据 ---")
@@ -206,5 +278,6 @@ def run_analysis_task(self, h5ad_file_path: str,  csv_file_path: Optional[str],
 
 @celery_app.task(bind=True)
 def get_atlas_method(self, atlas_dataset_id:str,tissue_info:str):
-    response = requests.get(ATLAS_API_URL, params={"atlas_id": atlas_dataset_id,"tissue":tissue_info.lower()})
+    response = demos_client.get(ATLAS_API_PATH, params={"atlas_id": atlas_dataset_id,"tissue":tissue_info.lower()},
+                                read_timeout=60)
     return {"status": "SUCCESS","result":response.json()}
\ No newline at end of file
@@ -184,6 +184,23 @@ def get_analysis_by_param(db: Session, dataset_id: int, analysis_param: str):
     ).first()
 
 
+def get_similarity_matrix(db: Session, dataset_id: int):
+    return db.query(models.SimilarityMatrix).filter(models.SimilarityMatrix.dataset_id == dataset_id).first()
+
+def save_similarity_matrix(db: Session, dataset_id: int, matrix_json: str):
+    """保存（或覆盖）数据集的完整相似度矩阵"""
+    db_matrix = get_similarity_matrix(db, dataset_id)
+    if db_matrix is None:
+        db_matrix = models.SimilarityMatrix(dataset_id=dataset_id, matrix_json=matrix_json)
+        db.add(db_matrix)
+    else:
+        db_matrix.matrix_json = matrix_json
+        db_matrix.created_at = datetime.utcnow()
+    db.commit()
+    db.refresh(db_matrix)
+    return db_matrix
+
+
 def get_atlas_dataset_by_id(db: Session, dataset_id: int):
     """
     通过 ID 获取单个 Atlas 数据集。
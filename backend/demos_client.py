@@ -0,0 +1,176 @@
+"""访问 demos 服务的共享 HTTP 客户端
+
+每个进程（Celery 的每个 worker 进程）复用一个 requests.Session，连接池保持长连接，不再为每个任务新建 TCP 连接。
+所有请求都有连接超时和读取超时，demos 服务卡住时不会一直占用 worker。
+
+- GET 等幂等请求在连接失败、读取失败或 502/503/504 时按指数退避重试
+- demos 服务返回 429/503 且带 Retry-After 时（请求未被处理）等待后重试，POST 请求也是如此
+- 上传 h5ad 文件时可以用 gzip 或 zstd 压缩（DEMOS_UPLOAD_COMPRESSION），demos 服务边接收边解压
+- 每次调用的耗时、状态码和重试次数写入日志，并按接口汇总在 latency_stats() 中
+"""
+import collections
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEMO_URL = os.getenv("DEMO_URL", "http://localhost:8100")
+CONNECT_TIMEOUT = float(os.getenv("DEMOS_CONNECT_TIMEOUT", "5"))
+# 相似度分析可能需要几十分钟
+READ_TIMEOUT = float(os.getenv("DEMOS_READ_TIMEOUT", "1800"))
+MAX_RETRIES = int(os.getenv("DEMOS_MAX_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("DEMOS_BACKOFF_FACTOR", "0.5"))
+# 等待 Retry-After 的总时长上限（秒）
+MAX_RETRY_AFTER_WAIT = float(os.getenv("DEMOS_MAX_RETRY_AFTER_WAIT", "600"))
+POOL_MAXSIZE = int(os.getenv("DEMOS_POOL_MAXSIZE", "4"))
+# 上传 h5ad 文件的压缩方式: none, gzip 或 zstd（需要安装 zstandard）
+UPLOAD_COMPRESSION = os.getenv("DEMOS_UPLOAD_COMPRESSION", "none")
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """当前进程的 Session；Celery prefork 在 fork 之后的子进程中各自新建，不共享父进程的连接"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(
+                total=MAX_RETRIES,
+                connect=MAX_RETRIES,
+                read=MAX_RETRIES,
+                status=MAX_RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=(502, 503, 504),
+                # 只有幂等请求会在读取失败和 5xx 时重试；连接失败时请求还没有发出，任何请求都可以重试
+                allowed_methods=IDEMPOTENT_METHODS,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def _record(name: str, elapsed: float, status: Optional[int], attempts: int):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {"calls": 0, "errors": 0, "retries": 0, "total_seconds": 0.0,
+                                         "max_seconds": 0.0, "recent": collections.deque(maxlen=256)})
+        stats["calls"] += 1
+        stats["errors"] += status is None or status >= 400
+        stats["retries"] += attempts - 1
+        stats["total_seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        stats["recent"].append(elapsed)
+    print(f"[demos_client] {name} status={status} attempts={attempts} {elapsed * 1000:.0f} ms")
+
+
+def latency_stats() -> dict:
+    """当前进程中每个接口的调用次数、错误数、重试数和耗时（最近 256 次调用的 p50/p95）"""
+    with _stats_lock:
+        result = {}
+        for name, stats in _stats.items():
+            recent = sorted(stats["recent"])
+            result[name] = {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "retries": stats["retries"],
+                "mean_seconds": stats["total_seconds"] / stats["calls"],
+                "max_seconds": stats["max_seconds"],
+                "p50_seconds": recent[len(recent) // 2],
+                "p95_seconds": recent[min(len(recent) - 1, int(len(recent) * 0.95))],
+            }
+        return result
+
+
+def _retry_after(response) -> Optional[float]:
+    if response.status_code not in (429, 503):
+        return None
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def request(method: str, path: str, read_timeout: Optional[float] = None, files: Optional[dict] = None,
+            **kwargs) -> requests.Response:
+    """向 demos 服务发送请求
+
+    :param method: HTTP 方法
+    :param path: 接口路径，例如 '/api/get_similarity'
+    :param read_timeout: 读取超时（秒），默认 DEMOS_READ_TIMEOUT
+    :param files: 同 requests 的 files；其中的文件对象在重试前会回到开头
+    :return: 最后一次请求的响应，状态码由调用方检查
+    """
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT if read_timeout is None else read_timeout)
+    name = f"{method.upper()} {path}"
+    attempts = 0
+    waited = 0.0
+    t_start = time.perf_counter()
+    status = None
+    try:
+        while True:
+            attempts += 1
+            status = None
+            if files:
+                for value in files.values():
+                    fileobj = value[1] if isinstance(value, tuple) else value
+                    if hasattr(fileobj, "seek"):
+                        fileobj.seek(0)
+            response = get_session().request(method, DEMO_URL + path, timeout=timeout, files=files, **kwargs)
+            status = response.status_code
+            # 429/503 且带 Retry-After 表示 demos 服务没有处理该请求，非幂等请求也可以重试
+            # （幂等请求已经由 urllib3 的 Retry 处理）
+            retry_after = None if method.upper() in IDEMPOTENT_METHODS else _retry_after(response)
+            if retry_after is None or attempts > MAX_RETRIES or waited + retry_after > MAX_RETRY_AFTER_WAIT:
+                return response
+            print(f"[demos_client] {name} 返回 {status}，{retry_after:.0f} 秒后重试")
+            response.close()
+            time.sleep(retry_after)
+            waited += retry_after
+    finally:
+        _record(name, time.perf_counter() - t_start, status, attempts)
+
+
+def get(path: str, **kwargs) -> requests.Response:
+    return request("GET", path, **kwargs)
+
+
+def post(path: str, **kwargs) -> requests.Response:
+    return request("POST", path, **kwargs)
+
+
+def compressed_file(path: str, compression: str = UPLOAD_COMPRESSION):
+    """按 compression 压缩文件，返回 (文件对象, 编码)；不压缩时返回打开的原文件和 'identity'
+
+    压缩结果写入临时文件（超过 64 MB 时落盘），调用方负责关闭返回的文件对象。
+    """
+    if compression in (None, "", "none", "identity"):
+        return open(path, "rb"), "identity"
+    buffer = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+    with open(path, "rb") as source:
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 8 * 1024 * 1024)
+        elif compression == "zstd":
+            import zstandard
+            zstandard.ZstdCompressor(level=3, threads=-1).copy_stream(source, buffer)
+        else:
+            buffer.close()
+            raise ValueError(f"不支持的压缩方式: {compression}")
+    buffer.seek(0)
+    return buffer, compression
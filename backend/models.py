@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey,Boolean,Float
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey,Boolean,Float,Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
@@ -40,6 +40,7 @@ class Dataset(Base):
     
     owner = relationship("User", back_populates="datasets")
     analyses = relationship("Analysis", back_populates="dataset", cascade="all, delete-orphan")
+    similarity_matrix = relationship("SimilarityMatrix", back_populates="dataset", uselist=False, cascade="all, delete-orphan")
     atlas_metadata = relationship("AtlasMetadata", back_populates="dataset", uselist=False, cascade="all, delete-orphan")
 
 class Analysis(Base):
@@ -55,6 +56,15 @@ class Analysis(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     dataset_id = Column(Integer, ForeignKey("datasets.id"))
     dataset = relationship("Dataset", back_populates="analyses")
+
+# 查询数据集与所有图谱数据集的完整 指标×图谱 相似度矩阵，换一个 analysis_param 时只需重新排序
+class SimilarityMatrix(Base):
+    __tablename__ = "similarity_matrices"
+    id = Column(Integer, primary_key=True, index=True)
+    dataset_id = Column(Integer, ForeignKey("datasets.id"), unique=True, nullable=False)
+    matrix_json = Column(Text, nullable=False)  # {图谱数据集: {指标: 相似度字符串}}
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    dataset = relationship("Dataset", back_populates="similarity_matrix")
 # --- 新增 AtlasMetadata 模型 ---
 class AtlasMetadata(Base):
     __tablename__ = "atlas_metadata"
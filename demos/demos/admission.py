@@ -0,0 +1,147 @@
+"""Bounded execution of blocking analyses for the async endpoints of the service.
+
+Similarity analyses are synchronous and take seconds to minutes; called from an ``async def`` endpoint they block
+the event loop and every other request with it. :class:`AnalysisExecutor` runs them in a fixed number of threads
+(the heavy lifting happens in the worker pool processes, so threads mostly wait) behind a bounded queue. Requests
+arriving when the queue is full are rejected right away with :class:`OverloadedError`, which carries a
+``Retry-After`` estimate derived from the recent analysis durations.
+
+"""
+import asyncio
+import concurrent.futures
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class OverloadedError(Exception):
+    """The analysis was not admitted.
+
+    Parameters
+    ----------
+    message : str
+        Reason of the rejection
+    retry_after : int
+        Seconds after which the client should retry
+    status_code : int
+        429 if the queue is full, 503 if the executor no longer accepts analyses
+
+    """
+
+    def __init__(self, message: str, retry_after: int, status_code: int = 429):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class AnalysisExecutor:
+    """Thread pool running at most ``max_concurrent`` analyses with at most ``max_queued`` waiting.
+
+    Parameters
+    ----------
+    max_concurrent : int
+        Number of analyses running at the same time
+    max_queued : int
+        Number of admitted analyses waiting for a free thread
+    default_duration : float
+        Duration in seconds assumed for the ``Retry-After`` estimate until analyses have completed
+
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_queued: int = 8, default_duration: float = 60.0):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent,
+                                                               thread_name_prefix="analysis")
+        self._lock = threading.Lock()
+        self._accepting = True
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        # Exponentially weighted moving average of the analysis durations
+        self.mean_duration = default_duration
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is expected to have drained."""
+        backlog = self.running + self.queued
+        return max(1, math.ceil(self.mean_duration * math.ceil(backlog / self.max_concurrent)))
+
+    def _call(self, fn: Callable, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        t_start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self.failed += 1
+            raise
+        else:
+            with self._lock:
+                self.completed += 1
+                self.mean_duration = 0.8 * self.mean_duration + 0.2 * (time.perf_counter() - t_start)
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def _admit(self):
+        if not self._accepting:
+            self.rejected += 1
+            raise OverloadedError("The service is shutting down", self.retry_after(), status_code=503)
+        if self.running + self.queued >= self.max_concurrent + self.max_queued:
+            self.rejected += 1
+            raise OverloadedError(f"{self.running} analyses running and {self.queued} queued", self.retry_after(),
+                                  status_code=429)
+
+    def check(self):
+        """Raise :class:`OverloadedError` if an analysis submitted now would be rejected.
+
+        Lets endpoints reject a request before preparing its input; :meth:`run` checks again.
+
+        """
+        with self._lock:
+            self._admit()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run ``fn(*args, **kwargs)`` in a thread, or raise :class:`OverloadedError` if it is not admitted."""
+        with self._lock:
+            self._admit()
+            self.queued += 1
+        try:
+            future = self._executor.submit(self._call, fn, args, kwargs)
+        except RuntimeError:
+            with self._lock:
+                self.queued -= 1
+            raise OverloadedError("The service is shutting down", self.retry_after(), status_code=503)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The client went away: drop the analysis unless it already started
+            if future.cancel():
+                with self._lock:
+                    self.queued -= 1
+            raise
+
+    def shutdown(self, wait: bool = True):
+        """Reject new analyses and wait for the admitted ones."""
+        with self._lock:
+            self._accepting = False
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "running": self.running,
+                "queue_depth": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "mean_duration": self.mean_duration,
+            }
@@ -1,6 +1,22 @@
+import functools
+import json
+
 import yaml
 
 
+def _expected_dict(yaml_config):
+    """Run config expected for a parsed ``*_step2_best_yaml`` pipeline."""
+    expected_dict = {}
+    for i, item in enumerate(yaml_config):
+        # Skip misc and graph.cell types, or SCNFeature targets
+        if item['type'] in ['misc', 'graph.cell'] or item['target'] == 'SCNFeature':
+            continue
+        key = f"pipeline.{i}.{item['type']}"
+        value = item['target']
+        expected_dict[key] = value
+    return expected_dict
+
+
 def is_matching_dict(yaml_str, target_dict):
     """Compare YAML configuration with target dictionary.
 
@@ -19,15 +35,68 @@ def is_matching_dict(yaml_str, target_dict):
     """
     # Parse YAML string
     yaml_config = yaml.safe_load(yaml_str)
+    return _expected_dict(yaml_config) == target_dict
 
-    # Build expected dictionary format
-    expected_dict = {}
-    for i, item in enumerate(yaml_config):
-        # Skip misc and graph.cell types, or SCNFeature targets
-        if item['type'] in ['misc', 'graph.cell'] or item['target'] == 'SCNFeature':
-            continue
-        key = f"pipeline.{i}.{item['type']}"
-        value = item['target']
-        expected_dict[key] = value
 
-    return expected_dict == target_dict
\ No newline at end of file
+def config_signature(config):
+    """Canonical hashable key of a run config.
+
+    Two configs have the same signature if and only if they are equal, up to the order of their keys.
+
+    Parameters
+    ----------
+    config : dict
+        Run config, e.g. ``run.config`` of a wandb run
+
+    Returns
+    -------
+    str
+        Key-sorted JSON of the config
+
+    """
+    return json.dumps(dict(config), sort_keys=True, default=str)
+
+
+@functools.lru_cache(maxsize=4096)
+def yaml_signature(yaml_str):
+    """Signature of the run config a YAML configuration matches, see :func:`is_matching_dict`.
+
+    ``yaml_signature(yaml_str) == config_signature(target_dict)`` is equivalent to
+    ``is_matching_dict(yaml_str, target_dict)``. Signatures are memoized per YAML string, so every best configuration
+    of the atlas configuration workbook is parsed once.
+
+    """
+    return config_signature(_expected_dict(yaml.safe_load(yaml_str)))
+
+
+def match_runs(best_yamls, runs):
+    """Find the run of every best configuration with a hash join instead of comparing every pair.
+
+    Parameters
+    ----------
+    best_yamls : dict
+        Mapping from a key (e.g. the atlas dataset id) to its YAML configuration string
+    runs : list
+        Runs with a ``config`` attribute
+
+    Returns
+    -------
+    dict
+        Mapping from each key of ``best_yamls`` to its matching run, or None if no run matches
+
+    Raises
+    ------
+    ValueError
+        If several runs match the configuration of a key
+
+    """
+    runs_by_signature = {}
+    for run in runs:
+        runs_by_signature.setdefault(config_signature(run.config), []).append(run)
+    matches = {}
+    for key, yaml_str in best_yamls.items():
+        matching_runs = runs_by_signature.get(yaml_signature(yaml_str), [])
+        if len(matching_runs) > 1:
+            raise ValueError("Multiple matching runs found when only one expected")
+        matches[key] = matching_runs[0] if matching_runs else None
+    return matches
@@ -1,7 +1,10 @@
 # anndata_similarity.py
+import os
 import re
+import time
 import warnings
-from typing import Dict, List, Optional
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
 
 import anndata
 import anndata as ad
@@ -11,36 +14,43 @@ import pandas as pd
 import scanpy as sc
 import scipy
 import yaml
+from joblib import Parallel, delayed
 from omegaconf import OmegaConf
 from scipy.linalg import sqrtm
 from scipy.spatial import cKDTree
-from scipy.spatial.distance import cdist, directed_hausdorff, jensenshannon
-from sklearn.metrics.pairwise import cosine_similarity, rbf_kernel
+from scipy.spatial.distance import cdist
+from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
 
 from demos import logger
+from demos.similarity_kernels import (DEFAULT_MAX_TILE_BYTES, covariance, jaccard_similarity_matrix,
+                                     js_divergence_matrix, nearest_distances, pairwise_sums, row_corrcoef,
+                                     row_normalize, shared_pca_basis, sliced_wasserstein_distance, sqrtm_psd)
 
 
 # Suppress scipy warnings for constant input in Pearson correlation
 warnings.filterwarnings("ignore", message="An input array is constant")
 from demos.singlemodality import CellTypeAnnotationDataset
+from demos.atlas_cache import anndata_nbytes
+from demos.shared_anndata import SharedAnnData
+from demos.worker_pool import resident_atlases
 
 
-def get_anndata(tissue: str = "Blood", species: str = "human", filetype: str = "h5ad", train_dataset=[],
-                test_dataset=[], valid_dataset=[], data_dir="../temp_data"):
+def find_dataset_in_metadata(datasets, tissue):
+    datasets_in_metadata = []
+    for dataset_id in datasets:
+        all_datasets = pd.read_csv("demos/scdeepsort.csv", header=0, skiprows=[i for i in range(1, 68)])
+        for collect_dataset in all_datasets[all_datasets["tissue"] == tissue]["data_fname"].tolist():
+            if dataset_id in collect_dataset:
+                datasets_in_metadata.append(
+                    (collect_dataset.split(tissue)[1] +
+                     (tissue + collect_dataset.split(tissue)[2] if len(collect_dataset.split(tissue)) >= 3 else '')
+                     ).split('_')[0])
+                break
+    return datasets_in_metadata
 
-    def find_dataset_in_metadata(datasets, tissue):
-        datasets_in_metadata = []
-        for dataset_id in datasets:
-            all_datasets = pd.read_csv("demos/scdeepsort.csv", header=0, skiprows=[i for i in range(1, 68)])
-            for collect_dataset in all_datasets[all_datasets["tissue"] == tissue]["data_fname"].tolist():
-                if dataset_id in collect_dataset:
-                    datasets_in_metadata.append(
-                        (collect_dataset.split(tissue)[1] +
-                         (tissue + collect_dataset.split(tissue)[2] if len(collect_dataset.split(tissue)) >= 3 else '')
-                         ).split('_')[0])
-                    break
-        return datasets_in_metadata
 
+def get_anndata(tissue: str = "Blood", species: str = "human", filetype: str = "h5ad", train_dataset=[],
+                test_dataset=[], valid_dataset=[], data_dir="../temp_data"):
     train_dataset = find_dataset_in_metadata(train_dataset, tissue)
     valid_dataset = find_dataset_in_metadata(valid_dataset, tissue)
     test_dataset = find_dataset_in_metadata(test_dataset, tissue)
@@ -50,6 +60,77 @@ def get_anndata(tissue: str = "Blood", species: str = "human", filetype: str = "
     return data.data
 
 
+def get_anndata_path(dataset_id: str, tissue: str = "Blood", species: str = "human", data_dir="../temp_data") -> str:
+    """Path of the h5ad file :func:`get_anndata` reads for a single training dataset."""
+    mapped_id, = find_dataset_in_metadata([dataset_id], tissue)
+    return os.path.join(data_dir, "train", species, f"{species}_{tissue}{mapped_id}_data.h5ad")
+
+
+def select_highly_variable_genes(adata: anndata.AnnData, n_top_genes: int = 3000) -> anndata.AnnData:
+    """Filter lowly expressed genes and keep the ``seurat_v3`` highly variable genes of a single dataset.
+
+    This is the per-dataset half of :meth:`AnnDataSimilarity.filter_gene`; it only depends on ``adata`` itself, so a
+    query compared against many atlas datasets only needs it once. ``adata`` is annotated in place.
+
+    Parameters
+    ----------
+    adata : anndata.AnnData
+        Raw count data
+    n_top_genes : int
+        Number of top variable genes to select
+
+    Returns
+    -------
+    anndata.AnnData
+        Copy of ``adata`` restricted to its highly variable genes
+
+    """
+    sc.pp.filter_genes(adata, min_counts=3)
+    sc.pp.highly_variable_genes(adata, n_top_genes=n_top_genes, flavor='seurat_v3')
+    return adata[:, adata.var['highly_variable']].copy()
+
+
+def atlas_key(tissue: str, atlas_id: str, n_top_genes: int) -> Tuple[str, str, int]:
+    """Key of a loaded atlas dataset among the resident atlas datasets of a pool worker."""
+    return tissue, atlas_id, n_top_genes
+
+
+def load_atlas(tissue: str, atlas_id: str, data_dir: str = "../temp_data", n_top_genes: int = 3000,
+               store=None) -> anndata.AnnData:
+    """Load one atlas dataset restricted to its highly variable genes.
+
+    The atlas dataset is read from ``store`` (see :mod:`demos.atlas_store`) if given, from its h5ad file otherwise. In
+    a pool worker, it is taken from (and added to) the resident atlas datasets of the worker.
+
+    """
+    cache = resident_atlases()
+    key = atlas_key(tissue, atlas_id, n_top_genes)
+    if cache is not None and (atlas := cache.get(key)) is not None:
+        return atlas
+    if store is not None:
+        atlas = store.load(tissue, atlas_id)
+    else:
+        atlas = get_anndata(train_dataset=[f"{atlas_id}"], data_dir=data_dir, tissue=tissue.capitalize())
+        atlas = select_highly_variable_genes(atlas, n_top_genes=n_top_genes)
+    if cache is not None:
+        cache.put(key, atlas)
+    return atlas
+
+
+def warm_atlas(tissue: str, atlas_id: str, data_dir: str = "../temp_data", n_top_genes: int = 3000,
+               store=None) -> Tuple[str, int]:
+    """Load an atlas dataset into the resident atlas datasets of the current pool worker, return its size."""
+    return atlas_id, anndata_nbytes(load_atlas(tissue, atlas_id, data_dir, n_top_genes=n_top_genes, store=store))
+
+
+def _as_csr(X, nan_to_num: bool = False) -> scipy.sparse.csr_matrix:
+    """CSR float64 copy of a dense or sparse expression matrix."""
+    X = scipy.sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    if nan_to_num:
+        X.data = np.nan_to_num(X.data)
+    return X
+
+
 class AnnDataSimilarity:
     """A class to compute various similarity metrics between two AnnData objects.
 
@@ -75,17 +156,66 @@ class AnnDataSimilarity:
         List of cell type annotation methods to use
     tissue : str
         Tissue type being analyzed
+    max_tile_bytes : int
+        Memory budget of a single tile in the blocked pairwise kernels. Bounds the peak memory of the JS divergence,
+        MMD and energy distance computations, e.g. ``256 * 1024**2`` for 256 MB
+    sparse : bool
+        Keep the expression matrices in CSR format. Row normalization and the euclidean distances of wasserstein,
+        sinkhorn2, Hausdorff, chamfer, energy and mmd are then computed from sparse products, and rows are only
+        densified in bounded tiles. The exact covariances of bures and spectral are dense gene x gene matrices and
+        are computed from densified rows in both modes
+    adata1_hvg_selected : bool
+        ``adata1`` was already passed through :func:`select_highly_variable_genes`. It is then neither copied nor
+        re-filtered, only intersected with the genes of ``adata2``
+    adata2_hvg_selected : bool
+        Same as ``adata1_hvg_selected`` for ``adata2``
+    covariance_rank : Optional[int]
+        If set, ``bures`` and ``spectral`` compare the covariances of both datasets projected onto a shared
+        randomized PCA basis of this rank instead of the full gene x gene covariances. The projected matrices are
+        ``covariance_rank`` x ``covariance_rank``, so the square roots are cheap eigendecompositions and always real
+    n_projections : int
+        Number of random directions of the ``wasserstein_sliced`` metric
+    projection_seed : Optional[int]
+        Seed of the ``wasserstein_sliced`` directions, fixed so that the score of a pair is reproducible
+
+    Notes
+    -----
+    Within one run of :meth:`compute_similarity`, geometry shared by several metrics (the X/Y cost matrix, pairwise
+    distance sums, covariance matrices and KD-trees) is built at most once. Each metric declares the intermediates it
+    reads in ``METRIC_INTERMEDIATES``, and an intermediate is freed as soon as its last consumer of the run is done.
 
     """
 
+    METRIC_INTERMEDIATES = {
+        "wasserstein": ("cost_matrix", ),
+        "sinkhorn2": ("cost_matrix", ),
+        "Hausdorff": ("nearest_distances", ),
+        "chamfer": ("nearest_distances", ),
+        "energy": ("self_pair_sums", "cross_pair_sums"),
+        "mmd": ("self_pair_sums", "cross_pair_sums"),
+        "bures": ("covariances", ),
+        "spectral": ("covariances", ),
+    }
+    COST_MATRIX_DERIVED = ("nearest_distances", "cross_pair_sums")
+    # obs columns read by get_dataset_meta_sim
+    METADATA_OBS_COLUMNS = ("assay", "tissue", "nnz", "n_measured_vars", "n_counts")
+    rbf_gamma = 1.0
+
     def __init__(self, adata1: anndata.AnnData, adata2: anndata.AnnData, sample_size: Optional[int] = None,
                  init_random_state: Optional[int] = None, n_runs: int = 10,
                  ground_truth_conf_path: Optional[str] = None, adata1_name: Optional[str] = None,
                  adata2_name: Optional[str] = None,
-                 methods=['cta_actinn', 'cta_celltypist', 'cta_scdeepsort', 'cta_singlecellnet'], tissue="blood"):
+                 methods=['cta_actinn', 'cta_celltypist', 'cta_scdeepsort', 'cta_singlecellnet'], tissue="blood",
+                 max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES, sparse: bool = False,
+                 adata1_hvg_selected: bool = False, adata2_hvg_selected: bool = False,
+                 covariance_rank: Optional[int] = None, n_projections: int = 200,
+                 projection_seed: Optional[int] = 0):
         """Initialize the AnnDataSimilarity object and perform data preprocessing."""
-        self.origin_adata1 = adata1.copy()
-        self.origin_adata2 = adata2.copy()
+        # Preselected inputs are only read and sliced (with a copy) by filter_gene, so they can be shared
+        self.origin_adata1 = adata1 if adata1_hvg_selected else adata1.copy()
+        self.origin_adata2 = adata2 if adata2_hvg_selected else adata2.copy()
+        self.adata1_hvg_selected = adata1_hvg_selected
+        self.adata2_hvg_selected = adata2_hvg_selected
         self.sample_size = sample_size
         self.init_random_state = init_random_state
         self.preprocess()
@@ -96,6 +226,12 @@ class AnnDataSimilarity:
         self.methods = methods
         self.tissue = tissue
         self.n_runs = n_runs
+        self.max_tile_bytes = max_tile_bytes
+        self.sparse = sparse
+        self.covariance_rank = covariance_rank
+        self.n_projections = n_projections
+        self.projection_seed = projection_seed
+        self._plan_intermediates([])
 
     def filter_gene(self, n_top_genes=3000):
         """Filter genes to keep only highly variable genes common between datasets.
@@ -106,13 +242,12 @@ class AnnDataSimilarity:
             Number of top variable genes to select
 
         """
-        sc.pp.filter_genes(self.origin_adata1, min_counts=3)
-        sc.pp.filter_genes(self.origin_adata2, min_counts=3)
-        sc.pp.highly_variable_genes(self.origin_adata1, n_top_genes=n_top_genes, flavor='seurat_v3')
-        sc.pp.highly_variable_genes(self.origin_adata2, n_top_genes=n_top_genes, flavor='seurat_v3')
+        if not self.adata1_hvg_selected:
+            self.origin_adata1 = select_highly_variable_genes(self.origin_adata1, n_top_genes=n_top_genes)
+        if not self.adata2_hvg_selected:
+            self.origin_adata2 = select_highly_variable_genes(self.origin_adata2, n_top_genes=n_top_genes)
 
-        common_hvg = self.origin_adata1.var_names[self.origin_adata1.var['highly_variable']].intersection(
-            self.origin_adata2.var_names[self.origin_adata2.var['highly_variable']])
+        common_hvg = self.origin_adata1.var_names.intersection(self.origin_adata2.var_names)
 
         self.origin_adata1 = self.origin_adata1[:, common_hvg].copy()
         self.origin_adata2 = self.origin_adata2[:, common_hvg].copy()
@@ -148,6 +283,12 @@ class AnnDataSimilarity:
 
     def set_prob_data(self, sampled=False):
         # Normalize the data to probability distributions
+        if self.sparse:
+            adata1, adata2 = (self.sampled_adata1, self.sampled_adata2) if sampled else (self.adata1, self.adata2)
+            # Zero rows stay zero, as nan_to_num does below, and the matrices stay CSR
+            self.X = row_normalize(_as_csr(adata1.X))
+            self.Y = row_normalize(_as_csr(adata2.X))
+            return
         if sampled:
             prob_adata1 = self.sampled_adata1.X / self.sampled_adata1.X.sum(axis=1)
             prob_adata2 = self.sampled_adata2.X / self.sampled_adata2.X.sum(axis=1)
@@ -169,63 +310,117 @@ class AnnDataSimilarity:
     def pearson_corr_sampled(self) -> pd.DataFrame:
         """Computes the average Pearson correlation coefficient between all pairs of
         cells from the two datasets."""
-        # Compute Pearson correlation matrix
-        corr_matrix = np.corrcoef(self.sampled_adata1.X.toarray(),
-                                  self.sampled_adata2.X.toarray())[:self.sampled_adata1.n_obs,
-                                                                   self.sampled_adata1.n_obs:]
+        # Compute Pearson correlation matrix (the cross block of np.corrcoef, from sparse dot products)
+        corr_matrix = row_corrcoef(self.sampled_adata1.X, self.sampled_adata2.X)
         # Return the average correlation
         return np.nanmean(corr_matrix)
 
     def jaccard_sim_sampled(self, threshold: float = 0.5) -> pd.DataFrame:
         """Computes the average Jaccard similarity between all pairs of binarized cells
         from the two datasets."""
-        # Binarize the data
-        binary_adata1 = (self.sampled_adata1.X > threshold).astype(int)
-        binary_adata2 = (self.sampled_adata2.X > threshold).astype(int)
-        # Compute Jaccard distance matrix
-        distance_matrix = cdist(binary_adata1.A, binary_adata2.A, metric='jaccard')
-        # Convert to similarity and compute the average
-        similarity_matrix = 1 - distance_matrix
+        # Binarize the data and compute the Jaccard similarity matrix from sparse intersection counts
+        similarity_matrix = jaccard_similarity_matrix(self.sampled_adata1.X, self.sampled_adata2.X,
+                                                      threshold=threshold)
         return similarity_matrix.mean()
 
     def js_divergence_sampled(self) -> float:
         """Computes the average Jensen-Shannon divergence between all pairs of cells
         from the two datasets."""
-        # Normalize the data to probability distributions
-        prob_adata1 = self.sampled_adata1.X / self.sampled_adata1.X.sum(axis=1)
-        prob_adata2 = self.sampled_adata2.X / self.sampled_adata2.X.sum(axis=1)
-        # Handle any NaN values resulting from division by zero
-        prob_adata1 = np.nan_to_num(prob_adata1).toarray()
-        prob_adata2 = np.nan_to_num(prob_adata2).toarray()
-
-        # Define a function to compute JS divergence for a pair of probability vectors
-        def jsd(p, q):
-            return jensenshannon(p, q)
-
-        # Compute JS divergence matrix
-        jsd_vectorized = np.vectorize(jsd, signature='(n),(n)->()')
-        divergence_matrix = np.zeros((prob_adata1.shape[0], prob_adata2.shape[0]))
-        for i in range(prob_adata1.shape[0]):
-            divergence_matrix[i, :] = jsd_vectorized(
-                np.repeat(prob_adata1[i, :], prob_adata2.shape[0], axis=0).reshape(-1, prob_adata1.shape[1]),
-                prob_adata2)
+        # Rows are normalized to probability distributions inside the kernel, which also keeps sparse input sparse
+        divergence_matrix = js_divergence_matrix(self.sampled_adata1.X, self.sampled_adata2.X,
+                                                 max_tile_bytes=self.max_tile_bytes)
 
         # Convert divergence to similarity and compute the average
         similarity_matrix = 1 - divergence_matrix
         return np.nanmean(similarity_matrix)
 
+    def _plan_intermediates(self, methods: List[str]):
+        """Reset the per-run intermediate cache and count how many of ``methods`` consume each intermediate."""
+        self._intermediates = {}
+        self._pending_consumers = Counter(name for method in methods
+                                          for name in self.METRIC_INTERMEDIATES.get(method, ()))
+        # Derived intermediates are read off the cost matrix when some metric needs it anyway
+        if self._pending_consumers["cost_matrix"] > 0:
+            for derived in self.COST_MATRIX_DERIVED:
+                if self._pending_consumers[derived] > 0:
+                    self._pending_consumers["cost_matrix"] += 1
+
+    def _intermediate(self, name: str):
+        """Return the intermediate ``name`` of the current run, building it on first use."""
+        if name not in self._intermediates:
+            self._intermediates[name] = getattr(self, f"_build_{name}")()
+        return self._intermediates[name]
+
+    def _release_intermediate(self, name: str):
+        """Drop one pending consumer of ``name`` and free the intermediate once nobody needs it anymore."""
+        self._pending_consumers[name] -= 1
+        if self._pending_consumers[name] <= 0:
+            self._intermediates.pop(name, None)
+
+    def _build_cost_matrix(self):
+        if self.sparse:
+            return euclidean_distances(self.X, self.Y)
+        # Exact float64 distances: ot.dist would stay in the (possibly float32) input dtype
+        return cdist(self.X, self.Y, metric='euclidean')
+
+    def _build_kdtrees(self):
+        return cKDTree(self.X), cKDTree(self.Y)
+
+    def _build_nearest_distances(self):
+        """Distance from each X cell to its nearest Y cell and from each Y cell to its nearest X cell."""
+        if self._pending_consumers["cost_matrix"] > 0:
+            M = self._intermediate("cost_matrix")
+            nearest = M.min(axis=1), M.min(axis=0)
+            self._release_intermediate("cost_matrix")
+            return nearest
+        if self.sparse:
+            # KD-trees need dense input; scan tiles of sparse dot-product distances instead
+            return nearest_distances(self.X, self.Y, max_tile_bytes=self.max_tile_bytes)
+        tree_X, tree_Y = self._intermediate("kdtrees")
+        x_to_y, _ = tree_Y.query(self.X)
+        y_to_x, _ = tree_X.query(self.Y)
+        return x_to_y, y_to_x
+
+    def _distance_kernels(self):
+        return {"euclidean": None, "rbf": lambda dist: np.exp(-self.rbf_gamma * np.square(dist))}
+
+    def _build_self_pair_sums(self):
+        """Off-diagonal sums of the euclidean distances and RBF kernel within X and within Y."""
+        return tuple(
+            pairwise_sums(Z, funcs=self._distance_kernels(), exclude_diagonal=True,
+                          max_tile_bytes=self.max_tile_bytes) for Z in (self.X, self.Y))
+
+    def _build_cross_pair_sums(self):
+        """Sums of the euclidean distances and RBF kernel between X and Y."""
+        if self._pending_consumers["cost_matrix"] > 0:
+            M = self._intermediate("cost_matrix")
+            sums = {
+                name: float((M if func is None else func(M)).sum())
+                for name, func in self._distance_kernels().items()
+            }
+            self._release_intermediate("cost_matrix")
+            return sums
+        return pairwise_sums(self.X, self.Y, funcs=self._distance_kernels(), max_tile_bytes=self.max_tile_bytes)
+
+    def _build_covariances(self):
+        if self.covariance_rank is None:
+            return covariance(self.X), covariance(self.Y)
+        # V.T @ C @ V is the covariance of the projected cells, so the gene x gene matrices are never formed
+        basis = shared_pca_basis(self.X, self.Y, rank=self.covariance_rank, random_state=self.init_random_state)
+        return covariance(np.asarray(self.X @ basis)), covariance(np.asarray(self.Y @ basis))
+
+    def _rbf_mmd_squared(self) -> float:
+        self_sums_X, self_sums_Y = self._intermediate("self_pair_sums")
+        cross_sums = self._intermediate("cross_pair_sums")
+        m = self.X.shape[0]
+        n = self.Y.shape[0]
+        sum_X = self_sums_X["rbf"] / (m * (m - 1))
+        sum_Y = self_sums_Y["rbf"] / (n * (n - 1))
+        sum_XY = cross_sums["rbf"] / (m * n)
+        return sum_X + sum_Y - 2 * sum_XY
+
     def compute_mmd_alternative(self) -> float:
-        X = self.X
-        Y = self.Y
-        gamma = 1.0
-        K_XX = rbf_kernel(X, X, gamma)
-        K_YY = rbf_kernel(Y, Y, gamma)
-        K_XY = rbf_kernel(X, Y, gamma)
-        n_x = X.shape[0]
-        n_y = Y.shape[0]
-        mmd = (K_XX.sum() - np.trace(K_XX)) / (n_x * (n_x - 1)) \
-            + (K_YY.sum() - np.trace(K_YY)) / (n_y * (n_y - 1)) \
-            - 2 * K_XY.mean()
+        mmd = self._rbf_mmd_squared()
         return 1 / (1 + np.sqrt(max(mmd, 0)))
 
     def compute_mmd(self) -> float:
@@ -240,26 +435,24 @@ class AnnDataSimilarity:
         X = self.X
         Y = self.Y
         kernel = "rbf"
-        gamma = 1.0
         if kernel == 'rbf':
-            K_X = np.exp(-gamma * cdist(X, X, 'sqeuclidean'))
-            K_Y = np.exp(-gamma * cdist(Y, Y, 'sqeuclidean'))
-            K_XY = np.exp(-gamma * cdist(X, Y, 'sqeuclidean'))
+            # Kernel sums are streamed over tiles instead of building the dense K_X, K_Y and K_XY matrices
+            mmd_squared = self._rbf_mmd_squared()
         elif kernel == 'linear':
-            K_X = np.dot(X, X.T)
-            K_Y = np.dot(Y, Y.T)
-            K_XY = np.dot(X, Y.T)
+            # sum_ij <x_i, y_j> = <sum_i x_i, sum_j y_j>, so the Gram matrices are never needed
+            m = X.shape[0]
+            n = Y.shape[0]
+            X_sum = np.asarray(X.sum(axis=0)).ravel()
+            Y_sum = np.asarray(Y.sum(axis=0)).ravel()
+            X_sq = X.multiply(X).sum() if self.sparse else np.square(X).sum()
+            Y_sq = Y.multiply(Y).sum() if self.sparse else np.square(Y).sum()
+            sum_X = (X_sum @ X_sum - X_sq) / (m * (m - 1))
+            sum_Y = (Y_sum @ Y_sum - Y_sq) / (n * (n - 1))
+            sum_XY = X_sum @ Y_sum / (m * n)
+            mmd_squared = sum_X + sum_Y - 2 * sum_XY
         else:
             raise ValueError("Unsupported kernel type")
 
-        m = X.shape[0]
-        n = Y.shape[0]
-
-        sum_X = (np.sum(K_X) - np.sum(np.diag(K_X))) / (m * (m - 1))
-        sum_Y = (np.sum(K_Y) - np.sum(np.diag(K_Y))) / (n * (n - 1))
-        sum_XY = np.sum(K_XY) / (m * n)
-
-        mmd_squared = sum_X + sum_Y - 2 * sum_XY
         mmd = np.sqrt(max(mmd_squared, 0))
         return 1 / (1 + mmd)
 
@@ -286,15 +479,31 @@ class AnnDataSimilarity:
         Y = self.Y
         a = np.ones((X.shape[0], )) / X.shape[0]
         b = np.ones((Y.shape[0], )) / Y.shape[0]
-        M = ot.dist(X, Y, metric='euclidean')
+        M = self._intermediate("cost_matrix")
         wasserstein_dist = ot.emd2(a, b, M)
         return 1 / (1 + wasserstein_dist)
 
+    def sliced_wasserstein_dist(self) -> float:
+        """Compute the sliced Wasserstein distance between datasets.
+
+        Fast alternative to :meth:`wasserstein_dist` that never builds the cell x cell cost matrix.
+
+        Returns
+        -------
+        float
+            Normalized sliced Wasserstein similarity score between 0 and 1
+
+        """
+        sliced_dist = sliced_wasserstein_distance(self.X, self.Y, n_projections=self.n_projections,
+                                                  seed=self.projection_seed)
+        return 1 / (1 + sliced_dist)
+
     def get_Hausdorff(self):
         X = self.X
-        Y = self.Y
-        forward = directed_hausdorff(X, Y)[0]
-        backward = directed_hausdorff(X, Y)[0]
+        x_to_y, _ = self._intermediate("nearest_distances")
+        # Same as directed_hausdorff(X, Y); the backward term has always repeated the X to Y direction
+        forward = x_to_y.max()
+        backward = x_to_y.max()
         hausdorff_distance = max(forward, backward)
         normalized_hausdorff = hausdorff_distance / np.sqrt(X.shape[1])
         similarity = 1 - normalized_hausdorff
@@ -302,12 +511,7 @@ class AnnDataSimilarity:
 
     def chamfer_distance(self):
         X = self.X
-        Y = self.Y
-        tree_A = cKDTree(X)
-        tree_B = cKDTree(Y)
-
-        distances_A_to_B, _ = tree_A.query(Y)
-        distances_B_to_A, _ = tree_B.query(X)
+        distances_B_to_A, distances_A_to_B = self._intermediate("nearest_distances")
 
         chamfer_A_to_B = np.mean(distances_A_to_B)
         chamfer_B_to_A = np.mean(distances_B_to_A)
@@ -317,12 +521,15 @@ class AnnDataSimilarity:
         return similarity
 
     def energy_distance_metric(self):
-        X = self.X
-        Y = self.Y
-        XX = cdist(X, X, 'euclidean')
-        YY = cdist(Y, Y, 'euclidean')
-        XY = cdist(X, Y, 'euclidean')
-        distance = 2 * np.mean(XY) - np.mean(XX) - np.mean(YY)
+        m = self.X.shape[0]
+        n = self.Y.shape[0]
+        self_sums_X, self_sums_Y = self._intermediate("self_pair_sums")
+        cross_sums = self._intermediate("cross_pair_sums")
+        # The diagonal of a distance matrix is zero, so the off-diagonal sums give the full means
+        XY = cross_sums["euclidean"] / (m * n)
+        XX = self_sums_X["euclidean"] / (m * m)
+        YY = self_sums_Y["euclidean"] / (n * n)
+        distance = 2 * XY - XX - YY
         return 1 / (1 + distance)
 
     def get_sinkhorn2(self):
@@ -330,27 +537,27 @@ class AnnDataSimilarity:
         Y = self.Y
         a = np.ones(X.shape[0]) / X.shape[0]
         b = np.ones(Y.shape[0]) / Y.shape[0]
-        M = ot.dist(X, Y, metric='euclidean')
+        M = self._intermediate("cost_matrix")
         reg = 0.1
         sinkhorn_dist = ot.sinkhorn2(a, b, M, reg)
         return 1 / (1 + sinkhorn_dist)
 
     def bures_distance(self):
-        X = self.X
-        Y = self.Y
-        C1 = np.cov(X, rowvar=False)
-        C2 = np.cov(Y, rowvar=False)
-        sqrt_C1 = sqrtm(C1)
-        product = sqrt_C1 @ C2 @ sqrt_C1
-        sqrt_product = sqrtm(product)
-        trace = np.trace(C1) + np.trace(C2) - 2 * np.trace(sqrt_product)
+        C1, C2 = self._intermediate("covariances")
+        if self.covariance_rank is None:
+            sqrt_C1 = sqrtm(C1)
+            product = sqrt_C1 @ C2 @ sqrt_C1
+            trace_sqrt_product = np.trace(sqrtm(product))
+        else:
+            # Both factors are symmetric PSD, so tr(sqrtm(product)) is the sum of the roots of its eigenvalues
+            sqrt_C1 = sqrtm_psd(C1)
+            product = sqrt_C1 @ C2 @ sqrt_C1
+            trace_sqrt_product = np.sqrt(np.clip(np.linalg.eigvalsh(product), 0, None)).sum()
+        trace = np.trace(C1) + np.trace(C2) - 2 * trace_sqrt_product
         return 1 / (1 + np.sqrt(max(trace, 0)))
 
     def spectral_distance(self):
-        X = self.X
-        Y = self.Y
-        C1 = np.cov(X, rowvar=False)
-        C2 = np.cov(Y, rowvar=False)
+        C1, C2 = self._intermediate("covariances")
         eig_A = np.linalg.eigvalsh(C1)
         eig_B = np.linalg.eigvalsh(C2)
         return 1 / (1 + np.linalg.norm(eig_A - eig_B))
@@ -460,7 +667,7 @@ class AnnDataSimilarity:
 
     def compute_similarity(self, random_state: int, methods: List[str] = [
         'cosine', 'pearson', 'jaccard', 'js_distance', 'otdd', 'common_genes_num', "ground_truth", "metadata_sim"
-    ], origin=False) -> Dict[str, float]:
+    ], origin=False, sampled=False) -> Dict[str, float]:
         """Compute multiple similarity metrics between datasets.
 
         Parameters
@@ -469,6 +676,8 @@ class AnnDataSimilarity:
             Random seed for cell sampling
         methods : List[str]
             List of similarity methods to compute
+        sampled : bool
+            Compute the distribution metrics (wasserstein, bures, mmd, ...) on the sampled cells instead of all cells
 
         Returns
         -------
@@ -478,13 +687,17 @@ class AnnDataSimilarity:
         """
         self.adata1 = self.origin_adata1.copy()
         self.adata2 = self.origin_adata2.copy()
-        if origin:
+        if origin and self.sparse:
+            self.X = _as_csr(self.adata1.X, nan_to_num=True)
+            self.Y = _as_csr(self.adata2.X, nan_to_num=True)
+        elif origin:
             self.X = np.nan_to_num(self.adata1.X).toarray()
             self.Y = np.nan_to_num(self.adata2.X).toarray()
         else:
             self.normalize_data()
             self.sample_cells(random_state)
-            self.set_prob_data()
+            self.set_prob_data(sampled=sampled)
+        self._plan_intermediates(methods)
 
         results = {}
         for method in methods:
@@ -499,6 +712,8 @@ class AnnDataSimilarity:
                 results['js_distance'] = self.js_divergence_sampled()
             elif method == 'wasserstein':
                 results['wasserstein'] = self.wasserstein_dist()
+            elif method == 'wasserstein_sliced':
+                results['wasserstein_sliced'] = self.sliced_wasserstein_dist()
             elif method == "common_genes_num":
                 results["common_genes_num"] = self.common_genes_num()
             elif method == "Hausdorff":
@@ -523,6 +738,8 @@ class AnnDataSimilarity:
                 results["mmd"] = self.compute_mmd()
             else:
                 raise ValueError(f"Unsupported similarity method: {method}")
+            for name in self.METRIC_INTERMEDIATES.get(method, ()):
+                self._release_intermediate(name)
         return results
 
     def get_similarity_matrix_A2B(
@@ -554,6 +771,23 @@ class AnnDataSimilarity:
         }
         return averaged_results
 
+    def sampled_runs(self, methods: List[str], sample_size: int, random_states: List[int]) -> Dict[str, list]:
+        """Compute ``methods`` on ``sample_size`` sampled cells of each dataset, once per random state.
+
+        Returns
+        -------
+        Dict[str, list]
+            Dictionary mapping method names to the values of every run
+
+        """
+        self.sample_size = sample_size
+        runs = {method: [] for method in methods}
+        for random_state in random_states:
+            run_results = self.compute_similarity(random_state=random_state, methods=methods, sampled=True)
+            for method in methods:
+                runs[method].append(run_results[method])
+        return runs
+
     # def get_max_similarity_A_to_B(self):
     #     if self.results is None:
     #         raise ValueError(f"need results!")
@@ -577,6 +811,320 @@ class AnnDataSimilarity:
     #     return overall_similarity
 
 
+class AtlasSimilarityBatch:
+    """Score one query dataset against many atlas datasets of a tissue.
+
+    The query is copied, gene-filtered and reduced to its highly variable genes once for the whole batch instead of
+    once per atlas dataset. Each atlas dataset is then loaded, reduced to its own highly variable genes and compared
+    with :class:`AnnDataSimilarity`, which only intersects the two gene sets.
+
+    Parameters
+    ----------
+    query : anndata.AnnData
+        Query dataset with raw counts
+    atlas_list : List[str]
+        Atlas dataset ids of the tissue
+    tissue : str
+        Tissue of the atlas datasets
+    data_dir : str
+        Directory holding the atlas h5ad files, see :func:`get_anndata`
+    n_top_genes : int
+        Number of highly variable genes selected per dataset
+    n_jobs : int
+        Number of joblib workers scoring atlas datasets in parallel
+    store : Optional[AtlasStatsStore]
+        Store of precomputed atlas data (see :mod:`demos.atlas_store`). Atlas datasets are then read from their stored
+        highly variable genes instead of the full h5ad files
+    pool : Optional[WorkerPool]
+        Persistent worker pool (see :mod:`demos.worker_pool`) scoring the atlas datasets instead of ``n_jobs``
+        joblib workers. Its workers keep the atlas datasets they loaded resident between batches
+    share_query : bool
+        Hand the prepared query over to parallel workers through memory-mapped buffers (see
+        :class:`SharedAnnData`) instead of pickling it into every task. The buffers are removed by :meth:`close`
+    **similarity_kwargs
+        Passed on to :class:`AnnDataSimilarity`, e.g. ``sample_size``, ``init_random_state`` or ``n_runs``
+
+    Notes
+    -----
+    Normalization, covariances and nearest-neighbour structures are computed on the genes shared by the query and one
+    atlas dataset, so they stay per pair; everything that only depends on the query is prepared here.
+
+    Use the batch as a context manager so that the shared query buffers are removed as soon as it is done.
+
+    """
+
+    def __init__(self, query: anndata.AnnData, atlas_list: List[str], tissue: str, data_dir: str = "../temp_data",
+                 n_top_genes: int = 3000, n_jobs: int = -1, store=None, pool=None, share_query: bool = True,
+                 **similarity_kwargs):
+        if store is not None and store.n_top_genes != n_top_genes:
+            raise ValueError(f"Atlas store holds {store.n_top_genes} highly variable genes, got {n_top_genes=}")
+        self.query = select_highly_variable_genes(query.copy(), n_top_genes=n_top_genes)
+        self.atlas_list = list(atlas_list)
+        self.tissue = tissue
+        self.data_dir = data_dir
+        self.n_top_genes = n_top_genes
+        self.n_jobs = n_jobs
+        self.store = store
+        self.pool = pool
+        self.share_query = share_query
+        self.similarity_kwargs = similarity_kwargs
+        self.shared_query = None
+
+    def __getstate__(self):
+        # Tasks sent to workers carry the batch, but neither the pool nor a shared query
+        state = {**self.__dict__, "pool": None}
+        if self.shared_query is not None:
+            state["query"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.query is None:
+            self.query = self.shared_query.open()
+
+    def close(self):
+        """Remove the buffers of the shared query."""
+        if self.shared_query is not None:
+            self.shared_query.close()
+            self.shared_query = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def atlas_key(self, atlas_id: str) -> Tuple[str, str, int]:
+        return atlas_key(self.tissue, atlas_id, self.n_top_genes)
+
+    def load_atlas(self, atlas_id: str) -> anndata.AnnData:
+        """Load one atlas dataset restricted to its highly variable genes, see :func:`load_atlas`."""
+        return load_atlas(self.tissue, atlas_id, self.data_dir, n_top_genes=self.n_top_genes, store=self.store)
+
+    def calculator(self, atlas_id: str, **options) -> AnnDataSimilarity:
+        """Similarity calculator between the prepared query and one atlas dataset.
+
+        ``options`` override the ``similarity_kwargs`` of the batch, e.g. ``covariance_rank`` for one stage of
+        :meth:`compute_cascade`.
+
+        """
+        return AnnDataSimilarity(adata1=self.query, adata2=self.load_atlas(atlas_id), tissue=self.tissue,
+                                 adata1_hvg_selected=True, adata2_hvg_selected=True,
+                                 **{**self.similarity_kwargs, **options})
+
+    def score(self, atlas_id: str, methods: List[str], **options) -> Tuple[str, Dict[str, float]]:
+        """Compute ``methods`` between the query and one atlas dataset."""
+        return atlas_id, self.calculator(atlas_id, **options).get_similarity_matrix_A2B(methods=methods)
+
+    def sampled_runs(self, atlas_id: str, methods: List[str], sample_size: int,
+                     random_states: List[int]) -> Tuple[str, Dict[str, list]]:
+        """Per-run values of ``methods`` on sampled cells of the query and one atlas dataset."""
+        return atlas_id, self.calculator(atlas_id).sampled_runs(methods, sample_size, random_states)
+
+    def map(self, method_name: str, calls: List[Tuple[str, tuple, dict]]) -> list:
+        """Run ``getattr(self, method_name)(atlas_id, *args, **kwargs)`` for each call in parallel.
+
+        Calls run in the worker pool if the batch has one, in ``n_jobs`` joblib workers otherwise.
+
+        """
+        if self.share_query and self.shared_query is None and (self.pool is not None or self.n_jobs != 1):
+            self.shared_query = SharedAnnData(self.query, obs_columns=AnnDataSimilarity.METADATA_OBS_COLUMNS)
+        if self.pool is None:
+            return Parallel(n_jobs=self.n_jobs)(
+                delayed(getattr(self, method_name))(atlas_id, *args, **kwargs) for atlas_id, args, kwargs in calls)
+        futures = [
+            self.pool.submit(_call_batch, self, method_name, atlas_id, *args, affinity=self.atlas_key(atlas_id),
+                             **kwargs) for atlas_id, args, kwargs in calls
+        ]
+        return [future.result() for future in futures]
+
+    def compute(self, methods: List[str], atlas_list: Optional[List[str]] = None,
+                **options) -> Dict[str, Dict[str, float]]:
+        """Compute ``methods`` between the query and every atlas dataset.
+
+        Parameters
+        ----------
+        methods : List[str]
+            List of similarity methods to compute
+        atlas_list : Optional[List[str]]
+            Atlas dataset ids to score, all atlas datasets of the batch by default
+        **options
+            Overrides of the ``similarity_kwargs`` of the batch
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            Mapping from atlas dataset id to the metric values of that pair
+
+        """
+        atlas_list = self.atlas_list if atlas_list is None else atlas_list
+        return dict(self.map("score", [(atlas_id, (methods, ), options) for atlas_id in atlas_list]))
+
+    def compute_cascade(self, stages: List[dict]) -> Tuple[Dict[str, Dict], Dict]:
+        """Shortlist atlas datasets with cheap metrics and run the expensive ones on the shortlist only.
+
+        Each stage is a dict with the keys
+
+        * ``methods``: similarity methods computed on the current candidates
+        * ``top_k`` (optional): number of candidates kept after the stage, all of them if missing or None
+        * ``rank_by`` (optional): method the candidates are ranked by, the first of ``methods`` by default
+        * ``options`` (optional): overrides of the ``similarity_kwargs`` for this stage, e.g.
+          ``{"covariance_rank": 50}`` for a low-rank ``spectral`` stage
+
+        Later stages overwrite values of the same method computed by earlier ones.
+
+        Returns
+        -------
+        Tuple[Dict[str, Dict], Dict]
+            Mapping from each atlas dataset that survived all stages to its metric values, and a report with the
+            candidates, shortlist and elapsed seconds of every stage
+
+        """
+        candidates = list(self.atlas_list)
+        scores = {atlas_id: {} for atlas_id in candidates}
+        report = {"stages": []}
+        for stage in stages:
+            t_start = time.perf_counter()
+            n_candidates = len(candidates)
+            for atlas_id, atlas_results in self.compute(stage["methods"], atlas_list=candidates,
+                                                         **stage.get("options", {})).items():
+                scores[atlas_id].update(atlas_results)
+            rank_by = stage.get("rank_by", stage["methods"][0])
+            if stage.get("top_k") is not None:
+                candidates = sorted(candidates, key=lambda atlas_id: np.real(scores[atlas_id][rank_by]),
+                                    reverse=True)[:stage["top_k"]]
+            elapsed = time.perf_counter() - t_start
+            logger.info(f"Cascade stage {stage['methods']}: {n_candidates} -> {len(candidates)} atlas datasets, "
+                        f"{elapsed:.1f}s")
+            report["stages"].append({
+                "methods": list(stage["methods"]),
+                "rank_by": rank_by,
+                "top_k": stage.get("top_k"),
+                "n_candidates": n_candidates,
+                "shortlist": list(candidates),
+                "elapsed": elapsed,
+            })
+        return {atlas_id: scores[atlas_id] for atlas_id in candidates}, report
+
+    @staticmethod
+    def ambiguous_atlases(means: Dict[str, float], errors: Dict[str, float], top_k: int, z: float) -> List[str]:
+        """Atlas datasets whose confidence interval straddles the boundary between the top ``top_k`` and the rest."""
+        ranked = sorted(means, key=means.get, reverse=True)
+        if len(ranked) <= top_k:
+            return []
+        boundary = (means[ranked[top_k - 1]] + means[ranked[top_k]]) / 2
+        return [atlas_id for atlas_id in ranked if abs(means[atlas_id] - boundary) <= z * errors[atlas_id]]
+
+    def compute_adaptive(self, methods: List[str], feature_name: str, top_k: int = 3, initial_sample_size: int = 10,
+                         max_sample_size: int = 1000, growth: int = 2, runs_per_round: int = 2, max_runs: int = 8,
+                         z: float = 1.96, time_budget: Optional[float] = None) -> Tuple[Dict[str, Dict], Dict]:
+        """Compute ``methods`` on progressively larger cell samples until the top-k atlas ranking is stable.
+
+        All metrics, including the distribution metrics, are computed on sampled cells. Each round adds
+        ``runs_per_round`` runs to the atlas datasets whose ranking is still ambiguous, i.e. whose ``z`` confidence
+        interval of ``feature_name`` straddles the score separating the top ``top_k`` atlas datasets from the rest.
+        Once an ambiguous atlas dataset reached ``max_runs`` runs, the sample size is multiplied by ``growth`` and
+        every atlas dataset starts over, since scores at different sample sizes are not comparable. Sampling stops as
+        soon as no atlas dataset is ambiguous, at ``max_sample_size``, or after the round exceeding ``time_budget``.
+
+        Parameters
+        ----------
+        methods : List[str]
+            List of similarity methods to compute
+        feature_name : str
+            Method the atlas datasets are ranked by, must be one of ``methods``
+        top_k : int
+            Number of top-ranked atlas datasets that have to be stable
+        initial_sample_size : int
+            Number of cells sampled from each dataset in the first round
+        max_sample_size : int
+            Upper bound of the sample size
+        growth : int
+            Factor the sample size grows by
+        runs_per_round : int
+            Runs added per round to each ambiguous atlas dataset, at least 2 for the first variance estimate
+        max_runs : int
+            Runs of an atlas dataset at one sample size before the sample size grows
+        z : float
+            Width of the confidence intervals in standard errors
+        time_budget : Optional[float]
+            Seconds after which no new round is started
+
+        Returns
+        -------
+        Tuple[Dict[str, Dict], Dict]
+            Mapping from atlas dataset id to the metric values averaged over its runs, like :meth:`compute`, and a
+            report with the achieved sample size, whether the ranking is stable, and the number of runs, variance and
+            standard error of ``feature_name`` for each atlas dataset
+
+        """
+        if feature_name not in methods:
+            raise ValueError(f"Ranking feature {feature_name!r} is not one of the computed methods {methods}")
+        t_start = time.perf_counter()
+        seed = self.similarity_kwargs.get("init_random_state") or 0
+        sample_size = initial_sample_size
+        runs = {atlas_id: {method: [] for method in methods} for atlas_id in self.atlas_list}
+        ambiguous = list(self.atlas_list)
+        n_rounds = 0
+        while True:
+            n_rounds += 1
+            # Run i of an atlas dataset always uses seed + i, like the runs of get_similarity_matrix_A2B
+            new_runs = self.map("sampled_runs", [
+                (atlas_id, (methods, sample_size,
+                            list(range(seed + len(runs[atlas_id][feature_name]),
+                                       seed + len(runs[atlas_id][feature_name]) + runs_per_round))), {})
+                for atlas_id in ambiguous
+            ])
+            for atlas_id, atlas_runs in new_runs:
+                for method in methods:
+                    runs[atlas_id][method].extend(atlas_runs[method])
+
+            scores = {atlas_id: np.real(runs[atlas_id][feature_name]).astype(float) for atlas_id in self.atlas_list}
+            means = {atlas_id: values.mean() for atlas_id, values in scores.items()}
+            errors = {
+                atlas_id: values.std(ddof=1) / np.sqrt(len(values)) if len(values) > 1 else np.inf
+                for atlas_id, values in scores.items()
+            }
+            ambiguous = self.ambiguous_atlases(means, errors, top_k, z)
+            elapsed = time.perf_counter() - t_start
+            logger.info(f"Adaptive sampling round {n_rounds}: sample size {sample_size}, "
+                        f"{len(ambiguous)} ambiguous atlas datasets, {elapsed:.1f}s")
+            if not ambiguous or (time_budget is not None and elapsed >= time_budget):
+                break
+            if all(len(scores[atlas_id]) >= max_runs for atlas_id in ambiguous):
+                if sample_size >= max_sample_size:
+                    break
+                sample_size = min(sample_size * growth, max_sample_size)
+                runs = {atlas_id: {method: [] for method in methods} for atlas_id in self.atlas_list}
+                ambiguous = list(self.atlas_list)
+
+        results = {
+            atlas_id: {method: np.mean(atlas_runs[method]) for method in methods}
+            for atlas_id, atlas_runs in runs.items()
+        }
+        report = {
+            "sample_size": sample_size,
+            "stable": not ambiguous,
+            "rounds": n_rounds,
+            "elapsed": elapsed,
+            "atlases": {
+                atlas_id: {
+                    "n_runs": len(scores[atlas_id]),
+                    "mean": float(means[atlas_id]),
+                    "variance": float(scores[atlas_id].var(ddof=1)) if len(scores[atlas_id]) > 1 else None,
+                    "std_error": float(errors[atlas_id]) if len(scores[atlas_id]) > 1 else None,
+                }
+                for atlas_id in self.atlas_list
+            },
+        }
+        return results, report
+
+
+def _call_batch(batch: AtlasSimilarityBatch, method_name: str, atlas_id: str, *args, **kwargs):
+    """Entry point of :meth:`AtlasSimilarityBatch.map` tasks in pool workers."""
+    return getattr(batch, method_name)(atlas_id, *args, **kwargs)
+
+
 def extract_type_target_params(item_text):
     lines = item_text.strip().split('\n')
     item_dict = {}
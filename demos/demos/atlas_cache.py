@@ -0,0 +1,93 @@
+"""Memory-bounded LRU cache of loaded atlas datasets.
+
+Every similarity request of a tissue compares the query with the same atlas datasets, and loading one means reading
+and preprocessing its h5ad. :class:`AtlasCache` keeps loaded atlas datasets in memory, bounded by their total size in
+bytes rather than by their number since atlas datasets range from a few hundred to hundreds of thousands of cells.
+Each worker of :class:`demos.worker_pool.WorkerPool` holds one (see :func:`demos.worker_pool.resident_atlases`).
+
+"""
+import collections
+import threading
+from typing import Any, Dict, Hashable, List
+
+import anndata
+import scipy.sparse
+
+
+def anndata_nbytes(adata: anndata.AnnData) -> int:
+    """Approximate memory held by ``X``, ``obs`` and ``var`` of an AnnData."""
+    X = adata.X
+    if scipy.sparse.issparse(X):
+        nbytes = sum(getattr(X, name).nbytes for name in ("data", "indices", "indptr") if hasattr(X, name))
+    else:
+        nbytes = getattr(X, "nbytes", 0)
+    return int(nbytes + adata.obs.memory_usage(index=True, deep=True).sum()
+               + adata.var.memory_usage(index=True, deep=True).sum())
+
+
+class AtlasCache:
+    """Least recently used atlas datasets, bounded by their total size.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Total size of the cached atlas datasets above which the least recently used ones are evicted. A single atlas
+        dataset larger than this is not cached
+
+    """
+
+    def __init__(self, max_bytes: int = 4 * 1024**3):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key: Hashable, adata: anndata.AnnData):
+        nbytes = anndata_nbytes(adata)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (adata, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._items)
+
+    def clear(self):
+        """Drop every cached atlas dataset, counted as evictions."""
+        with self._lock:
+            self.evictions += len(self._items)
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "entries": len(self._items),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,137 @@
+"""In-memory index of the atlas configuration workbook.
+
+``Cell Type Annotation Atlas.xlsx`` has one sheet per tissue and one row per dataset, with the best preprocessing
+configuration (``<method>_step2_best_yaml``) and accuracy (``<method>_best_res``) of every annotation method. Parsing
+the workbook takes seconds, so :class:`AtlasConfigRepository` parses it once, indexes the rows by
+``(tissue, dataset_id)`` and only parses it again when the file's mtime changes.
+
+The workbook can be pre-converted into a Parquet snapshot (one file per sheet, requires ``pyarrow``), which is read
+instead of the workbook as long as it was built from the current workbook::
+
+    python -m demos.atlas_config
+
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from demos import logger
+
+DEFAULT_ATLAS_CONF_PATH = "demos/Cell Type Annotation Atlas.xlsx"
+
+
+class AtlasConfigRepository:
+    """Atlas configuration rows indexed by ``(tissue, dataset_id)``.
+
+    Parameters
+    ----------
+    path : str
+        Path of the configuration workbook
+    snapshot_dir : Optional[str]
+        Directory of the Parquet snapshot, ``<path without extension>_snapshot`` by default
+
+    """
+
+    def __init__(self, path: str = DEFAULT_ATLAS_CONF_PATH, snapshot_dir: Optional[str] = None):
+        self.path = path
+        self.snapshot_dir = f"{os.path.splitext(path)[0]}_snapshot" if snapshot_dir is None else snapshot_dir
+        self._lock = threading.Lock()
+        self._mtime_ns = None
+        self._sheets: Dict[str, pd.DataFrame] = {}
+        self._index: Dict[Tuple[str, str], int] = {}
+
+    def _read_snapshot(self, mtime_ns: int) -> Optional[Dict[str, pd.DataFrame]]:
+        meta_path = os.path.join(self.snapshot_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("source_mtime_ns") != mtime_ns:
+            logger.info(f"Atlas configuration snapshot {self.snapshot_dir} is older than {self.path}")
+            return None
+        try:
+            return {
+                sheet: pd.read_parquet(os.path.join(self.snapshot_dir, f"{sheet}.parquet"))
+                for sheet in meta["sheets"]
+            }
+        except ImportError as e:
+            logger.warning(f"Cannot read atlas configuration snapshot, falling back to the workbook: {e}")
+            return None
+
+    def _refresh(self):
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        if mtime_ns == self._mtime_ns:
+            return
+        with self._lock:
+            if mtime_ns == self._mtime_ns:
+                return
+            sheets = self._read_snapshot(mtime_ns)
+            if sheets is None:
+                sheets = pd.read_excel(self.path, sheet_name=None)
+            index = {}
+            for tissue, sheet in sheets.items():
+                if "dataset_id" not in sheet.columns:  # notes sheet
+                    continue
+                for position, dataset_id in enumerate(sheet["dataset_id"]):
+                    # Like conf_data.loc[conf_data["dataset_id"] == dataset_id].iloc[0], the first row wins
+                    index.setdefault((tissue, dataset_id), position)
+            self._sheets, self._index, self._mtime_ns = sheets, index, mtime_ns
+            logger.info(f"Loaded atlas configuration of {len(sheets)} tissues from {self.path}")
+
+    def tissues(self) -> List[str]:
+        """Tissues with atlas datasets, i.e. the sheets having a ``dataset_id`` column."""
+        self._refresh()
+        return [tissue for tissue, conf_data in self._sheets.items() if "dataset_id" in conf_data]
+
+    def sheet(self, tissue: str) -> pd.DataFrame:
+        """Configuration sheet of ``tissue``, as ``pd.read_excel(path, sheet_name=tissue)`` returns it."""
+        self._refresh()
+        return self._sheets[tissue]
+
+    def atlas_datasets(self, tissue: str) -> List[str]:
+        """Ids of the atlas datasets of ``tissue``, i.e. the datasets that were not queried."""
+        conf_data = self.sheet(tissue)
+        return list(conf_data[conf_data["queryed"] == False]["dataset_id"])
+
+    def row(self, tissue: str, dataset_id: str) -> pd.Series:
+        self._refresh()
+        return self._sheets[tissue].iloc[self._index[(tissue, dataset_id)]]
+
+    def get(self, tissue: str, dataset_id: str, column: str):
+        return self.row(tissue, dataset_id)[column]
+
+    def best_yaml(self, tissue: str, dataset_id: str, method: str):
+        """``<method>_step2_best_yaml`` of a dataset, NaN if the method has no valid configuration."""
+        return self.get(tissue, dataset_id, f"{method}_step2_best_yaml")
+
+    def best_res(self, tissue: str, dataset_id: str, method: str):
+        return self.get(tissue, dataset_id, f"{method}_best_res")
+
+    def write_snapshot(self):
+        """Convert the workbook into the Parquet snapshot read by later loads."""
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        sheets = pd.read_excel(self.path, sheet_name=None)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        for sheet, conf_data in sheets.items():
+            conf_data.to_parquet(os.path.join(self.snapshot_dir, f"{sheet}.parquet"), index=False)
+        with open(os.path.join(self.snapshot_dir, "meta.json"), "w") as f:
+            json.dump({"source_mtime_ns": mtime_ns, "sheets": list(sheets)}, f, indent=2)
+        logger.info(f"Wrote atlas configuration snapshot of {len(sheets)} tissues to {self.snapshot_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the atlas configuration workbook into a Parquet snapshot")
+    parser.add_argument("--conf-path", default=DEFAULT_ATLAS_CONF_PATH)
+    parser.add_argument("--snapshot-dir")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    AtlasConfigRepository(args.conf_path, snapshot_dir=args.snapshot_dir).write_snapshot()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""On-disk store of per-atlas precomputed data.
+
+Atlas datasets do not change between requests, yet every similarity request used to read the full atlas h5ad and
+redo the gene filtering and highly variable gene selection of :func:`select_highly_variable_genes`. The store keeps one
+entry per atlas dataset under ``<data_dir>/atlas_stats/<tissue>/<dataset_id>``:
+
+* ``hvg.h5ad``: the raw counts restricted to the highly variable genes, with the ``seurat_v3`` ranks and variances in
+  ``var`` and the ``obs`` columns read by :meth:`AnnDataSimilarity.get_dataset_meta_sim`
+* ``meta.json``: store version, ``n_top_genes`` and the md5 hash, size and mtime of the source h5ad
+
+An entry is rebuilt when the store version or ``n_top_genes`` differ, or when the source file's hash changed. The hash
+is only recomputed when the size or mtime of the source file moved. Builds of an entry are serialized across processes
+by an ``fcntl`` lock on ``<entry>/.lock``; a process that waited for the lock loads the entry the other one built.
+
+Build the store offline from the ``demos`` directory, e.g.::
+
+    python -m demos.atlas_store --tissue blood
+
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+import anndata
+import scanpy as sc
+
+from demos import logger
+from demos.atlas_config import DEFAULT_ATLAS_CONF_PATH, AtlasConfigRepository
+from demos.anndata_similarity import get_anndata, get_anndata_path, select_highly_variable_genes
+
+STORE_VERSION = 1
+STORED_OBS_COLUMNS = ("assay", "tissue", "nnz", "n_measured_vars", "n_counts")
+STORED_VAR_COLUMNS = ("highly_variable_rank", "variances_norm", "means", "n_counts")
+
+
+def file_md5(path: str, chunk_size: int = 16 * 1024**2) -> str:
+    """md5 hex digest of a file, read in chunks."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class AtlasStatsStore:
+    """Versioned store of HVG-restricted atlas datasets.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory holding the atlas h5ad files, see :func:`get_anndata`
+    root : Optional[str]
+        Store directory, ``<data_dir>/atlas_stats`` by default
+    n_top_genes : int
+        Number of highly variable genes selected per atlas dataset
+    species : str
+        Species of the atlas datasets
+
+    """
+
+    def __init__(self, data_dir: str = "demos/temp_data", root: Optional[str] = None, n_top_genes: int = 3000,
+                 species: str = "human"):
+        self.data_dir = data_dir
+        self.root = os.path.join(data_dir, "atlas_stats") if root is None else root
+        self.n_top_genes = n_top_genes
+        self.species = species
+
+    def entry_dir(self, tissue: str, atlas_id: str) -> str:
+        return os.path.join(self.root, tissue.lower(), atlas_id)
+
+    def source_path(self, tissue: str, atlas_id: str) -> str:
+        return get_anndata_path(atlas_id, tissue=tissue.capitalize(), species=self.species, data_dir=self.data_dir)
+
+    def source_manifest(self, tissue: str, atlas_list: List[str]) -> dict:
+        """Size and mtime of the source file of each atlas dataset, ``None`` for missing or unknown datasets.
+
+        Cheap to compute on every request; results derived from the atlas datasets key on it so that they are
+        invalidated when a source file is replaced.
+
+        """
+        manifest = {}
+        for atlas_id in atlas_list:
+            try:
+                stat = os.stat(self.source_path(tissue, atlas_id))
+                manifest[atlas_id] = [stat.st_size, stat.st_mtime_ns]
+            except (OSError, ValueError):
+                manifest[atlas_id] = None
+        return manifest
+
+    def _read_meta(self, tissue: str, atlas_id: str) -> Optional[dict]:
+        meta_path = os.path.join(self.entry_dir(tissue, atlas_id), "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _tmp_path(path: str) -> str:
+        # Unique per writer, so that concurrent writers never truncate or replace each other's file
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    @contextlib.contextmanager
+    def _locked(self, tissue: str, atlas_id: str):
+        """Hold the build lock of an entry, shared by all processes using the store."""
+        entry_dir = self.entry_dir(tissue, atlas_id)
+        os.makedirs(entry_dir, exist_ok=True)
+        with open(os.path.join(entry_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_meta(self, tissue: str, atlas_id: str, meta: dict):
+        meta_path = os.path.join(self.entry_dir(tissue, atlas_id), "meta.json")
+        tmp_path = self._tmp_path(meta_path)
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, meta_path)
+
+    def is_fresh(self, tissue: str, atlas_id: str) -> bool:
+        """Whether the entry exists and was built by this store version from the current source file."""
+        meta = self._read_meta(tissue, atlas_id)
+        if meta is None or meta.get("version") != STORE_VERSION or meta.get("n_top_genes") != self.n_top_genes:
+            return False
+        if not os.path.exists(os.path.join(self.entry_dir(tissue, atlas_id), "hvg.h5ad")):
+            return False
+        source_path = self.source_path(tissue, atlas_id)
+        stat = os.stat(source_path)
+        if stat.st_size == meta["source_size"] and stat.st_mtime_ns == meta["source_mtime_ns"]:
+            return True
+        # The file was touched or replaced: only its content decides
+        if file_md5(source_path) != meta["source_md5"]:
+            logger.info(f"Atlas {tissue}/{atlas_id} changed since its statistics were stored")
+            return False
+        meta.update(source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+        self._write_meta(tissue, atlas_id, meta)
+        return True
+
+    def build(self, tissue: str, atlas_id: str) -> anndata.AnnData:
+        """Load the source atlas dataset, select its highly variable genes and store the result.
+
+        Callers sharing the store with other processes hold :meth:`_locked`, as :meth:`load` does.
+
+        """
+        source_path = self.source_path(tissue, atlas_id)
+        stat = os.stat(source_path)
+        source_md5 = file_md5(source_path)
+        adata = get_anndata(train_dataset=[f"{atlas_id}"], data_dir=self.data_dir, tissue=tissue.capitalize(),
+                            species=self.species)
+        adata = select_highly_variable_genes(adata, n_top_genes=self.n_top_genes)
+        entry = anndata.AnnData(
+            X=adata.X, obs=adata.obs[[col for col in STORED_OBS_COLUMNS if col in adata.obs.columns]].copy(),
+            var=adata.var[[col for col in STORED_VAR_COLUMNS if col in adata.var.columns]].copy())
+
+        entry_dir = self.entry_dir(tissue, atlas_id)
+        os.makedirs(entry_dir, exist_ok=True)
+        tmp_path = self._tmp_path(os.path.join(entry_dir, "hvg.h5ad"))
+        entry.write_h5ad(tmp_path)
+        os.replace(tmp_path, os.path.join(entry_dir, "hvg.h5ad"))
+        self._write_meta(
+            tissue, atlas_id, {
+                "version": STORE_VERSION,
+                "n_top_genes": self.n_top_genes,
+                "source_path": source_path,
+                "source_md5": source_md5,
+                "source_size": stat.st_size,
+                "source_mtime_ns": stat.st_mtime_ns,
+                "n_obs": entry.n_obs,
+                "n_vars": entry.n_vars,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            })
+        logger.info(f"Stored {entry.n_vars} highly variable genes of atlas {tissue}/{atlas_id}")
+        return entry
+
+    def load(self, tissue: str, atlas_id: str) -> anndata.AnnData:
+        """HVG-restricted atlas dataset, rebuilt first if the entry is missing or stale."""
+        if not self.is_fresh(tissue, atlas_id):
+            with self._locked(tissue, atlas_id):
+                # Another process may have built the entry while this one waited for the lock
+                if not self.is_fresh(tissue, atlas_id):
+                    return self.build(tissue, atlas_id)
+        return sc.read_h5ad(os.path.join(self.entry_dir(tissue, atlas_id), "hvg.h5ad"))
+
+    def build_tissue(self, tissue: str, atlas_list: List[str], force: bool = False):
+        """Build every stale entry of ``atlas_list``, or all of them with ``force``."""
+        for atlas_id in atlas_list:
+            with self._locked(tissue, atlas_id):
+                if force or not self.is_fresh(tissue, atlas_id):
+                    self.build(tissue, atlas_id)
+                else:
+                    logger.info(f"Atlas {tissue}/{atlas_id} is up to date")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the per-atlas statistics store of a tissue")
+    parser.add_argument("--tissue", required=True)
+    parser.add_argument("--data-dir", default="demos/temp_data")
+    parser.add_argument("--conf-path", default=DEFAULT_ATLAS_CONF_PATH)
+    parser.add_argument("--n-top-genes", type=int, default=3000)
+    parser.add_argument("--force", action="store_true", help="Rebuild entries that are up to date")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    atlas_datasets = AtlasConfigRepository(args.conf_path).atlas_datasets(args.tissue)
+    store = AtlasStatsStore(data_dir=args.data_dir, n_top_genes=args.n_top_genes)
+    store.build_tissue(args.tissue, atlas_datasets, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""Micro benchmarks for the similarity kernels.
+
+Run from the ``demos`` directory, e.g.::
+
+    python -m demos.benchmark_similarity js --n-cells 200 --n-genes 2000
+
+Each benchmark compares a kernel against the reference implementation it replaces, checks that both agree and
+logs the timings.
+
+"""
+import argparse
+import logging
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist, jensenshannon
+
+from demos import logger
+from demos.anndata_similarity import AtlasSimilarityBatch, select_highly_variable_genes
+from demos.similarity_kernels import js_divergence_matrix, pairwise_mean
+from demos.worker_pool import WorkerPool, rss_bytes
+
+
+def synthetic_counts(n_cells: int, n_genes: int, density: float = 0.1, seed: int = 0,
+                     block_size: int = 10_000) -> sp.csr_matrix:
+    """Random sparse count matrix roughly shaped like a scRNA-seq expression matrix."""
+    rng = np.random.default_rng(seed)
+    # Blocks of cells keep the peak memory of sp.random low for large matrices
+    X = sp.vstack([
+        sp.random(min(block_size, n_cells - start), n_genes, density=density, format="csr", random_state=rng,
+                  data_rvs=lambda k: rng.negative_binomial(2, 0.3, size=k) + 1.0)
+        for start in range(0, n_cells, block_size)
+    ], format="csr")
+    return X.astype(np.float64)
+
+
+def _timed(func, *args, **kwargs):
+    t_start = time.perf_counter()
+    res = func(*args, **kwargs)
+    return res, time.perf_counter() - t_start
+
+
+def _traced(func, *args, **kwargs):
+    """Like :func:`_timed`, additionally returning the peak traced memory in MB."""
+    tracemalloc.start()
+    try:
+        res, elapsed = _timed(func, *args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return res, elapsed, peak / 1024**2
+
+
+def _js_reference(P: np.ndarray, Q: np.ndarray) -> np.ndarray:
+    # Per-pair scipy loop of the former AnnDataSimilarity.js_divergence_sampled. The former code used np.repeat,
+    # which interleaves the entries of P[i] instead of stacking copies of it; np.tile pairs the rows as intended.
+    jsd_vectorized = np.vectorize(jensenshannon, signature='(n),(n)->()')
+    out = np.zeros((P.shape[0], Q.shape[0]))
+    for i in range(P.shape[0]):
+        out[i, :] = jsd_vectorized(np.tile(P[i, :], (Q.shape[0], 1)), Q)
+    return out
+
+
+def bench_js(n_cells: int, n_genes: int, max_tile_mb: int):
+    X = synthetic_counts(n_cells, n_genes, seed=0)
+    Y = synthetic_counts(n_cells, n_genes, seed=1)
+    expected, t_ref = _timed(_js_reference, X.toarray(), Y.toarray())
+    actual, t_new = _timed(js_divergence_matrix, X, Y, max_tile_bytes=max_tile_mb * 1024**2)
+    max_err = np.nanmax(np.abs(expected - actual))
+    logger.info(f"JS divergence {n_cells}x{n_cells} cells, {n_genes} genes: reference {t_ref:.3f}s, "
+                f"blocked {t_new:.3f}s ({t_ref / t_new:.1f}x), max abs error {max_err:.2e}")
+    np.testing.assert_allclose(actual, expected, rtol=1e-10, atol=1e-12, equal_nan=True)
+
+
+def _mmd_energy_dense(X: np.ndarray, Y: np.ndarray):
+    # Former compute_mmd / energy_distance_metric: three dense n x n matrices per metric
+    K_X = np.exp(-cdist(X, X, 'sqeuclidean'))
+    K_Y = np.exp(-cdist(Y, Y, 'sqeuclidean'))
+    K_XY = np.exp(-cdist(X, Y, 'sqeuclidean'))
+    m, n = X.shape[0], Y.shape[0]
+    mmd2 = (K_X.sum() - np.trace(K_X)) / (m * (m - 1)) + (K_Y.sum() - np.trace(K_Y)) / (n * (n - 1)) \
+        - 2 * K_XY.mean()
+    energy = 2 * cdist(X, Y).mean() - cdist(X, X).mean() - cdist(Y, Y).mean()
+    return mmd2, energy
+
+
+def _mmd_energy_tiled(X, Y, max_tile_bytes: int):
+    def rbf(d):
+        return np.exp(-d)
+
+    mmd2 = pairwise_mean(X, metric='sqeuclidean', func=rbf, exclude_diagonal=True, max_tile_bytes=max_tile_bytes) \
+        + pairwise_mean(Y, metric='sqeuclidean', func=rbf, exclude_diagonal=True, max_tile_bytes=max_tile_bytes) \
+        - 2 * pairwise_mean(X, Y, metric='sqeuclidean', func=rbf, max_tile_bytes=max_tile_bytes)
+    energy = 2 * pairwise_mean(X, Y, max_tile_bytes=max_tile_bytes) - pairwise_mean(
+        X, max_tile_bytes=max_tile_bytes) - pairwise_mean(Y, max_tile_bytes=max_tile_bytes)
+    return mmd2, energy
+
+
+def bench_mmd(n_cells: int, n_genes: int, max_tile_mb: int):
+    X = synthetic_counts(n_cells, n_genes, seed=0)
+    Y = synthetic_counts(n_cells, n_genes, seed=1)
+    X = (X.multiply(1 / X.sum(axis=1))).tocsr()
+    Y = (Y.multiply(1 / Y.sum(axis=1))).tocsr()
+    expected, t_ref, mem_ref = _traced(_mmd_energy_dense, X.toarray(), Y.toarray())
+    actual, t_new, mem_new = _traced(_mmd_energy_tiled, X, Y, max_tile_mb * 1024**2)
+    logger.info(f"MMD + energy {n_cells} cells, {n_genes} genes: dense {t_ref:.3f}s / {mem_ref:.1f} MB peak, "
+                f"tiled {t_new:.3f}s / {mem_new:.1f} MB peak")
+    logger.info(f"MMD^2 dense {expected[0]:.12g} tiled {actual[0]:.12g}; "
+                f"energy dense {expected[1]:.12g} tiled {actual[1]:.12g}")
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-10)
+
+
+def synthetic_anndata(n_cells: int, n_genes: int, seed: int = 0, density: float = 0.2):
+    """Synthetic AnnData with the obs columns ``get_dataset_meta_sim`` expects."""
+    import anndata as ad
+
+    X = synthetic_counts(n_cells, n_genes, density=density, seed=seed).astype(np.float32)
+    adata = ad.AnnData(X)
+    adata.var_names = [f"gene_{i}" for i in range(n_genes)]
+    adata.obs["assay"] = "10x 3' v3"
+    adata.obs["tissue"] = "blood"
+    adata.obs["nnz"] = X.getnnz(axis=1)
+    adata.obs["n_measured_vars"] = n_genes
+    return adata
+
+
+DEFAULT_FEATURES = ["wasserstein", "Hausdorff", "chamfer", "energy", "sinkhorn2", "bures", "spectral", "mmd"]
+
+
+def bench_metrics(n_cells: int, n_genes: int):
+    from demos.anndata_similarity import AnnDataSimilarity
+
+    calculator = AnnDataSimilarity(synthetic_anndata(n_cells, n_genes, seed=0),
+                                   synthetic_anndata(n_cells, n_genes, seed=1), init_random_state=42, n_runs=1)
+    shared, t_shared = _timed(calculator.compute_similarity, random_state=42, methods=DEFAULT_FEATURES)
+    separate, t_separate = {}, 0.0
+    for method in DEFAULT_FEATURES:
+        # One metric per run rebuilds every intermediate, like independent metric calls used to
+        res, elapsed = _timed(calculator.compute_similarity, random_state=42, methods=[method])
+        separate.update(res)
+        t_separate += elapsed
+    logger.info(f"{len(DEFAULT_FEATURES)} metrics, {n_cells} cells, {n_genes} genes: separate runs {t_separate:.3f}s, "
+                f"shared intermediates {t_shared:.3f}s ({t_separate / t_shared:.1f}x)")
+    for method in DEFAULT_FEATURES:
+        np.testing.assert_allclose(np.real(shared[method]), np.real(separate[method]), rtol=1e-9)
+
+
+def bench_sparse(n_query: int, n_atlas: int, n_genes: int, density: float, methods=DEFAULT_FEATURES):
+    """Peak memory of each metric alone in the dense and sparse modes.
+
+    Metrics are measured one at a time: run together, the peak is that of the most expensive metric (bures) and
+    hides the savings of the others.
+
+    """
+    from demos.anndata_similarity import AnnDataSimilarity
+
+    query = synthetic_anndata(n_query, n_genes, seed=0, density=density)
+    atlas = synthetic_anndata(n_atlas, n_genes, seed=1, density=density)
+    for method in methods:
+        results, report = {}, []
+        for sparse in (False, True):
+            calculator = AnnDataSimilarity(query, atlas, init_random_state=42, n_runs=1, sparse=sparse)
+            res, elapsed, peak = _traced(calculator.compute_similarity, random_state=42, methods=[method])
+            results[sparse] = res[method]
+            report.append(f"{'sparse' if sparse else 'dense'} {elapsed:.2f}s {peak:.1f} MB peak")
+        logger.info(f"{method}, {n_query} x {n_atlas} cells, {len(calculator.common_genes)} common genes: "
+                    + ", ".join(report))
+        np.testing.assert_allclose(np.real(results[True]), np.real(results[False]), rtol=1e-7)
+
+
+def bench_lowrank(n_query: int, n_atlas: int, n_genes: int, ranks):
+    from demos.anndata_similarity import AnnDataSimilarity
+
+    query = synthetic_anndata(n_query, n_genes, seed=0)
+    atlas = synthetic_anndata(n_atlas, n_genes, seed=1)
+    methods = ["bures", "spectral"]
+    exact, t_exact = _timed(
+        AnnDataSimilarity(query, atlas, init_random_state=42, n_runs=1).compute_similarity, random_state=42,
+        methods=methods)
+    logger.info(f"exact covariances, {n_query} x {n_atlas} cells, {n_genes} genes: {t_exact:.3f}s, "
+                + ", ".join(f"{method} {exact[method]:.6g}" for method in methods))
+    for rank in ranks:
+        calculator = AnnDataSimilarity(query, atlas, init_random_state=42, n_runs=1, covariance_rank=rank)
+        res, elapsed = _timed(calculator.compute_similarity, random_state=42, methods=methods)
+        assert all(np.isrealobj(res[method]) for method in methods)
+        logger.info(f"rank {rank}: {elapsed:.3f}s ({t_exact / elapsed:.1f}x), " + ", ".join(
+            f"{method} {res[method]:.6g} (abs error {abs(res[method] - np.real(exact[method])):.2e})"
+            for method in methods))
+
+
+def bench_sliced(n_cells: int, n_genes: int, n_atlases: int, n_projections: int, tissue=None, query_path=None):
+    """Rank correlation of ``wasserstein_sliced`` with the exact ``wasserstein`` across a set of atlases.
+
+    With ``tissue`` and ``query_path`` the query h5ad is scored against the atlas datasets of that tissue, otherwise
+    against synthetic atlases with an increasing fraction of cells from a shifted population.
+
+    """
+    from scipy.stats import pearsonr, spearmanr
+
+    from demos.anndata_similarity import AnnDataSimilarity
+
+    methods = ["wasserstein", "wasserstein_sliced"]
+    if tissue is not None:
+        import anndata as ad
+
+        from demos.atlas_config import AtlasConfigRepository
+        from demos.atlas_store import AtlasStatsStore
+
+        atlas_datasets = AtlasConfigRepository().atlas_datasets(tissue)
+        batch = AtlasSimilarityBatch(ad.read_h5ad(query_path), atlas_datasets, tissue=tissue,
+                                     data_dir="demos/temp_data", store=AtlasStatsStore("demos/temp_data"),
+                                     sample_size=10, init_random_state=42, n_runs=1, n_projections=n_projections)
+        results = batch.compute(methods=methods)
+        timings = {}
+    else:
+        query = synthetic_anndata(n_cells, n_genes, seed=0)
+        results, timings = {}, {method: 0.0 for method in methods}
+        for i, shifted_fraction in enumerate(np.linspace(0, 1, n_atlases)):
+            atlas = synthetic_anndata(n_cells, n_genes, seed=i + 1)
+            # Upregulate a tenth of the genes in the first cells, so the atlas drifts away from the query
+            n_shifted = int(shifted_fraction * n_cells)
+            fold = np.where(np.arange(n_genes) < n_genes // 10, 8.0, 1.0).astype(np.float32)
+            atlas.X = sp.vstack([atlas.X[:n_shifted] @ sp.diags(fold), atlas.X[n_shifted:]], format="csr")
+            calculator = AnnDataSimilarity(query, atlas, init_random_state=42, n_runs=1, n_projections=n_projections)
+            results[f"atlas_{i}"] = {}
+            for method in methods:
+                res, elapsed = _timed(calculator.compute_similarity, random_state=42, methods=[method])
+                results[f"atlas_{i}"][method] = res[method]
+                timings[method] += elapsed
+    exact = [results[atlas]["wasserstein"] for atlas in results]
+    sliced = [results[atlas]["wasserstein_sliced"] for atlas in results]
+    logger.info(f"{len(results)} atlases, {n_projections} projections: spearman {spearmanr(exact, sliced)[0]:.4f}, "
+                f"pearson {pearsonr(exact, sliced)[0]:.4f}"
+                + "".join(f", {method} {elapsed:.3f}s" for method, elapsed in timings.items()))
+
+
+class SyntheticAtlasBatch(AtlasSimilarityBatch):
+    """Batch scoring synthetic atlas datasets ``atlas_<seed>``, importable by pool workers."""
+    n_atlas_cells = 2000
+
+    def load_atlas(self, atlas_id: str):
+        atlas = synthetic_anndata(self.n_atlas_cells, self.query.n_vars, seed=int(atlas_id.split("_")[1]))
+        return select_highly_variable_genes(atlas, n_top_genes=self.n_top_genes)
+
+
+def _peak_rss(func, *args, interval: float = 0.02, **kwargs):
+    """Result of ``func`` and the peak resident set size of this process while it ran, in MB."""
+    peak, done = [rss_bytes()], threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        res = func(*args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+    return res, max(peak[0], rss_bytes()) / 1024**2
+
+
+def bench_handoff(n_cells: int, n_genes: int, n_atlases: int, n_workers: int, density: float):
+    """Peak memory of pickling the query into every pool task vs handing it over through shared buffers.
+
+    The pairs are scored in the sparse execution mode, the dense one holds a dense copy of the whole query per worker.
+
+    """
+    query = synthetic_anndata(n_cells, n_genes, seed=0, density=density)
+    atlas_list = [f"atlas_{i + 1}" for i in range(n_atlases)]
+    # A metric whose own memory is negligible next to the preprocessing of each pair
+    methods = ["common_genes_num"]
+    results = {}
+    for share_query in (False, True):
+        pool = WorkerPool(n_workers)
+        pool.start()
+        try:
+            with SyntheticAtlasBatch(query, atlas_list, tissue="blood", n_top_genes=n_genes, pool=pool,
+                                     share_query=share_query, sparse=True, sample_size=10, init_random_state=42,
+                                     n_runs=1) as batch:
+                query_mb = (batch.query.X.data.nbytes + batch.query.X.indices.nbytes
+                            + batch.query.X.indptr.nbytes) / 1024**2
+                (res, elapsed), parent_peak = _peak_rss(_timed, batch.compute, methods)
+            stats = pool.stats()
+        finally:
+            pool.shutdown()
+        results[share_query] = res
+        worker_peaks = [worker["max_rss"] / 1024**2 for worker in stats["workers"] if worker["max_rss"]]
+        logger.info(f"{'shared buffers' if share_query else 'pickled query'}, {n_cells} cells x {n_genes} genes "
+                    f"({query_mb:.0f} MB), {n_atlases} atlases, {n_workers} workers: {elapsed:.1f}s, "
+                    f"service peak RSS {parent_peak:.0f} MB, worker peak RSS "
+                    + ", ".join(f"{peak:.0f}" for peak in worker_peaks) + " MB")
+    for atlas_id in atlas_list:
+        for method in methods:
+            np.testing.assert_allclose(np.real(results[True][atlas_id][method]),
+                                       np.real(results[False][atlas_id][method]), rtol=1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    js_parser = subparsers.add_parser("js", help="Blocked Jensen-Shannon kernel vs per-pair scipy loop")
+    js_parser.add_argument("--n-cells", type=int, default=200)
+    js_parser.add_argument("--n-genes", type=int, default=2000)
+    js_parser.add_argument("--max-tile-mb", type=int, default=64)
+
+    mmd_parser = subparsers.add_parser("mmd", help="Tiled MMD / energy distance vs dense cdist matrices")
+    mmd_parser.add_argument("--n-cells", type=int, default=3000)
+    mmd_parser.add_argument("--n-genes", type=int, default=2000)
+    mmd_parser.add_argument("--max-tile-mb", type=int, default=64)
+
+    metrics_parser = subparsers.add_parser("metrics", help="Default feature set with and without shared intermediates")
+    metrics_parser.add_argument("--n-cells", type=int, default=1000)
+    metrics_parser.add_argument("--n-genes", type=int, default=1000)
+
+    sparse_parser = subparsers.add_parser("sparse", help="Peak memory of the dense and sparse execution modes")
+    sparse_parser.add_argument("--n-query", type=int, default=1500)
+    sparse_parser.add_argument("--n-atlas", type=int, default=2500)
+    sparse_parser.add_argument("--n-genes", type=int, default=3000)
+    sparse_parser.add_argument("--density", type=float, default=0.05)
+    sparse_parser.add_argument("--methods", nargs="+", default=DEFAULT_FEATURES)
+
+    lowrank_parser = subparsers.add_parser("lowrank", help="Bures / spectral on shared PCA bases vs exact covariances")
+    lowrank_parser.add_argument("--n-query", type=int, default=1000)
+    lowrank_parser.add_argument("--n-atlas", type=int, default=1500)
+    lowrank_parser.add_argument("--n-genes", type=int, default=3000)
+    lowrank_parser.add_argument("--ranks", type=int, nargs="+", default=[10, 50, 100, 200])
+
+    sliced_parser = subparsers.add_parser("sliced", help="Rank correlation of sliced and exact Wasserstein")
+    sliced_parser.add_argument("--n-cells", type=int, default=500)
+    sliced_parser.add_argument("--n-genes", type=int, default=2000)
+    sliced_parser.add_argument("--n-atlases", type=int, default=12)
+    sliced_parser.add_argument("--n-projections", type=int, default=200)
+    sliced_parser.add_argument("--tissue", help="Score the atlas datasets of this tissue instead of synthetic ones")
+    sliced_parser.add_argument("--query", help="Query h5ad file, required with --tissue and only used with it")
+
+    handoff_parser = subparsers.add_parser("handoff", help="Peak RSS of pickled and shared query handoff to the pool")
+    handoff_parser.add_argument("--n-cells", type=int, default=100_000)
+    handoff_parser.add_argument("--n-genes", type=int, default=3000)
+    handoff_parser.add_argument("--n-atlases", type=int, default=4)
+    handoff_parser.add_argument("--n-workers", type=int, default=2)
+    handoff_parser.add_argument("--density", type=float, default=0.05)
+
+    args = parser.parse_args()
+    if args.benchmark == "sliced" and (args.tissue is None) != (args.query is None):
+        parser.error("sliced: --tissue and --query must be given together")
+    logging.basicConfig(level=logging.INFO)
+    if args.benchmark == "js":
+        bench_js(args.n_cells, args.n_genes, args.max_tile_mb)
+    elif args.benchmark == "mmd":
+        bench_mmd(args.n_cells, args.n_genes, args.max_tile_mb)
+    elif args.benchmark == "metrics":
+        bench_metrics(args.n_cells, args.n_genes)
+    elif args.benchmark == "sparse":
+        bench_sparse(args.n_query, args.n_atlas, args.n_genes, args.density, args.methods)
+    elif args.benchmark == "lowrank":
+        bench_lowrank(args.n_query, args.n_atlas, args.n_genes, args.ranks)
+    elif args.benchmark == "sliced":
+        bench_sliced(args.n_cells, args.n_genes, args.n_atlases, args.n_projections, args.tissue, args.query)
+    elif args.benchmark == "handoff":
+        bench_handoff(args.n_cells, args.n_genes, args.n_atlases, args.n_workers, args.density)
+
+
+if __name__ == "__main__":
+    main()
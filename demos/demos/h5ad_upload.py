@@ -0,0 +1,357 @@
+"""Validation of uploaded h5ad files before they are loaded.
+
+Uploads are streamed to disk in chunks by :class:`H5adUploadWriter`, which hashes and counts the bytes on the fly and
+rejects the upload as soon as it exceeds the size limit or its first bytes are not an HDF5 signature. Uploads
+compressed with gzip or zstd are decompressed on the fly (:func:`decoded_chunks`), the size limit then applies to the
+decompressed bytes.
+:func:`check_h5ad_header` then reads the shape of ``X`` from the HDF5 metadata only, so that files whose matrix is
+too large or missing are rejected before ``sc.read_h5ad`` loads anything.
+
+Callers sharing a volume with the service can pass files by reference instead of uploading them: either a path under
+one of the shared roots (:func:`resolve_shared_path`), or the content hash of a file uploaded before and kept by
+:class:`UploadStore`. When the service has neither, it raises :class:`UploadRequiredError` and the caller falls back
+to uploading the bytes. The hash of a shared file is always computed by the service (:func:`shared_file_sha256`),
+never taken from the caller, since results are cached under it.
+
+"""
+import collections
+import gzip
+import hashlib
+import os
+import re
+import threading
+import uuid
+import zlib
+from typing import BinaryIO, Dict, Iterator, Optional, Sequence, Tuple
+
+import h5py
+
+from demos import logger
+from demos.utils import try_import
+
+#: Content encodings of uploaded files, zstd requires the zstandard package
+UPLOAD_ENCODINGS = ("identity", "gzip", "zstd")
+
+# HDF5 files start with this signature, at offset 0 or after a user block of 512, 1024, 2048, ... bytes
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+
+class UploadRejectedError(Exception):
+    """The uploaded file cannot be analyzed.
+
+    Parameters
+    ----------
+    message : str
+        Reason of the rejection
+    status_code : int
+        413 if the file is too large, 400 if it is malformed
+
+    """
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadRequiredError(Exception):
+    """A file passed by reference is unknown to the service and has to be uploaded."""
+
+
+def has_hdf5_signature(head: bytes) -> bool:
+    """Whether ``head``, the first bytes of a file, contains the HDF5 signature at one of its allowed offsets."""
+    offset = 0
+    while offset + len(HDF5_SIGNATURE) <= len(head):
+        if head[offset:offset + len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+            return True
+        offset = 512 if offset == 0 else offset * 2
+    return False
+
+
+class H5adUploadWriter:
+    """Write an upload chunk by chunk while computing its SHA-256 and size.
+
+    Parameters
+    ----------
+    buffer : BinaryIO
+        File the chunks are written to
+    max_bytes : Optional[int]
+        Size above which the upload is rejected, unlimited if None
+    head_bytes : int
+        Number of leading bytes searched for the HDF5 signature
+
+    """
+
+    def __init__(self, buffer: BinaryIO, max_bytes: Optional[int] = None, head_bytes: int = 4096):
+        self.buffer = buffer
+        self.max_bytes = max_bytes
+        self.head_bytes = head_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._head = b""
+        self._checked = False
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise UploadRejectedError(f"File exceeds {self.max_bytes / 1024**2:.0f} MB", status_code=413)
+        if not self._checked:
+            self._head += chunk[:self.head_bytes - len(self._head)]
+            if len(self._head) >= self.head_bytes:
+                self._check_signature()
+        self._hash.update(chunk)
+        self.buffer.write(chunk)
+
+    def _check_signature(self):
+        self._checked = True
+        if not has_hdf5_signature(self._head):
+            raise UploadRejectedError("File is not an HDF5/h5ad file")
+
+    def close(self):
+        """Check the signature of uploads shorter than ``head_bytes``."""
+        if not self._checked:
+            self._check_signature()
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def decoded_chunks(fileobj: BinaryIO, encoding: str = "identity", chunk_size: int = 8 * 1024**2) -> Iterator[bytes]:
+    """Chunks of at most ``chunk_size`` decompressed bytes of an upload with the given content encoding.
+
+    Raises
+    ------
+    UploadRejectedError
+        If the encoding is unknown or the upload is not valid for it
+
+    """
+    if encoding not in UPLOAD_ENCODINGS:
+        raise UploadRejectedError(f"Unsupported encoding {encoding!r}, expected one of {UPLOAD_ENCODINGS}")
+    if encoding == "gzip":
+        reader, errors = gzip.GzipFile(fileobj=fileobj, mode="rb"), (OSError, EOFError, zlib.error)
+    elif encoding == "zstd":
+        try:
+            zstandard = try_import("zstandard")
+        except ImportError as e:
+            raise UploadRejectedError(str(e)) from e
+        reader, errors = zstandard.ZstdDecompressor().stream_reader(fileobj), (zstandard.ZstdError, )
+    else:
+        reader, errors = fileobj, ()
+    try:
+        while chunk := reader.read(chunk_size):
+            yield chunk
+    except errors as e:
+        raise UploadRejectedError(f"Upload is not valid {encoding} data: {e}") from e
+
+
+def check_h5ad_header(path: str, max_cells: Optional[int] = None,
+                      max_values: Optional[int] = None) -> Tuple[int, int]:
+    """Shape of ``X`` of an h5ad file, read from the HDF5 metadata without loading the matrix.
+
+    Parameters
+    ----------
+    path : str
+        Path of the h5ad file
+    max_cells : Optional[int]
+        Number of cells above which the file is rejected, unlimited if None
+    max_values : Optional[int]
+        Number of cells times genes above which the file is rejected, unlimited if None
+
+    Returns
+    -------
+    Tuple[int, int]
+        Number of cells and genes
+
+    Raises
+    ------
+    UploadRejectedError
+        If the file cannot be opened as HDF5, has no ``X``, or ``X`` is empty or too large
+
+    """
+    try:
+        with h5py.File(path, "r") as f:
+            if "X" not in f:
+                raise UploadRejectedError("h5ad file has no X matrix")
+            X = f["X"]
+            if isinstance(X, h5py.Dataset):
+                shape = X.shape
+            else:
+                # Sparse matrices are groups, anndata < 0.7 stores their shape as h5sparse_shape
+                shape = X.attrs.get("shape", X.attrs.get("h5sparse_shape"))
+    except OSError as e:
+        raise UploadRejectedError(f"File is not a readable HDF5 file: {e}") from e
+    if shape is None or len(shape) != 2:
+        raise UploadRejectedError(f"X of the h5ad file must be a 2D matrix, got shape {shape}")
+    n_obs, n_vars = int(shape[0]), int(shape[1])
+    if n_obs == 0 or n_vars == 0:
+        raise UploadRejectedError(f"X of the h5ad file is empty: {n_obs} cells x {n_vars} genes")
+    if max_cells is not None and n_obs > max_cells:
+        raise UploadRejectedError(f"{n_obs} cells exceed the limit of {max_cells}", status_code=413)
+    if max_values is not None and n_obs * n_vars > max_values:
+        raise UploadRejectedError(f"{n_obs} cells x {n_vars} genes exceed the limit of {max_values} values",
+                                  status_code=413)
+    return n_obs, n_vars
+
+
+def is_content_hash(value: str) -> bool:
+    """Whether ``value`` is a hex SHA-256 digest, and thus safe to use in a file name."""
+    return re.fullmatch(r"[0-9a-f]{64}", value) is not None
+
+
+def file_sha256(path: str, chunk_size: int = 8 * 1024**2) -> str:
+    """SHA-256 of a file, the same digest :class:`H5adUploadWriter` computes for an upload."""
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+_shared_hashes = collections.OrderedDict()
+_shared_hashes_lock = threading.Lock()
+
+
+def shared_file_sha256(path: str, max_entries: int = 1024) -> str:
+    """:func:`file_sha256` memoized by path, size and modification time, for files read repeatedly by reference."""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _shared_hashes_lock:
+        if key in _shared_hashes:
+            _shared_hashes.move_to_end(key)
+            return _shared_hashes[key]
+    content_hash = file_sha256(path)
+    with _shared_hashes_lock:
+        _shared_hashes[key] = content_hash
+        while len(_shared_hashes) > max_entries:
+            _shared_hashes.popitem(last=False)
+    return content_hash
+
+
+def resolve_shared_path(path: str, roots: Sequence[str]) -> Optional[str]:
+    """Real path of ``path`` if it is an existing file under one of ``roots``, None otherwise."""
+    real_path = os.path.realpath(path)
+    for root in roots:
+        real_root = os.path.realpath(root)
+        if os.path.commonpath([real_root, real_path]) == real_root and os.path.isfile(real_path):
+            return real_path
+    return None
+
+
+class UploadStore:
+    """Uploaded h5ad files kept by content hash, so that later requests can pass the hash instead of the bytes.
+
+    The store is bounded in bytes; least recently used files (by mtime, refreshed on every hit) are removed first.
+    Files pinned by :meth:`path` or :meth:`add` are never removed until they are released with :meth:`release`, so
+    that a concurrent upload cannot evict a file a request is about to read.
+
+    Parameters
+    ----------
+    root : str
+        Directory holding the files, uploads are also written there before their hash is known
+    max_bytes : int
+        Total size of the kept files, 0 keeps no file
+
+    """
+
+    def __init__(self, root: str, max_bytes: int = 4 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pins = collections.Counter()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.root, f"{content_hash}.h5ad")
+
+    def temp_path(self) -> str:
+        """Path an upload is written to, on the file system of the store."""
+        return os.path.join(self.root, f"{uuid.uuid4()}.part")
+
+    def path(self, content_hash: str, pin: bool = False) -> Optional[str]:
+        """Path of the file with ``content_hash``, None if the store does not have it.
+
+        If ``pin``, the file is kept until :meth:`release` is called, which callers must do once they read it.
+
+        """
+        path = self._path(content_hash)
+        with self._lock:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if pin:
+                self._pins[content_hash] += 1
+        return path
+
+    def add(self, temp_path: str, content_hash: str, pin: bool = False) -> str:
+        """Keep the upload at ``temp_path`` and return its new path, or ``temp_path`` if the store keeps no file.
+
+        If ``pin``, the kept file is pinned as by :meth:`path`.
+
+        """
+        if self.max_bytes <= 0:
+            return temp_path
+        path = self._path(content_hash)
+        with self._lock:
+            os.replace(temp_path, path)
+            if pin:
+                self._pins[content_hash] += 1
+        # The new file is the most recently used one and is only evicted if it alone exceeds max_bytes
+        self._evict(keep=path)
+        return path
+
+    def release(self, content_hash: str):
+        """Unpin a file pinned by :meth:`path` or :meth:`add`."""
+        with self._lock:
+            self._pins[content_hash] -= 1
+            if self._pins[content_hash] <= 0:
+                del self._pins[content_hash]
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".h5ad"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _evict(self, keep: Optional[str] = None):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.root, name)
+            if path == keep:
+                continue
+            with self._lock:
+                if self._pins[name[:-len(".h5ad")]] > 0:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self.evictions += 1
+            total -= size
+            logger.info(f"Evicted uploaded file {name} from the upload store")
+
+    def stats(self) -> Dict[str, int]:
+        entries = self._entries()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "pinned": len(self._pins),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+            }
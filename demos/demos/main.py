@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import io
 import json
@@ -9,34 +10,106 @@ from matplotlib import pyplot as plt
 from networkx import dfs_tree
 import numpy as np
 import pandas as pd
-import tempfile
-import uuid
+import threading
+from contextlib import asynccontextmanager
 # --- FastAPI 相关的导入 ---
 
 import uvicorn
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 
 
-from demos.anndata_similarity import AnnDataSimilarity, get_anndata
-from demos.pipeline import get_additional_sweep
+from demos.admission import AnalysisExecutor, OverloadedError
+from demos.anndata_similarity import AnnDataSimilarity, AtlasSimilarityBatch, atlas_key, get_anndata, warm_atlas
+from demos.atlas_config import AtlasConfigRepository
+from demos.atlas_store import STORE_VERSION, AtlasStatsStore
+from demos.h5ad_upload import (UPLOAD_ENCODINGS, H5adUploadWriter, UploadRejectedError, UploadRequiredError,
+                                UploadStore, check_h5ad_header, decoded_chunks, is_content_hash, resolve_shared_path,
+                                shared_file_sha256)
+from demos.metric_plan import OUTPUTS, missing_metrics, plan_metrics
+from demos.result_cache import ResultCache, cache_key
+from demos.sim_matrix_store import SimilarityMatrixStore
 from demos.settings import entity,project
+from demos.sweep_mirror import DEFAULT_MIRROR_PATH, SweepMirror, SweepNotMirroredError, WandbSource
+from demos.worker_pool import WorkerPool, drop_resident_atlases
 
 
 import scanpy as sc
 import sys
-from demos.analyze_atlas_accuracy import is_matching_dict
+from demos.analyze_atlas_accuracy import match_runs
 from demos.process_tissue_similarity_matrices import convert_to_complex, unify_complex_float_types_cell
 from demos.vis_sim_v2_data import exclude_data
 from demos.vis_sim_v2_vis import plot_pre_normalized_radar_v3
 from demos.visualize_atlas_performance_v2 import plot_combined_methods
-from demos.utils import try_import
 from demos import logger
 # feature_names_global = ["wasserstein", "Hausdorff", "chamfer", "energy", "sinkhorn2", "bures", "spectral", "mmd","metadata_sim"]
 # feature_names_global = ["wasserstein", "Hausdorff",  "spectral"]
 feature_names_global = ["wasserstein", "Hausdorff", "chamfer", "energy", "sinkhorn2", "bures", "spectral", "mmd"]
+# 雷达图展示的指标；只需要排序时只计算 feature_name（见 demos.metric_plan）
+radar_feature_names_global = feature_names_global.copy()
+# 级联排序：先用廉价指标筛选 top_k 个图谱数据集，最后一级只在候选集上计算 feature_names_global
+cascade_stages_global = [
+    {"methods": ["metadata_sim", "common_genes_num", "wasserstein_sliced"], "rank_by": "wasserstein_sliced",
+     "top_k": 10},
+    {"methods": ["spectral"], "options": {"covariance_rank": 50}, "top_k": 5},
+]
 
-wandb =try_import("wandb")
 data_dir=f"demos/temp_data"
+atlas_store = AtlasStatsStore(data_dir=data_dir)
+# 图谱配置表只解析一次，文件修改后自动重新加载
+atlas_config = AtlasConfigRepository("demos/Cell Type Annotation Atlas.xlsx")
+# 预先计算的相似度矩阵，优先读取 python -m demos.sim_matrix_store 生成的快照，没有快照时读取 xlsx
+sim_matrix_store = SimilarityMatrixStore("demos/new_sim")
+# 相似度计算的采样参数，也是结果缓存键的一部分
+similarity_params_global = {"sample_size": 10, "init_random_state": 42, "n_runs": 1}
+# 按上传文件内容哈希缓存相似度矩阵，超过容量后淘汰最久未使用的结果
+result_cache = ResultCache(os.path.join(data_dir, "result_cache"),
+                           max_bytes=int(os.getenv("SIM_RESULT_CACHE_MAX_MB", "1024")) * 1024**2)
+UPLOAD_CHUNK_SIZE = 8 * 1024**2
+# 上传文件的大小上限与 nginx 的 client_max_body_size 一致；查询数据的细胞数上限在读取前从文件头检查
+MAX_UPLOAD_BYTES = int(os.getenv("SIM_MAX_UPLOAD_MB", "1000")) * 1024**2
+MAX_QUERY_CELLS = int(os.getenv("SIM_MAX_QUERY_CELLS", "1000000"))
+# 上传过的文件按内容哈希保留，之后的请求只需发送哈希；与后端共享的目录中的文件可以直接按路径读取
+upload_store = UploadStore(os.path.join(data_dir, "uploads"),
+                           max_bytes=int(os.getenv("SIM_UPLOAD_STORE_MB", "4096")) * 1024**2)
+SHARED_UPLOAD_ROOTS = [root for root in os.getenv("SIM_SHARED_UPLOAD_ROOTS", "/uploads").split(os.pathsep) if root]
+# 常驻的相似度计算进程池，随服务启动和关闭；SIM_POOL_SIZE=0 时每个请求改用 joblib 临时启动进程
+# 每个进程按 LRU 缓存已加载的图谱数据；SIM_ATLAS_CACHE_MB 是整个进程池的总预算，平均分给各个进程
+# 默认进程数为 CPU 核数，最多 8 个
+similarity_pool = WorkerPool(
+    size=int(os.getenv("SIM_POOL_SIZE", str(min(os.cpu_count() or 1, 8)))),
+    max_memory_mb=int(os.getenv("SIM_POOL_MAX_MEMORY_MB")) if os.getenv("SIM_POOL_MAX_MEMORY_MB") else None,
+    max_tasks_per_worker=int(os.getenv("SIM_POOL_MAX_TASKS")) if os.getenv("SIM_POOL_MAX_TASKS") else None,
+    atlas_cache_mb=int(os.getenv("SIM_ATLAS_CACHE_MB", "4096")))
+# 在线程中执行分析，避免阻塞事件循环；同时运行和排队的分析数量有上限，超出时立即返回 429
+analysis_executor = AnalysisExecutor(max_concurrent=int(os.getenv("SIM_MAX_CONCURRENT_ANALYSES", "2")),
+                                     max_queued=int(os.getenv("SIM_MAX_QUEUED_ANALYSES", "8")))
+# 本地的 W&B sweep 镜像，由 python -m demos.sweep_mirror 定期同步，请求时不访问 W&B API
+# 只有镜像中还没有的 sweep 才在请求时拉取，SWEEP_MIRROR_FETCH_MISSING=0 时改为返回 409
+# 数据库文件在第一次使用时才创建，导入 main 不会创建文件
+sweep_mirror = SweepMirror(os.getenv("SWEEP_MIRROR_PATH", DEFAULT_MIRROR_PATH),
+                           ttl=float(os.getenv("SWEEP_MIRROR_TTL", str(24 * 3600))))
+sweep_source = WandbSource(entity, project) if os.getenv("SWEEP_MIRROR_FETCH_MISSING", "1") == "1" else None
+# pyplot 的全局状态不是线程安全的，绘图需要串行执行
+plot_lock = threading.Lock()
+
+
+def similarity_cache_key(content_hash: str, tissue: str, adaptive_sampling=False, cascade=False, methods=None,
+                         feature_name=None):
+    """缓存键。除自适应采样外，同一文件的所有指标保存在同一个条目中，缺少的指标在之后的请求中补充计算。
+
+    自适应采样的采样规模取决于排序指标和计算的指标，所以这两者也是缓存键的一部分。
+    图谱数据集列表、图谱统计存储的版本和各图谱源文件的大小与修改时间也是缓存键的一部分，
+    新增图谱或重新生成图谱后不再使用旧的结果。
+    """
+    atlas_datasets = atlas_config.atlas_datasets(tissue)
+    atlas_params = {"atlas_datasets": atlas_datasets, "atlas_store": [STORE_VERSION, atlas_store.n_top_genes],
+                    "atlas_sources": atlas_store.source_manifest(tissue, atlas_datasets)}
+    if not adaptive_sampling:
+        return cache_key(content_hash, tissue=tissue, methods=feature_names_global, similarity=similarity_params_global,
+                         adaptive_sampling=False, cascade=cascade_stages_global if cascade else None, **atlas_params)
+    return cache_key(content_hash, tissue=tissue, methods=methods, similarity=similarity_params_global,
+                     adaptive_sampling=True, cascade=cascade_stages_global if cascade else None,
+                     rank_by=feature_name, **atlas_params)
 # 辅助函数：将Matplotlib figure对象转为Base64字符串
 def fig_to_base64(fig):
     buf = io.BytesIO()
@@ -47,39 +120,95 @@ def fig_to_base64(fig):
     plt.close(fig) # 重要：关闭图形，防止内存泄漏
     return base64_string
 
-def get_sim(adata:ad.AnnData,tissue:str,sweep_dict:Optional[dict]=None,feature_name:str="bures",use_sim_cache=False,query_dataset=None):
-    conf_data = pd.read_excel( "demos/Cell Type Annotation Atlas.xlsx", sheet_name=tissue)
-    atlas_datasets = list(conf_data[conf_data["queryed"] == False]["dataset_id"])
+def get_sim(adata:ad.AnnData,tissue:str,sweep_dict:Optional[dict]=None,feature_name:str="bures",use_sim_cache=False,query_dataset=None,adaptive_sampling=False,cascade=False,content_hash=None,adata_path=None,outputs="full"):
+    atlas_datasets = atlas_config.atlas_datasets(tissue)
     ans = {}
-    feature_names=feature_names_global.copy()
-    df_excel=pd.ExcelFile(f"demos/new_sim/{tissue}_similarity.xlsx")
-    if use_sim_cache and query_dataset is not None and query_dataset[:4] in df_excel.sheet_names:
-        sim_data = pd.read_excel(f"demos/new_sim/{tissue}_similarity.xlsx", sheet_name=query_dataset[:4],
-                             index_col=0)
+    sampling_report = None
+    cascade_report = None
+    # 只计算所需输出（排序 / 排序和雷达图 / 完整矩阵）用到的指标
+    feature_names = plan_metrics(outputs, feature_name, radar_feature_names_global, feature_names_global)
+    sim_data = None
+    if use_sim_cache and query_dataset is not None:
+        sim_data = sim_matrix_store.get(tissue, query_dataset[:4])
+    if sim_data is not None:
         for target_file in atlas_datasets:
             ans[target_file] = dict(sim_data.loc[feature_names, target_file])
     else:
-        # 定义单个目标文件的处理函数
-        def process_target_file(target_file):
-            target_data = get_anndata(train_dataset=[f"{target_file}"], data_dir=data_dir, tissue=tissue.capitalize())
-            
-            # Initialize similarity calculator with multiple metrics
-            similarity_calculator = AnnDataSimilarity(
-                adata1=adata, adata2=target_data, sample_size=10, init_random_state=42, n_runs=1,
-                ground_truth_conf_path="demos/Cell Type Annotation Atlas.xlsx", tissue=tissue)
-            
-            # Calculate similarity using multiple methods
-            return target_file, similarity_calculator.get_similarity_matrix_A2B(methods=feature_names)
-        
-        # 使用joblib并行执行处理函数
-        results = Parallel(n_jobs=-1)(delayed(process_target_file)(target_file) for target_file in atlas_datasets)
-        logger.info(results)
-        # 将结果整合到ans字典中
-        for target_file, sim_result in results:
-            ans[target_file] = sim_result
+        key = None if content_hash is None else similarity_cache_key(
+            content_hash, tissue, adaptive_sampling, cascade, methods=feature_names, feature_name=feature_name)
+        cached = None if key is None else result_cache.get(key)
+        missing = feature_names
+        if cached is not None:
+            ans.update(cached["similarity_matrix"])
+            atlas_datasets = cached["atlas_datasets"]
+            sampling_report = cached["sampling"]
+            cascade_report = cached["cascade"]
+            missing = missing_metrics(ans, atlas_datasets, feature_names)
+            if missing:
+                logger.info(f"结果缓存缺少指标 {missing}，只计算缺少的指标: {content_hash}")
+            else:
+                logger.info(f"命中结果缓存: {content_hash}")
+        if missing:
+            if adata is None:
+                if adata_path is None:
+                    # 按内容哈希引用的文件不在本服务中，且结果缓存中缺少所需指标
+                    raise UploadRequiredError(content_hash)
+                adata = sc.read_h5ad(adata_path)
+            # 查询数据只预处理一次，通过共享内存交给各进程，再并行计算与各图谱数据集的相似度
+            with AtlasSimilarityBatch(
+                    adata, atlas_datasets, tissue=tissue, data_dir=data_dir,
+                    ground_truth_conf_path="demos/Cell Type Annotation Atlas.xlsx", store=atlas_store,
+                    pool=similarity_pool if similarity_pool.running else None, **similarity_params_global) as batch:
+                if cached is not None:
+                    # 缓存中的图谱数据集（级联排序时为筛选后的候选集）已经确定，只补充缺少的指标
+                    results = batch.compute(methods=missing)
+                elif cascade:
+                    results, cascade_report = batch.compute_cascade(cascade_stages_global + [{"methods": missing}])
+                    logger.info(cascade_report)
+                    # 只保留通过所有筛选阶段的图谱数据集
+                    atlas_datasets = list(results)
+                elif adaptive_sampling:
+                    # 逐步增大采样规模，直到按 feature_name 排序的前几名稳定
+                    results, sampling_report = batch.compute_adaptive(methods=missing, feature_name=feature_name)
+                    logger.info(sampling_report)
+                else:
+                    results = batch.compute(methods=missing)
+            logger.info(results)
+            # 将结果整合到ans字典中
+            for atlas_dataset, values in results.items():
+                ans.setdefault(atlas_dataset, {}).update(values)
+            if key is not None:
+                result_cache.put(key, {
+                    "similarity_matrix": pd.DataFrame(ans).astype(str).to_dict(),
+                    "atlas_datasets": atlas_datasets,
+                    "sampling": sampling_report,
+                    "cascade": cascade_report,
+                })
 
+    response_data = rank_similarity(ans, tissue, feature_name=feature_name, sweep_dict=sweep_dict,
+                                    atlas_datasets=atlas_datasets, radar=outputs != "ranking")
+    # 已计算的 指标×图谱 矩阵（复数以字符串保存），之后换一个已有的 feature_name 只需调用 /api/rank_similarity 重新排序
+    response_data["similarity_matrix"] = pd.DataFrame(ans).astype(str).to_dict()
+    response_data["sampling"] = sampling_report
+    response_data["cascade"] = cascade_report
+    response_data["metrics"] = feature_names
+    return response_data
+
+
+def rank_similarity(ans: dict, tissue: str, feature_name: str = "bures", sweep_dict: Optional[dict] = None,
+                    atlas_datasets: Optional[list] = None, radar: bool = True):
+    """按 feature_name 对图谱数据集排序，选出最相似的图谱数据集并绘图。
+
+    ans 为 {图谱数据集: {指标: 相似度}}，可以是 get_sim 返回的 similarity_matrix，这时不需要重新计算相似度。
+    radar 为 False 时不绘制雷达图；雷达图只包含 ans 中已有的指标。
+    """
+    if atlas_datasets is None:
+        atlas_datasets = list(ans)
     df = pd.DataFrame(ans)
     df = df[~df.index.duplicated(keep='last')]
+    if feature_name not in df.index:
+        raise KeyError(f"相似度矩阵中没有指标 {feature_name}")
+    feature_names = [name for name in radar_feature_names_global if name in df.index]
             # df=unify_complex_float_types_row(df) #Some complex numbers may lose precision, but it's not a big issue since only real parts are used for comparison
     df = unify_complex_float_types_cell(
         df
@@ -99,7 +228,7 @@ def get_sim(adata:ad.AnnData,tissue:str,sweep_dict:Optional[dict]=None,feature_n
         logger.info(f"检查数据集 {dataset} 是否所有方法都有有效配置...")
         invalid_methods = []
         for method in methods:
-            yaml_value = conf_data.loc[conf_data["dataset_id"] == dataset, f"{method}_step2_best_yaml"].iloc[0]
+            yaml_value = atlas_config.best_yaml(tissue, dataset, method)
             if isinstance(yaml_value, float) and np.isnan(yaml_value):
                 invalid_methods.append(method)
                 
@@ -123,34 +252,27 @@ def get_sim(adata:ad.AnnData,tissue:str,sweep_dict:Optional[dict]=None,feature_n
     methods=["cta_celltypist", "cta_scdeepsort", "cta_singlecellnet", "cta_actinn"]
     ans_conf={}
     for method in methods:
-        row=conf_data.loc[conf_data["dataset_id"] == atlas_dataset_res]
-        ans_conf[method]=row[f"{method}_step2_best_yaml"].iloc[0]
-        ans_conf[f"{method}_res"]=row[f"{method}_best_res"].iloc[0]
+        ans_conf[method]=atlas_config.best_yaml(tissue, atlas_dataset_res, method)
+        ans_conf[f"{method}_res"]=atlas_config.best_res(tissue, atlas_dataset_res, method)
     ans_conf["dataset_id"] = atlas_dataset_res
     if sweep_dict is not None:
         method_accs_cache= {}
         
         for method in methods:
             sweep_id=sweep_dict.get(method,{})
-            sweep_ids = get_additional_sweep(entity=entity, project=project, sweep_id=sweep_id)
-            accs=[]
-            runs = []
-            for sweep_id in sweep_ids:
-                runs.extend(wandb.Api().sweep(f"{entity}/{project}/{sweep_id}").runs)
+            sweep_ids = sweep_mirror.sweep_ids(sweep_id, source=sweep_source)
+            runs = sweep_mirror.runs(sweep_ids)
             accs=[run.summary.get("test_acc", 0) for run in runs]
             method_accs_cache[method] = accs
+            best_yamls = {}
             for atlas_dataset in atlas_datasets:
-                best_yaml = conf_data[conf_data["dataset_id"] == atlas_dataset][f"{method}_step2_best_yaml"].iloc[0]
-                match_run = None
-                # Find matching run configuration
-                for run in runs:
-                    if isinstance(best_yaml, float) and np.isnan(best_yaml):
-                        continue
-                    if is_matching_dict(best_yaml, run.config):
-                        if match_run is not None:
-                            raise ValueError("Multiple matching runs found when only one expected")
-                        match_run = run
-
+                best_yaml = atlas_config.best_yaml(tissue, atlas_dataset, method)
+                if not (isinstance(best_yaml, float) and np.isnan(best_yaml)):
+                    best_yamls[atlas_dataset] = best_yaml
+            # Find matching run configuration: hash join on the config signatures instead of comparing every pair
+            matches = match_runs(best_yamls, runs)
+            for atlas_dataset in atlas_datasets:
+                match_run = matches.get(atlas_dataset)
                 if match_run is None:
                     logger.warning(f"No matching configuration found for {atlas_dataset} with method {method}")
                 else:
@@ -162,13 +284,16 @@ def get_sim(adata:ad.AnnData,tissue:str,sweep_dict:Optional[dict]=None,feature_n
             feature_names.append("average_acc")
     
     df_sim = df.loc[feature_names, :].T.applymap(convert_to_complex)
-    fig1,_=plot_pre_normalized_radar_v3(df_sim, atlas_dataset_res, tissue=tissue,query_dataset=None,title_fontsize=14,other_fill=False)
-    b64_image1=fig_to_base64(fig1)
-    
-    b64_image2 = None
-    if sweep_dict is not None:
-        fig2,_ = plot_combined_methods(df, tissue=tissue, query_dataset=None,methods=methods,feature_name=feature_name,conf_data=conf_data,save=False,method_runs_cache=method_accs_cache)
-        b64_image2 = fig_to_base64(fig2)
+    with plot_lock:
+        b64_image1 = None
+        if radar:
+            fig1,_=plot_pre_normalized_radar_v3(df_sim, atlas_dataset_res, tissue=tissue,query_dataset=None,title_fontsize=14,other_fill=False)
+            b64_image1=fig_to_base64(fig1)
+
+        b64_image2 = None
+        if sweep_dict is not None:
+            fig2,_ = plot_combined_methods(df, tissue=tissue, query_dataset=None,methods=methods,feature_name=feature_name,conf_data=atlas_config.sheet(tissue),save=False,method_runs_cache=method_accs_cache)
+            b64_image2 = fig_to_base64(fig2)
     # 4. 将所有内容打包到一个Python字典中
     response_data = {
         "metadata": ans_conf,
@@ -181,42 +306,218 @@ def get_sim(adata:ad.AnnData,tissue:str,sweep_dict:Optional[dict]=None,feature_n
 
 
 # ----------------- 新增 FastAPI 部分 -----------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if similarity_pool.size > 0:
+        similarity_pool.start()
+    yield
+    analysis_executor.shutdown()
+    similarity_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 @app.get("/api/hello")
 async def hello():
     return {"message": "Hello, World!"}
+@app.get("/api/cache_stats")
+async def get_cache_stats():
+    return result_cache.stats()
+@app.get("/api/sweep_mirror_stats")
+async def get_sweep_mirror_stats():
+    return sweep_mirror.stats()
+@app.post("/api/admin/sweep_mirror/sync")
+async def sync_sweep_mirror(
+    sweep_ids_json: str = Form(..., description="要同步的sweep ID列表的JSON字符串"),
+    force: bool = Form(False, description="是否忽略TTL重新拉取")
+):
+    """
+    同步 sweep 镜像：并行拉取缺少或过期的 sweep 及其关联的 sweep。
+    """
+    try:
+        sweep_ids = json.loads(sweep_ids_json)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="sweep_ids_json 不是一个有效的JSON字符串。")
+    return await asyncio.to_thread(sweep_mirror.sync, WandbSource(entity, project), sweep_ids, force=force)
+@app.get("/api/upload_store_stats")
+async def get_upload_store_stats():
+    return upload_store.stats()
+@app.get("/api/queue_stats")
+async def get_queue_stats():
+    return analysis_executor.stats()
+@app.get("/api/pool_stats")
+async def get_pool_stats():
+    return similarity_pool.stats()
+@app.get("/api/atlas_cache_stats")
+async def get_atlas_cache_stats():
+    return similarity_pool.atlas_cache_stats()
+@app.post("/api/admin/atlas_cache/warm")
+async def warm_atlas_cache(tissue: str = Form(..., description="组织类型, 例如 'brain'")):
+    """
+    预先把该组织的所有图谱数据集加载到计算进程的缓存中，之后的请求会优先分配给已缓存对应图谱的进程。
+    """
+    if not similarity_pool.running:
+        raise HTTPException(status_code=409, detail="计算进程池未启动")
+    futures = [
+        similarity_pool.submit(warm_atlas, tissue, atlas_id, data_dir, n_top_genes=atlas_store.n_top_genes,
+                               store=atlas_store, affinity=atlas_key(tissue, atlas_id, atlas_store.n_top_genes))
+        for atlas_id in atlas_config.atlas_datasets(tissue)
+    ]
+    loaded = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+    return {"loaded": dict(loaded), "atlas_cache": similarity_pool.atlas_cache_stats()}
+@app.post("/api/admin/atlas_cache/drop")
+async def drop_atlas_cache():
+    if not similarity_pool.running:
+        raise HTTPException(status_code=409, detail="计算进程池未启动")
+    await asyncio.gather(*(asyncio.wrap_future(future) for future in similarity_pool.broadcast(drop_resident_atlases)))
+    return similarity_pool.atlas_cache_stats()
+@app.post("/api/admin/pool/restart")
+async def restart_pool():
+    """
+    平滑重启计算进程：新进程立即接收任务，旧进程完成当前任务后退出，同时释放常驻的图谱数据。
+    """
+    if not similarity_pool.running:
+        raise HTTPException(status_code=409, detail="计算进程池未启动")
+    similarity_pool.restart()
+    return similarity_pool.stats()
 @app.get("/api/get_method")
 async def get_atlas_method(atlas_id,tissue):
-    conf_data = pd.read_excel( "demos/Cell Type Annotation Atlas.xlsx", sheet_name=tissue)
     ans_conf = {
-        method: conf_data.loc[conf_data["dataset_id"] == atlas_id, f"{method}_step2_best_yaml"].iloc[0]
+        method: atlas_config.best_yaml(tissue, atlas_id, method)
         for method in ["cta_celltypist", "cta_scdeepsort", "cta_singlecellnet", "cta_actinn"]
     } 
     ans_conf["dataset_id"]=atlas_id
     return ans_conf
+def overloaded_exception(e: OverloadedError) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=f"服务繁忙，请稍后重试: {e}",
+                         headers={"Retry-After": str(e.retry_after)})
+@app.post("/api/rank_similarity")
+async def rank_similarity_analysis(
+    tissue: str = Form(..., description="组织类型, 例如 'brain'"),
+    similarity_matrix_json: str = Form(..., description="之前 /api/get_similarity 返回的 similarity_matrix"),
+    feature_name: str = Form("metadata_sim", description="要使用的特征名称"),
+    sweep_dict_json: Optional[str] = Form(None, description="包含sweep ID的JSON字符串")
+):
+    """
+    按新的 feature_name 对已保存的相似度矩阵重新排序并绘图，不重新计算相似度。
+    """
+    try:
+        ans = json.loads(similarity_matrix_json)
+        sweep_dict = json.loads(sweep_dict_json) if sweep_dict_json else None
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="similarity_matrix_json 或 sweep_dict_json 不是一个有效的JSON字符串。")
+    if any(feature_name not in values for values in ans.values()):
+        raise HTTPException(status_code=400,
+                            detail=f"similarity_matrix 中没有指标 {feature_name}，请通过 /api/get_similarity 计算该指标。")
+    try:
+        logger.info(f"重新排序 tissue={tissue}, feature_name={feature_name}...")
+        # 重新排序不计算相似度，不占用 analysis_executor 的名额；绘图在 rank_similarity 中由 plot_lock 串行化
+        response_data = await asyncio.to_thread(rank_similarity, ans, tissue, feature_name=feature_name,
+                                                sweep_dict=sweep_dict)
+        response_data["similarity_matrix"] = ans
+        return response_data
+    except SweepNotMirroredError as e:
+        raise HTTPException(status_code=409, detail=f"sweep {e} 尚未同步到本地镜像，请先调用 /api/admin/sweep_mirror/sync。")
+    except Exception as e:
+        logger.error(f"重新排序过程中发生错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
 @app.post("/api/get_similarity")
 async def run_similarity_analysis(
-    h5ad_file: UploadFile = File(..., description="上传 .h5ad 格式的查询数据文件"),
+    h5ad_file: Optional[UploadFile] = File(None, description="上传 .h5ad 格式的查询数据文件"),
+    content_hash: Optional[str] = Form(None, description="不上传文件时，查询数据文件内容的 SHA-256"),
+    h5ad_path: Optional[str] = Form(None, description="不上传文件时，查询数据文件在共享目录中的路径"),
+    h5ad_encoding: str = Form("identity", description="上传文件的压缩方式: identity, gzip 或 zstd"),
     tissue: str = Form(..., description="组织类型, 例如 'brain'"),
     feature_name: str = Form("metadata_sim", description="要使用的特征名称"),
     use_sim_cache: bool = Form(False, description="是否使用缓存的相似度矩阵"),
     query_dataset: Optional[str] = Form(None, description="查询数据集的ID"),
-    sweep_dict_json: Optional[str] = Form(None, description="包含sweep ID的JSON字符串")
+    sweep_dict_json: Optional[str] = Form(None, description="包含sweep ID的JSON字符串"),
+    adaptive_sampling: bool = Form(False, description="是否使用自适应采样计算相似度"),
+    cascade: bool = Form(False, description="是否先用廉价指标筛选图谱数据集再计算昂贵指标"),
+    outputs: str = Form("full", description="需要的输出: ranking 只排序, radar 排序并绘制雷达图, full 另外返回完整的相似度矩阵")
 ):
     """
     接收上传的h5ad文件和参数，运行相似度分析，并返回包含结果和图表的JSON。
+
+    也可以不上传文件，只发送共享目录中的路径 h5ad_path 或之前上传过的文件的 content_hash；
+    服务中没有该文件时返回 404 和 {"error": "upload_required"}，调用方再上传文件。
     """
+    if outputs not in OUTPUTS:
+        raise HTTPException(status_code=400, detail=f"outputs 必须是 {', '.join(OUTPUTS)} 之一。")
+    if h5ad_file is None and content_hash is None and h5ad_path is None:
+        raise HTTPException(status_code=400, detail="需要上传 h5ad_file，或提供 content_hash 或 h5ad_path。")
+    if content_hash is not None and not is_content_hash(content_hash):
+        raise HTTPException(status_code=400, detail="content_hash 必须是十六进制的 SHA-256。")
+    if h5ad_encoding not in UPLOAD_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"h5ad_encoding 必须是 {', '.join(UPLOAD_ENCODINGS)} 之一。")
+    # 队列已满时在接收上传内容之前就拒绝请求
+    try:
+        analysis_executor.check()
+    except OverloadedError as e:
+        raise overloaded_exception(e)
+
     # 1. 处理上传的文件
-    # 创建一个安全的临时文件来保存上传内容
-    temp_dir = tempfile.gettempdir()
-    temp_file_path = os.path.join(temp_dir, f"{uuid.uuid4()}.h5ad")
+    # 上传内容先写入上传目录中的临时文件，得到内容哈希后按哈希保留
+    # 分析期间固定上传目录中使用的文件，其他请求上传文件时不会将其清除
+    temp_file_path = None
+    pinned_hash = None
+    # 分析线程开始后由分析线程释放文件：客户端断开连接时请求结束，但分析线程仍在读取文件
+    # 分析线程和请求中先声明的一方负责释放，分析被拒绝或在排队时取消则由请求释放
+    release_lock = threading.Lock()
+    release_owner = None
+
+    def claim_release(owner):
+        nonlocal release_owner
+        with release_lock:
+            if release_owner is None:
+                release_owner = owner
+            return release_owner == owner
+
+    def release_upload():
+        # 释放固定的文件，清理没有保留下来的临时文件，无论成功或失败
+        if pinned_hash is not None:
+            upload_store.release(pinned_hash)
+        if temp_file_path is not None and os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+            logger.info(f"已清理临时文件: {temp_file_path}")
 
     try:
-        with open(temp_file_path, "wb") as buffer:
-            buffer.write(await h5ad_file.read())
+        if h5ad_file is not None:
+            temp_file_path = upload_store.temp_path()
+            # 分块解压并写入磁盘，边写入边计算内容哈希和大小，相同文件再次上传时直接使用缓存的相似度矩阵
+            # 超过大小上限（按解压后的大小）或开头不是 HDF5 签名时立即拒绝，不再继续处理
+            def receive():
+                with open(temp_file_path, "wb") as buffer:
+                    writer = H5adUploadWriter(buffer, max_bytes=MAX_UPLOAD_BYTES)
+                    for chunk in decoded_chunks(h5ad_file.file, h5ad_encoding, UPLOAD_CHUNK_SIZE):
+                        writer.write(chunk)
+                    writer.close()
+                return writer
 
-        # 使用scanpy读取临时文件
-        adata = sc.read_h5ad(temp_file_path)
+            writer = await asyncio.to_thread(receive)
+            content_hash = writer.hexdigest()
+            # 只读取 HDF5 元数据检查 X 的形状，在 sc.read_h5ad 加载数据之前拒绝空矩阵或过大的文件
+            n_obs, n_vars = check_h5ad_header(temp_file_path, max_cells=MAX_QUERY_CELLS)
+            logger.info(f"已接收上传文件: {writer.size / 1024**2:.1f} MB, {n_obs} cells x {n_vars} genes")
+            adata_path = upload_store.add(temp_file_path, content_hash, pin=True)
+            if adata_path != temp_file_path:
+                pinned_hash = content_hash
+        else:
+            # 按引用传递：优先直接读取共享目录中的文件，其次使用之前上传过的同一文件
+            adata_path = None if h5ad_path is None else resolve_shared_path(h5ad_path, SHARED_UPLOAD_ROOTS)
+            if adata_path is not None:
+                n_obs, n_vars = check_h5ad_header(adata_path, max_cells=MAX_QUERY_CELLS)
+                # 结果按内容哈希缓存，共享文件的哈希总是由服务计算，不能使用请求中的 content_hash
+                file_hash = await asyncio.to_thread(shared_file_sha256, adata_path)
+                if content_hash is not None and content_hash != file_hash:
+                    raise HTTPException(status_code=400, detail="content_hash 与 h5ad_path 文件的内容不一致。")
+                content_hash = file_hash
+                logger.info(f"直接读取共享文件 {adata_path}: {n_obs} cells x {n_vars} genes")
+            elif content_hash is not None:
+                adata_path = upload_store.path(content_hash, pin=True)
+                if adata_path is not None:
+                    pinned_hash = content_hash
+            else:
+                raise UploadRequiredError(h5ad_path)
 
         # 2. 处理 sweep_dict
         sweep_dict = None
@@ -226,29 +527,54 @@ async def run_similarity_analysis(
             except json.JSONDecodeError:
                 raise HTTPException(status_code=400, detail="sweep_dict_json 不是一个有效的JSON字符串。")
 
-        # 3. 调用你的核心分析函数
-        logger.info(f"开始分析 tissue={tissue}, feature_name={feature_name}...")
-        results = get_sim(
-            adata=adata,
-            tissue=tissue,
-            sweep_dict=sweep_dict,
-            feature_name=feature_name,
-            use_sim_cache=use_sim_cache,
-            query_dataset=query_dataset
-        )
+        # 3. 调用你的核心分析函数（在分析线程中读取文件和计算）
+        def analyze():
+            if not claim_release("analysis"):
+                # 请求已经结束并释放了文件
+                return None
+            try:
+                logger.info(f"开始分析 tissue={tissue}, feature_name={feature_name}, outputs={outputs}...")
+                # 只有结果缓存中缺少所需指标时，get_sim 才会用scanpy读取临时文件
+                return get_sim(
+                    adata=None,
+                    tissue=tissue,
+                    sweep_dict=sweep_dict,
+                    feature_name=feature_name,
+                    use_sim_cache=use_sim_cache,
+                    query_dataset=query_dataset,
+                    adaptive_sampling=adaptive_sampling,
+                    cascade=cascade,
+                    content_hash=content_hash,
+                    adata_path=adata_path,
+                    outputs=outputs
+                )
+            finally:
+                release_upload()
+
+        results = await analysis_executor.run(analyze)
         logger.info("分析完成。")
         
         return results
 
+    except OverloadedError as e:
+        raise overloaded_exception(e)
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"上传文件无效: {e}")
+    except UploadRequiredError:
+        raise HTTPException(status_code=404, detail={"error": "upload_required",
+                                                     "message": "服务中没有该文件，请上传 h5ad_file。"})
+    except SweepNotMirroredError as e:
+        raise HTTPException(status_code=409, detail=f"sweep {e} 尚未同步到本地镜像，请先调用 /api/admin/sweep_mirror/sync。")
+    except HTTPException:
+        raise
     except Exception as e:
         # 捕获所有可能的错误，并返回一个有意义的错误信息
         logger.error(f"分析过程中发生错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
     finally:
-        # 4. 清理临时文件，无论成功或失败
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-            logger.info(f"已清理临时文件: {temp_file_path}")
+        # 4. 分析没有开始时（出错、被拒绝或排队时取消）由请求释放文件
+        if claim_release("request"):
+            release_upload()
 
 # 启动服务的命令 (在终端中运行)
 # uvicorn main:app --host 0.0.0.0 --port 8100 --reload
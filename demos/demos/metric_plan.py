@@ -0,0 +1,54 @@
+"""Selection of the similarity metrics a request actually needs.
+
+Computing every metric between the query and every atlas dataset dominates the cost of a similarity request, while
+ranking the atlas datasets only needs the metric they are ranked by. :func:`plan_metrics` maps the outputs a request
+asks for to the smallest metric set producing them, and :func:`missing_metrics` tells which of those a (cached)
+similarity matrix still lacks, so that later requests only compute the difference.
+
+"""
+from typing import Dict, List, Sequence
+
+#: Outputs of a similarity request, each one including the previous ones
+OUTPUTS = ("ranking", "radar", "full")
+
+
+def plan_metrics(outputs: str, feature_name: str, radar_metrics: Sequence[str],
+                 all_metrics: Sequence[str]) -> List[str]:
+    """Metrics needed to produce ``outputs``.
+
+    Parameters
+    ----------
+    outputs : str
+        ``"ranking"`` for the ranking of the atlas datasets, ``"radar"`` for the ranking and the radar plot, ``"full"``
+        for the ranking, the radar plot and the full similarity matrix
+    feature_name : str
+        Metric the atlas datasets are ranked by
+    radar_metrics : Sequence[str]
+        Metrics shown in the radar plot
+    all_metrics : Sequence[str]
+        Metrics of the full similarity matrix
+
+    Returns
+    -------
+    List[str]
+        Needed metrics in the order of ``all_metrics``, followed by ``feature_name`` if it is not one of them
+
+    """
+    if outputs not in OUTPUTS:
+        raise ValueError(f"Unknown outputs {outputs!r}, expected one of {OUTPUTS}")
+    needed = {feature_name}
+    if outputs != "ranking":
+        needed.update(radar_metrics)
+    if outputs == "full":
+        needed.update(all_metrics)
+    order = list(dict.fromkeys([*all_metrics, *radar_metrics, feature_name]))
+    return [metric for metric in order if metric in needed]
+
+
+def missing_metrics(matrix: Dict[str, Dict[str, object]], atlas_datasets: Sequence[str],
+                    metrics: Sequence[str]) -> List[str]:
+    """Metrics of ``metrics`` absent from ``matrix`` (atlas dataset -> metric -> value) for any atlas dataset."""
+    return [
+        metric for metric in metrics
+        if any(metric not in matrix.get(atlas_dataset, {}) for atlas_dataset in atlas_datasets)
+    ]
@@ -0,0 +1,110 @@
+"""Persistent content-addressed cache of similarity results.
+
+Entries are JSON files named by a key derived from the content hash of the query h5ad and every parameter that
+changes the similarity values (tissue, metric set, sampling parameters). The cache is bounded in bytes; when it grows
+beyond ``max_bytes``, least recently used entries are evicted. Recency is the file mtime, refreshed on every hit, so it
+survives restarts of the service.
+
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from demos import logger
+
+
+def cache_key(content_hash: str, **params) -> str:
+    """Key of a result computed from the file with ``content_hash`` and the given parameters."""
+    payload = json.dumps({"content_hash": content_hash, **params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of JSON results on disk.
+
+    Parameters
+    ----------
+    root : str
+        Directory holding the entries
+    max_bytes : int
+        Total size of the entries above which the least recently used ones are evicted
+
+    """
+
+    def __init__(self, root: str, max_bytes: int = 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f, default=str)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+            logger.info(f"Evicted similarity result {name} from the cache")
+
+    def stats(self) -> Dict[str, int]:
+        entries = self._entries()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,104 @@
+"""Read-only AnnData handed over to worker processes through memory-mapped files.
+
+Pickling an AnnData for every task of a worker pool copies its whole count matrix into every task payload and
+into every worker. :class:`SharedAnnData` writes the buffers of the matrix (``data``, ``indices`` and ``indptr`` of
+a CSR matrix, or the dense array) once to ``.npy`` files, preferably on the ``/dev/shm`` tmpfs. The handle itself
+pickles to the file locations plus ``obs`` and ``var``; :meth:`SharedAnnData.open` memory-maps the files read-only,
+so all workers share the pages of a single copy.
+
+"""
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Optional, Sequence
+
+import anndata
+import numpy as np
+import scipy.sparse
+
+from demos import logger
+
+SHM_DIR = "/dev/shm"
+
+
+class SharedAnnData:
+    """Picklable handle of an AnnData whose ``X`` is shared through memory-mapped files.
+
+    Parameters
+    ----------
+    adata : anndata.AnnData
+        Dataset to share, ``X`` is converted to CSR if it is sparse
+    obs_columns : Optional[Sequence[str]]
+        ``obs`` columns handed over, all of them by default. The obs names are not handed over
+    dir : Optional[str]
+        Directory the buffers are written to, ``/dev/shm`` if it exists and has room, the temporary directory
+        otherwise
+
+    """
+
+    def __init__(self, adata: anndata.AnnData, obs_columns: Optional[Sequence[str]] = None,
+                 dir: Optional[str] = None):
+        X = adata.X
+        self.sparse = scipy.sparse.issparse(X)
+        if self.sparse:
+            X = X.tocsr()
+            arrays = {"data": X.data, "indices": X.indices, "indptr": X.indptr}
+        else:
+            arrays = {"X": np.asarray(X)}
+        self.shape = X.shape
+        self.nbytes = sum(array.nbytes for array in arrays.values())
+        columns = adata.obs.columns if obs_columns is None else [col for col in obs_columns if col in adata.obs]
+        self.obs = adata.obs[list(columns)].reset_index(drop=True)
+        self.obs.index = self.obs.index.astype(str)
+        self.var = adata.var.copy()
+
+        if dir is None and os.path.isdir(SHM_DIR):
+            try:
+                self.path = self._write(arrays, SHM_DIR)
+            except OSError as e:
+                # e.g. the 64 MB /dev/shm of a docker container
+                logger.warning(f"Cannot share {self.nbytes / 1024**2:.0f} MB through {SHM_DIR}, using disk: {e}")
+                self.path = self._write(arrays, None)
+        else:
+            self.path = self._write(arrays, dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    @staticmethod
+    def _write(arrays: dict, dir: Optional[str]) -> str:
+        path = tempfile.mkdtemp(prefix="shared_anndata_", dir=dir)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f"{name}.npy"), array)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        return path
+
+    def __getstate__(self):
+        # Only the process that wrote the buffers removes them
+        return {key: value for key, value in self.__dict__.items() if key != "_finalizer"}
+
+    def open(self) -> anndata.AnnData:
+        """AnnData backed by read-only memory maps of the shared buffers."""
+
+        def load(name):
+            return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+        if self.sparse:
+            X = scipy.sparse.csr_matrix((load("data"), load("indices"), load("indptr")), shape=self.shape, copy=False)
+        else:
+            X = load("X")
+        return anndata.AnnData(X=X, obs=self.obs.copy(), var=self.var.copy())
+
+    def close(self):
+        """Remove the shared buffers, a no-op in processes that received the handle."""
+        finalizer = getattr(self, "_finalizer", None)
+        if finalizer is not None:
+            finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
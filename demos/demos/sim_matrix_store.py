@@ -0,0 +1,181 @@
+"""Columnar snapshots of the precomputed tissue similarity matrices.
+
+``demos/new_sim/<tissue>_similarity.xlsx`` holds one sheet per query dataset, named by the first four characters of
+its id, with the metrics (and method accuracies) as rows and the atlas datasets as columns. Reading one matrix from
+the workbook means parsing the xlsx, which dominates the ``use_sim_cache`` path of the service.
+
+The conversion tool writes one snapshot per tissue under ``<snapshot_dir>/<tissue>``:
+
+* ``values-<mtime_ns>.npy``: the matrices of all sheets stacked along the rows, over the union of their columns
+  (float64, or complex128 if any value has an imaginary part), memory-mapped when loaded
+* ``index.json``: the name of the values file, the mtime of the source workbook, the union of the columns and, per
+  query prefix, the first row, the row labels and the positions of its columns
+
+A lookup slices the memory-mapped array without parsing anything. When the snapshot is missing or older than the
+workbook, :class:`SimilarityMatrixStore` falls back to the workbook, opened once per tissue::
+
+    python -m demos.sim_matrix_store --tissue blood brain
+
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from demos import logger
+from demos.process_tissue_similarity_matrices import convert_complex_value
+
+
+def _to_number(value) -> complex:
+    value = convert_complex_value(value)
+    try:
+        return complex(value)
+    except (TypeError, ValueError):
+        return complex(np.nan)
+
+
+class SimilarityMatrixStore:
+    """Similarity matrices keyed by tissue and query prefix.
+
+    Parameters
+    ----------
+    xlsx_dir : str
+        Directory of the ``<tissue>_similarity.xlsx`` workbooks
+    snapshot_dir : Optional[str]
+        Directory of the snapshots, ``<xlsx_dir>/snapshot`` by default
+
+    """
+
+    def __init__(self, xlsx_dir: str = "demos/new_sim", snapshot_dir: Optional[str] = None):
+        self.xlsx_dir = xlsx_dir
+        self.snapshot_dir = os.path.join(xlsx_dir, "snapshot") if snapshot_dir is None else snapshot_dir
+        self._lock = threading.Lock()
+        self._snapshots: Dict[str, tuple] = {}
+        self._workbooks: Dict[str, tuple] = {}
+
+    def xlsx_path(self, tissue: str) -> str:
+        return os.path.join(self.xlsx_dir, f"{tissue}_similarity.xlsx")
+
+    def _xlsx_mtime_ns(self, tissue: str) -> Optional[int]:
+        try:
+            return os.stat(self.xlsx_path(tissue)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _snapshot(self, tissue: str) -> Optional[tuple]:
+        """``(index, values)`` of the tissue's snapshot, None if it is missing or older than the workbook."""
+        index_path = os.path.join(self.snapshot_dir, tissue, "index.json")
+        try:
+            index_mtime_ns = os.stat(index_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        cached = self._snapshots.get(tissue)
+        if cached is None or cached[0] != index_mtime_ns:
+            with open(index_path) as f:
+                index = json.load(f)
+            values = np.load(os.path.join(self.snapshot_dir, tissue, index["values"]), mmap_mode="r")
+            cached = (index_mtime_ns, index, values)
+            with self._lock:
+                self._snapshots[tissue] = cached
+        _, index, values = cached
+        xlsx_mtime_ns = self._xlsx_mtime_ns(tissue)
+        if xlsx_mtime_ns is not None and xlsx_mtime_ns != index["source_mtime_ns"]:
+            logger.warning(f"Similarity snapshot of {tissue} is older than {self.xlsx_path(tissue)}, reading the xlsx")
+            return None
+        return index, values
+
+    def _workbook(self, tissue: str) -> Optional[pd.ExcelFile]:
+        mtime_ns = self._xlsx_mtime_ns(tissue)
+        if mtime_ns is None:
+            return None
+        cached = self._workbooks.get(tissue)
+        if cached is None or cached[0] != mtime_ns:
+            cached = (mtime_ns, pd.ExcelFile(self.xlsx_path(tissue)))
+            with self._lock:
+                self._workbooks[tissue] = cached
+        return cached[1]
+
+    def query_prefixes(self, tissue: str) -> List[str]:
+        snapshot = self._snapshot(tissue)
+        if snapshot is not None:
+            return list(snapshot[0]["sheets"])
+        workbook = self._workbook(tissue)
+        return [] if workbook is None else list(workbook.sheet_names)
+
+    def get(self, tissue: str, query_prefix: str) -> Optional[pd.DataFrame]:
+        """Similarity matrix of the query dataset, metrics by atlas datasets, None if there is none."""
+        snapshot = self._snapshot(tissue)
+        if snapshot is not None:
+            index, values = snapshot
+            sheet = index["sheets"].get(query_prefix)
+            if sheet is None:
+                return None
+            rows = slice(sheet["start"], sheet["start"] + len(sheet["rows"]))
+            return pd.DataFrame(values[rows][:, sheet["columns"]], index=sheet["rows"],
+                                columns=[index["columns"][i] for i in sheet["columns"]])
+        workbook = self._workbook(tissue)
+        if workbook is None or query_prefix not in workbook.sheet_names:
+            return None
+        return workbook.parse(sheet_name=query_prefix, index_col=0)
+
+    def write_snapshot(self, tissue: str):
+        """Convert the tissue's workbook into a snapshot."""
+        mtime_ns = self._xlsx_mtime_ns(tissue)
+        if mtime_ns is None:
+            raise FileNotFoundError(self.xlsx_path(tissue))
+        sheets = pd.read_excel(self.xlsx_path(tissue), sheet_name=None, index_col=0)
+        columns = list(dict.fromkeys(col for sim_data in sheets.values() for col in sim_data.columns))
+        positions = {col: i for i, col in enumerate(columns)}
+        values = np.full((sum(len(sim_data) for sim_data in sheets.values()), len(columns)), np.nan, dtype=complex)
+        index = {"source_mtime_ns": mtime_ns, "values": f"values-{mtime_ns}.npy", "columns": columns, "sheets": {}}
+        start = 0
+        for query_prefix, sim_data in sheets.items():
+            sheet_columns = [positions[col] for col in sim_data.columns]
+            values[start:start + len(sim_data), sheet_columns] = sim_data.applymap(_to_number).to_numpy()
+            index["sheets"][query_prefix] = {
+                "start": start,
+                "rows": [str(row) for row in sim_data.index],
+                "columns": sheet_columns,
+            }
+            start += len(sim_data)
+        if not np.iscomplex(values).any():
+            values = values.real
+
+        tissue_dir = os.path.join(self.snapshot_dir, tissue)
+        os.makedirs(tissue_dir, exist_ok=True)
+        # The values file is named by the workbook version, so readers of the previous index keep a valid file
+        np.save(os.path.join(tissue_dir, index["values"]), values)
+        tmp_path = os.path.join(tissue_dir, "index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(tissue_dir, "index.json"))
+        for path in glob.glob(os.path.join(tissue_dir, "values-*.npy")):
+            if os.path.basename(path) != index["values"]:
+                os.remove(path)
+        logger.info(f"Wrote {len(sheets)} similarity matrices of {tissue} to {tissue_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the tissue similarity workbooks into columnar snapshots")
+    parser.add_argument("--tissue", nargs="+", help="Tissues to convert, all workbooks of --xlsx-dir by default")
+    parser.add_argument("--xlsx-dir", default="demos/new_sim")
+    parser.add_argument("--snapshot-dir")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    store = SimilarityMatrixStore(args.xlsx_dir, snapshot_dir=args.snapshot_dir)
+    tissues = args.tissue or sorted(
+        os.path.basename(path)[:-len("_similarity.xlsx")]
+        for path in glob.glob(os.path.join(args.xlsx_dir, "*_similarity.xlsx")))
+    for tissue in tissues:
+        store.write_snapshot(tissue)
+
+
+if __name__ == "__main__":
+    main()
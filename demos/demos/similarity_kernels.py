@@ -0,0 +1,341 @@
+"""Blocked pairwise kernels used by :class:`~demos.anndata_similarity.AnnDataSimilarity`.
+
+The kernels in this module never materialize more than one tile of a pairwise computation at a time, so the peak
+memory of a metric is bounded by ``max_tile_bytes`` instead of growing with the number of cells. Inputs may be dense
+arrays or scipy sparse matrices; sparse inputs are only densified one row block at a time.
+
+"""
+from typing import Callable, Dict, Optional
+
+import numpy as np
+import ot
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist
+from scipy.special import xlogy
+from sklearn.metrics.pairwise import euclidean_distances
+
+DEFAULT_MAX_TILE_BYTES = 64 * 1024**2
+
+
+def iter_blocks(n: int, block_size: int):
+    """Yield ``(start, stop)`` bounds splitting ``range(n)`` into consecutive blocks."""
+    block_size = max(int(block_size), 1)
+    for start in range(0, n, block_size):
+        yield start, min(start + block_size, n)
+
+
+def dense_rows(X, start: int, stop: int) -> np.ndarray:
+    """Return rows ``start:stop`` of a dense or sparse matrix as a dense float64 array."""
+    block = X[start:stop]
+    if sp.issparse(block):
+        block = block.toarray()
+    return np.asarray(block, dtype=np.float64)
+
+
+def row_normalize(X):
+    """Rescale the rows of a dense or sparse matrix to sum to one, leaving all-zero rows at zero.
+
+    Sparse input stays sparse (CSR, float64), which is what the sparse execution mode of
+    :class:`~demos.anndata_similarity.AnnDataSimilarity` relies on.
+
+    """
+    row_sums = np.asarray(X.sum(axis=1), dtype=np.float64).ravel()
+    scale = np.divide(1.0, row_sums, out=np.zeros_like(row_sums), where=row_sums != 0)
+    if sp.issparse(X):
+        return sp.csr_matrix(sp.diags(scale) @ X, dtype=np.float64)
+    return np.asarray(X, dtype=np.float64) * scale[:, None]
+
+
+def _sparse_euclidean(metric: str) -> bool:
+    return metric in ("euclidean", "sqeuclidean")
+
+
+def _tile_rows(X, start: int, stop: int, metric: str):
+    """Row block of ``X``, kept sparse when the distance can be computed from sparse dot products."""
+    if sp.issparse(X) and _sparse_euclidean(metric):
+        return X[start:stop]
+    return dense_rows(X, start, stop)
+
+
+def _distance_tile(A, B, metric: str) -> np.ndarray:
+    if sp.issparse(A) and _sparse_euclidean(metric):
+        # ||a||^2 + ||b||^2 - 2 <a, b> on the sparse blocks; sklearn zeroes the diagonal when A is B
+        return euclidean_distances(A, B, squared=metric == "sqeuclidean")
+    return cdist(A, B, metric)
+
+
+def _square_block_size(n_features: int, n_buffers: int, max_tile_bytes: int) -> int:
+    """Largest ``b`` such that ``n_buffers`` float64 tiles of shape ``(b, b, n_features)`` fit the budget."""
+    per_pair = max(n_features, 1) * np.dtype(np.float64).itemsize * n_buffers
+    return max(int(np.sqrt(max_tile_bytes / per_pair)), 1)
+
+
+def _row_normalize(P: np.ndarray) -> np.ndarray:
+    # Same convention as scipy.spatial.distance.jensenshannon: rows are rescaled to sum to one, all-zero rows
+    # become NaN and propagate to every divergence they take part in.
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return P / P.sum(axis=1, keepdims=True)
+
+
+def js_divergence_matrix(X, Y, max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES, base=None) -> np.ndarray:
+    """Compute the Jensen-Shannon distance between every row of ``X`` and every row of ``Y``.
+
+    The result is identical to calling :func:`scipy.spatial.distance.jensenshannon` on each pair of rows, but the
+    matrix is computed tile by tile with broadcasting instead of one pair at a time.
+
+    Parameters
+    ----------
+    X
+        Dense or sparse matrix of shape ``(n, g)`` with non-negative entries.
+    Y
+        Dense or sparse matrix of shape ``(m, g)`` with non-negative entries.
+    max_tile_bytes
+        Upper bound on the memory used by the temporaries of a single tile.
+    base
+        Logarithm base, as in :func:`~scipy.spatial.distance.jensenshannon`. Natural logarithm if ``None``.
+
+    Returns
+    -------
+    np.ndarray
+        Matrix of shape ``(n, m)`` holding the pairwise Jensen-Shannon distances.
+
+    """
+    if X.shape[1] != Y.shape[1]:
+        raise ValueError(f"X and Y must have the same number of columns, got {X.shape[1]} and {Y.shape[1]}")
+    n, m, g = X.shape[0], Y.shape[0], X.shape[1]
+    # With m = (p + q) / 2 and both rows summing to one, 2 * JS(p, q) = 2 log 2 + sum(p log p) + sum(q log q)
+    # - sum((p + q) log(p + q)). Only the last sum depends on the pair, so each tile costs one log per entry.
+    # Two (b, b, g) temporaries live at the same time: p + q and its xlogy.
+    block_size = _square_block_size(g, 2, max_tile_bytes)
+    out = np.empty((n, m), dtype=np.float64)
+    for y_start, y_stop in iter_blocks(m, block_size):
+        Q = _row_normalize(dense_rows(Y, y_start, y_stop))
+        neg_entropy_q = xlogy(Q, Q).sum(axis=1)
+        for x_start, x_stop in iter_blocks(n, block_size):
+            P = _row_normalize(dense_rows(X, x_start, x_stop))
+            neg_entropy_p = xlogy(P, P).sum(axis=1)
+            S = P[:, None, :] + Q[None, :, :]
+            js = 2 * np.log(2) + neg_entropy_p[:, None] + neg_entropy_q[None, :] - xlogy(S, S).sum(axis=2)
+            # Rounding can push identical distributions slightly below zero
+            js = np.maximum(js, 0.0)
+            if base is not None:
+                js /= np.log(base)
+            out[x_start:x_stop, y_start:y_stop] = np.sqrt(js / 2.0)
+    return out
+
+
+def _pairwise_block_size(n_features: int, max_tile_bytes: int) -> int:
+    """Largest ``b`` such that two ``(b, g)`` row blocks and two ``(b, b)`` tiles fit the budget."""
+    # 16 * b^2 + 16 * g * b <= max_tile_bytes
+    g = max(n_features, 1)
+    return max(int((-g + np.sqrt(g * g + max_tile_bytes / 4)) / 2), 1)
+
+
+def pairwise_sums(X, Y=None, metric: str = "euclidean", funcs: Optional[Dict[str, Callable]] = None,
+                  exclude_diagonal: bool = False, max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES) -> Dict[str, float]:
+    """Sum several transformations of the pairwise distances in a single tiled pass.
+
+    Distances are computed with :func:`scipy.spatial.distance.cdist` on one tile at a time and only running sums are
+    kept, so each result matches summing the dense ``cdist`` matrix up to floating point reordering. Euclidean
+    distances between sparse matrices are computed from sparse dot products instead, without densifying the rows.
+
+    Parameters
+    ----------
+    X
+        Dense or sparse matrix of shape ``(n, g)``.
+    Y
+        Dense or sparse matrix of shape ``(m, g)``. If ``None``, sum over the pairs of rows of ``X`` with itself and
+        only evaluate the upper triangle of tiles.
+    metric
+        Distance passed to :func:`~scipy.spatial.distance.cdist`.
+    funcs
+        Mapping from result name to an elementwise transformation of a distance tile, e.g. an RBF kernel. ``None``
+        stands for the identity. Defaults to ``{"sum": None}``.
+    exclude_diagonal
+        Leave out the ``d(x_i, x_i)`` terms. Only valid when ``Y`` is ``None``.
+    max_tile_bytes
+        Upper bound on the memory used by the row blocks and temporaries of a single tile.
+
+    Returns
+    -------
+    Dict[str, float]
+        The sum over all (off-diagonal, if requested) pairs for each entry of ``funcs``.
+
+    """
+    funcs = {"sum": None} if funcs is None else funcs
+    symmetric = Y is None
+    if exclude_diagonal and not symmetric:
+        raise ValueError("exclude_diagonal is only supported for the sum of X against itself")
+    Y = X if symmetric else Y
+    if X.shape[1] != Y.shape[1]:
+        raise ValueError(f"X and Y must have the same number of columns, got {X.shape[1]} and {Y.shape[1]}")
+    block_size = _pairwise_block_size(X.shape[1], max_tile_bytes)
+    totals = dict.fromkeys(funcs, 0.0)
+    for y_start, y_stop in iter_blocks(Y.shape[0], block_size):
+        B = _tile_rows(Y, y_start, y_stop, metric)
+        for x_start, x_stop in iter_blocks(X.shape[0], block_size):
+            if symmetric and x_start > y_start:
+                break
+            A = B if symmetric and x_start == y_start else _tile_rows(X, x_start, x_stop, metric)
+            dist = _distance_tile(A, B, metric)
+            for name, func in funcs.items():
+                tile = dist if func is None else func(dist)
+                if symmetric and x_start == y_start:
+                    tile_sum = tile.sum() - (np.trace(tile) if exclude_diagonal else 0.0)
+                elif symmetric:
+                    # Off-diagonal tiles stand for themselves and their transpose
+                    tile_sum = 2 * tile.sum()
+                else:
+                    tile_sum = tile.sum()
+                totals[name] += tile_sum
+    return {name: float(total) for name, total in totals.items()}
+
+
+def pairwise_sum(X, Y=None, metric: str = "euclidean", func: Optional[Callable] = None,
+                 exclude_diagonal: bool = False, max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES) -> float:
+    """Single transformation version of :func:`pairwise_sums`."""
+    return pairwise_sums(X, Y, metric=metric, funcs={"sum": func}, exclude_diagonal=exclude_diagonal,
+                         max_tile_bytes=max_tile_bytes)["sum"]
+
+
+def pairwise_mean(X, Y=None, metric: str = "euclidean", func=None, exclude_diagonal: bool = False,
+                  max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES) -> float:
+    """Mean counterpart of :func:`pairwise_sum`, normalized by the number of pairs summed."""
+    n = X.shape[0]
+    m = n if Y is None else Y.shape[0]
+    n_pairs = n * (n - 1) if exclude_diagonal else n * m
+    return pairwise_sum(X, Y, metric=metric, func=func, exclude_diagonal=exclude_diagonal,
+                        max_tile_bytes=max_tile_bytes) / n_pairs
+
+
+def nearest_distances(X, Y, max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES):
+    """Euclidean distance from each row of ``X`` to its nearest row of ``Y``, and vice versa, computed tile by tile.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Arrays of length ``n`` and ``m`` with the nearest neighbour distances of the rows of ``X`` and ``Y``.
+
+    """
+    block_size = _pairwise_block_size(X.shape[1], max_tile_bytes)
+    x_to_y = np.full(X.shape[0], np.inf)
+    y_to_x = np.full(Y.shape[0], np.inf)
+    for y_start, y_stop in iter_blocks(Y.shape[0], block_size):
+        B = _tile_rows(Y, y_start, y_stop, "euclidean")
+        for x_start, x_stop in iter_blocks(X.shape[0], block_size):
+            dist = _distance_tile(_tile_rows(X, x_start, x_stop, "euclidean"), B, "euclidean")
+            np.minimum(x_to_y[x_start:x_stop], dist.min(axis=1), out=x_to_y[x_start:x_stop])
+            np.minimum(y_to_x[y_start:y_stop], dist.min(axis=0), out=y_to_x[y_start:y_stop])
+    return x_to_y, y_to_x
+
+
+def covariance(X) -> np.ndarray:
+    """Feature covariance matrix, same as ``np.cov(X, rowvar=False)``.
+
+    Sparse input is densified: the result is a dense ``(g, g)`` matrix anyway, and the sparse Gram matrix of
+    expression data fills in, so it takes more memory than the dense rows.
+
+    """
+    return np.cov(X.toarray() if sp.issparse(X) else X, rowvar=False)
+
+
+def _column_mean(X) -> np.ndarray:
+    return np.asarray(X.mean(axis=0)).ravel()
+
+
+def shared_pca_basis(X, Y, rank: int, n_oversamples: int = 10, n_iter: int = 4,
+                     random_state: Optional[int] = None) -> np.ndarray:
+    """Orthonormal ``(n_features, rank)`` basis of the top principal directions of ``X`` and ``Y`` together.
+
+    Randomized range finder with power iterations on the stacked matrix of the two datasets, each centered on its own
+    mean, so the basis spans the directions carrying most of the variance within either dataset. Centering is applied
+    implicitly through the products, which keeps sparse input sparse.
+
+    """
+    means = [_column_mean(Z) for Z in (X, Y)]
+    n_features = X.shape[1]
+    n_components = min(rank + n_oversamples, n_features)
+
+    def matmul(M):
+        # [X - mean_X; Y - mean_Y] @ M
+        return np.vstack([np.asarray(Z @ M) - mean @ M for Z, mean in zip((X, Y), means)])
+
+    def rmatmul(N):
+        # [X - mean_X; Y - mean_Y].T @ N
+        N_X, N_Y = N[:X.shape[0]], N[X.shape[0]:]
+        return sum(
+            np.asarray(Z.T @ N_Z) - np.outer(mean, N_Z.sum(axis=0)) for Z, N_Z, mean in zip((X, Y), (N_X, N_Y), means))
+
+    rng = np.random.default_rng(random_state)
+    Q, _ = np.linalg.qr(matmul(rng.standard_normal((n_features, n_components))))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(rmatmul(Q))
+        Q, _ = np.linalg.qr(matmul(Q))
+    _, _, Vt = np.linalg.svd(rmatmul(Q).T, full_matrices=False)
+    return Vt[:rank].T
+
+
+def sqrtm_psd(C: np.ndarray) -> np.ndarray:
+    """Real square root of a symmetric positive semi-definite matrix, negative round-off eigenvalues clipped."""
+    eigvals, eigvecs = np.linalg.eigh(C)
+    return (eigvecs * np.sqrt(np.clip(eigvals, 0, None))) @ eigvecs.T
+
+
+def sliced_wasserstein_distance(X, Y, n_projections: int = 200, seed: Optional[int] = 0, p: int = 1) -> float:
+    """Sliced p-Wasserstein distance between the uniform distributions over the rows of ``X`` and ``Y``.
+
+    Both point clouds are projected onto ``n_projections`` random directions and the one-dimensional transport
+    problems are solved by sorting, in ``O(n_projections * n log n)`` instead of the cubic exact ``ot.emd2``. The
+    default ``p=1`` matches the order of the exact ``wasserstein`` metric, which uses a Euclidean ground cost. The
+    directions only depend on ``seed`` and the number of features, so scoring the same pair with the same seed is
+    reproducible. Sparse input stays sparse, only the projections are dense.
+
+    """
+    rng = np.random.default_rng(seed)
+    projections = rng.standard_normal((X.shape[1], n_projections))
+    projections /= np.linalg.norm(projections, axis=0)
+    costs = ot.wasserstein_1d(np.asarray(X @ projections), np.asarray(Y @ projections), p=p)
+    return float(np.mean(costs)**(1 / p))
+
+
+def _row_dot(A, B) -> np.ndarray:
+    prod = A @ B.T
+    return prod.toarray() if sp.issparse(prod) else np.asarray(prod)
+
+
+def _row_sq_norms(A) -> np.ndarray:
+    return np.asarray(A.multiply(A).sum(axis=1) if sp.issparse(A) else np.square(A).sum(axis=1)).ravel()
+
+
+def row_corrcoef(A, B) -> np.ndarray:
+    """Pearson correlation between every row of ``A`` and every row of ``B``.
+
+    Equivalent to the off-diagonal block of ``np.corrcoef(A, B)`` but computed from (sparse) dot products, without
+    centering, and therefore without densifying, the inputs. Constant rows yield NaN, as in :func:`numpy.corrcoef`.
+
+    """
+    A = A.astype(np.float64)
+    B = B.astype(np.float64)
+    g = A.shape[1]
+    mean_a = np.asarray(A.mean(axis=1)).ravel()
+    mean_b = np.asarray(B.mean(axis=1)).ravel()
+    cov = _row_dot(A, B) / g - np.outer(mean_a, mean_b)
+    std_a = np.sqrt(np.maximum(_row_sq_norms(A) / g - mean_a**2, 0))
+    std_b = np.sqrt(np.maximum(_row_sq_norms(B) / g - mean_b**2, 0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.outer(std_a, std_b)
+    return np.clip(corr, -1, 1)
+
+
+def jaccard_similarity_matrix(A, B, threshold: float = 0.5) -> np.ndarray:
+    """Jaccard similarity between the binarized (``> threshold``) rows of ``A`` and ``B``.
+
+    Matches ``1 - cdist(A > threshold, B > threshold, metric="jaccard")``, including a similarity of one for two
+    all-zero rows, using sparse intersection counts.
+
+    """
+    binary_a = sp.csr_matrix(A > threshold, dtype=np.float64)
+    binary_b = sp.csr_matrix(B > threshold, dtype=np.float64)
+    intersection = (binary_a @ binary_b.T).toarray()
+    union = binary_a.getnnz(axis=1)[:, None] + binary_b.getnnz(axis=1)[None, :] - intersection
+    return np.divide(intersection, union, out=np.ones_like(intersection), where=union != 0)
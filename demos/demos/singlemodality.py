@@ -19,7 +19,7 @@ from demos.download import download_unzip,download_file
 from demos.base import BaseDataset
 from demos.registry import register_dataset
 def _load_scdeepsort_metadata():
-    path = "demos/scdeepsort.csv"
+    path = os.path.join(os.path.dirname(__file__), "scdeepsort.csv")
     logger.debug(f"Loading scdeepsort metadata from {path}")
     scdeepsort_meta_df = pd.read_csv(path).astype(str)
 
@@ -0,0 +1,515 @@
+"""Local mirror of the W&B sweeps the service reads accuracies from.
+
+Ranking atlas datasets with a ``sweep_dict`` needs, for every annotation method, the sweep graph (a sweep lists the
+sweeps it continues through the ``--additional_sweep_ids`` argument of its runs), the config of every run and its
+``test_acc``. Fetching these from the W&B API takes one request per sweep plus paging through every run.
+:class:`SweepMirror` stores them in a SQLite database, one row per sweep, and is filled by a sync job that fetches
+sweeps in parallel and refreshes those older than a TTL::
+
+    python -m demos.sweep_mirror --from-atlas-config
+    python -m demos.sweep_mirror --sweep-ids rx5nefnc l2m0ex0v --ttl 3600
+
+The ``test_acc`` lists of the former ``cache/sweep_cache.json`` of ``get_runs`` are imported once with::
+
+    python -m demos.sweep_mirror --migrate-json demos/cache/sweep_cache.json
+
+Imported sweeps have no run configs, they serve ``test_acc`` readers (``get_runs``) after their sweep graph is
+fetched, which takes a single finished run instead of paging through every run of the sweep.
+
+Sweeps are fetched from a source: :class:`WandbSource` for the W&B API, or :class:`FileWandbSource`, a fake of the
+API reading the same data from a directory, for tests and offline runs.
+
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from demos import logger
+from demos.settings import entity, project
+from demos.utils import spilt_web, try_import
+
+DEFAULT_MIRROR_PATH = os.path.join(os.path.dirname(__file__), "cache", "sweep_mirror.sqlite")
+DEFAULT_TTL = 24 * 3600
+
+
+class SweepNotMirroredError(KeyError):
+    """A sweep was read from the mirror before being synced."""
+
+
+class MirroredRun:
+    """Run of a mirrored sweep, with the attributes of a ``wandb`` run the service reads.
+
+    ``summary`` only holds ``test_acc``, if the run logged it.
+
+    """
+
+    def __init__(self, id: str, state: str, config: Dict[str, Any], summary: Dict[str, Any]):
+        self.id = id
+        self.state = state
+        self.config = config
+        self.summary = summary
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MirroredRun":
+        return cls(data["id"], data["state"], data["config"], data["summary"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "state": self.state, "config": self.config, "summary": self.summary}
+
+
+def additional_sweep_ids(args: List[str]) -> List[str]:
+    """Sweep ids following ``--additional_sweep_ids`` in the command line arguments of a run."""
+    return [args[i + 1] for i in range(len(args) - 1) if args[i] == "--additional_sweep_ids"]
+
+
+def _summary(summary) -> Dict[str, Any]:
+    return {"test_acc": summary["test_acc"]} if "test_acc" in summary else {}
+
+
+class WandbSource:
+    """Sweeps fetched from the W&B API.
+
+    Parameters
+    ----------
+    entity : str
+        W&B entity of the sweeps
+    project : str
+        W&B project of the sweeps
+    timeout : Optional[int]
+        Timeout in seconds of the API requests
+
+    """
+
+    def __init__(self, entity: str = entity, project: str = project, timeout: Optional[int] = 60):
+        self.entity = entity
+        self.project = project
+        self.timeout = timeout
+
+    def sweep_runs(self, sweep_id: str) -> List[MirroredRun]:
+        wandb = try_import("wandb")
+        sweep = wandb.Api(timeout=self.timeout).sweep(f"{self.entity}/{self.project}/{sweep_id}")
+        return [MirroredRun(run.id, run.state, dict(run.config), _summary(run.summary)) for run in sweep.runs]
+
+    def finished_run_id(self, sweep_id: str) -> Optional[str]:
+        wandb = try_import("wandb")
+        runs = wandb.Api(timeout=self.timeout).runs(f"{self.entity}/{self.project}",
+                                                    filters={"sweep": sweep_id, "state": "finished"}, per_page=1)
+        return next((run.id for run in runs), None)
+
+    def run_args(self, run_id: str) -> List[str]:
+        requests = try_import("requests")
+        response = requests.get(f"https://api.wandb.ai/files/{self.entity}/{self.project}/{run_id}/wandb-metadata.json",
+                                timeout=self.timeout)
+        response.raise_for_status()
+        return list(response.json()["args"])
+
+
+class FileWandbSource:
+    """Fake of the W&B API reading sweeps from a directory.
+
+    The directory mirrors what the API returns::
+
+        <root>/sweeps/<sweep_id>.json                   {"runs": [{"id", "state", "config", "summary"}, ...]}
+        <root>/files/<run_id>/wandb-metadata.json       {"args": [...]}
+
+    Parameters
+    ----------
+    root : str
+        Directory holding the sweeps
+    delay : float
+        Seconds every call sleeps, to simulate the latency of the API
+
+    """
+
+    def __init__(self, root: str, delay: float = 0.0):
+        self.root = root
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _read(self, *parts) -> Any:
+        with self._lock:
+            self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        with open(os.path.join(self.root, *parts)) as f:
+            return json.load(f)
+
+    def sweep_runs(self, sweep_id: str) -> List[MirroredRun]:
+        return [
+            MirroredRun(run["id"], run["state"], run["config"], _summary(run["summary"]))
+            for run in self._read("sweeps", f"{sweep_id}.json")["runs"]
+        ]
+
+    def finished_run_id(self, sweep_id: str) -> Optional[str]:
+        runs = self._read("sweeps", f"{sweep_id}.json")["runs"]
+        return next((run["id"] for run in runs if run["state"] == "finished"), None)
+
+    def run_args(self, run_id: str) -> List[str]:
+        return self._read("files", run_id, "wandb-metadata.json")["args"]
+
+
+class SweepMirror:
+    """SQLite store of sweep graphs, run configs and ``test_acc`` summaries.
+
+    The database is in WAL mode, so readers never block the writer. Each sweep is one row that :meth:`sync` upserts
+    atomically, which makes the store safe for concurrent joblib workers, uvicorn workers and sync jobs. The database
+    file is created on first use, not when the mirror is constructed.
+
+    Parameters
+    ----------
+    path : str
+        SQLite database file
+    ttl : float
+        Age in seconds after which :meth:`sync` fetches a mirrored sweep again
+    timeout : float
+        Seconds a write waits for the database lock held by another connection
+
+    """
+
+    def __init__(self, path: str = DEFAULT_MIRROR_PATH, ttl: float = DEFAULT_TTL, timeout: float = 30.0):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._has_schema = False
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, every thread opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._has_schema:
+                    self._create_schema(conn)
+                    self._has_schema = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection):
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sweeps (
+                    sweep_id TEXT PRIMARY KEY,
+                    fetched_at REAL NOT NULL,
+                    additional_sweep_ids TEXT,
+                    runs TEXT,
+                    test_accs TEXT NOT NULL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS migrations (
+                    source TEXT PRIMARY KEY,
+                    migrated_at REAL NOT NULL,
+                    sweeps INTEGER NOT NULL
+                )""")
+
+    @staticmethod
+    def _record(row) -> Dict[str, Any]:
+        sweep_id, fetched_at, additional, runs, test_accs = row
+        return {
+            "sweep_id": sweep_id,
+            "fetched_at": fetched_at,
+            "additional_sweep_ids": None if additional is None else json.loads(additional),
+            "runs": None if runs is None else json.loads(runs),
+            "test_accs": json.loads(test_accs),
+        }
+
+    def records(self, sweep_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Mirrored sweeps among ``sweep_ids``, read in batches.
+
+        Each record has the keys ``fetched_at``, ``additional_sweep_ids``, ``runs`` and ``test_accs``. Sweeps migrated
+        from ``sweep_cache.json`` only have ``test_accs``, ``additional_sweep_ids`` is None until their graph is
+        fetched and ``runs`` is None until they are synced with ``runs=True``.
+
+        """
+        sweep_ids = list(dict.fromkeys(sweep_ids))
+        records = {}
+        conn = self._connection()
+        # Stay below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+        for start in range(0, len(sweep_ids), 500):
+            chunk = sweep_ids[start:start + 500]
+            rows = conn.execute(
+                "SELECT sweep_id, fetched_at, additional_sweep_ids, runs, test_accs FROM sweeps "
+                f"WHERE sweep_id IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+            records.update((row[0], self._record(row)) for row in rows)
+        return records
+
+    def record(self, sweep_id: str) -> Optional[Dict[str, Any]]:
+        """Mirrored sweep, None if missing."""
+        return self.records([sweep_id]).get(sweep_id)
+
+    def _put(self, sweep_id: str, record: Dict[str, Any]):
+        test_accs = [run["summary"].get("test_acc", 0) for run in record["runs"]]
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO sweeps (sweep_id, fetched_at, additional_sweep_ids, runs, test_accs) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (sweep_id) DO UPDATE SET fetched_at = excluded.fetched_at, "
+                "additional_sweep_ids = excluded.additional_sweep_ids, runs = excluded.runs, "
+                "test_accs = excluded.test_accs",
+                (sweep_id, record["fetched_at"], json.dumps(record["additional_sweep_ids"]),
+                 json.dumps(record["runs"]), json.dumps(test_accs)))
+
+    def fetch(self, source, sweep_id: str) -> Dict[str, Any]:
+        """Fetch a sweep from ``source`` and store it.
+
+        Like :func:`demos.pipeline.get_additional_sweep`, the sweeps it continues are read from the arguments of its
+        first finished run.
+
+        """
+        runs = source.sweep_runs(sweep_id)
+        run = next((run for run in runs if run.state == "finished"), None)
+        record = {
+            "sweep_id": sweep_id,
+            "fetched_at": time.time(),
+            "additional_sweep_ids": [] if run is None else additional_sweep_ids(source.run_args(run.id)),
+            "runs": [run.to_dict() for run in runs],
+        }
+        self._put(sweep_id, record)
+        return record
+
+    def fetch_graph(self, source, sweep_id: str) -> Dict[str, Any]:
+        """Fetch the sweeps a mirrored sweep continues, without its runs, and store them.
+
+        Completes sweeps migrated from ``sweep_cache.json`` for :meth:`test_accs` with one finished run lookup instead
+        of paging through every run.
+
+        """
+        run_id = source.finished_run_id(sweep_id)
+        additional = [] if run_id is None else additional_sweep_ids(source.run_args(run_id))
+        with self._connection() as conn:
+            conn.execute("UPDATE sweeps SET additional_sweep_ids = ? WHERE sweep_id = ?",
+                         (json.dumps(additional), sweep_id))
+        record = self.record(sweep_id)
+        if record is None:
+            raise SweepNotMirroredError(sweep_id)
+        return record
+
+    @staticmethod
+    def _complete(record: Optional[Dict[str, Any]], runs: bool = True) -> bool:
+        """Whether ``record`` has its sweep graph, and its runs if ``runs``."""
+        if record is None or record["additional_sweep_ids"] is None:
+            return False
+        return not runs or record["runs"] is not None
+
+    def sync(self, source, sweep_ids: Iterable[str], max_workers: int = 8, force: bool = False,
+             runs: bool = True) -> Dict[str, Any]:
+        """Mirror ``sweep_ids`` and the sweeps they continue, fetching missing and expired sweeps in parallel.
+
+        Parameters
+        ----------
+        source : WandbSource or FileWandbSource
+            Where sweeps are fetched from
+        sweep_ids : Iterable[str]
+            Sweeps to mirror
+        max_workers : int
+            Number of sweeps fetched at the same time
+        force : bool
+            Fetch every sweep again regardless of its age
+        runs : bool
+            Whether the runs are needed. If False, sweeps migrated from ``sweep_cache.json`` only get their sweep
+            graph fetched and are kept regardless of their age.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Fetched and still fresh sweep ids, and the error of every sweep that could not be fetched
+
+        """
+        report = {"fetched": [], "fresh": [], "failed": {}}
+        seen = set()
+        frontier = list(dict.fromkeys(sweep_ids))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Breadth-first over the sweep graph, the sweeps of one level are fetched in parallel
+            while frontier:
+                seen.update(frontier)
+                records, futures = self.records(frontier), {}
+                for sweep_id in frontier:
+                    record = records.pop(sweep_id, None)
+                    if force or record is None or runs and not self._complete(record):
+                        fetch = self.fetch
+                    elif record["runs"] is None:
+                        # Migrated from sweep_cache.json: its test_accs do not expire, only its graph may be missing
+                        fetch = None if self._complete(record, runs=False) else self.fetch_graph
+                    else:
+                        fetch = self.fetch if time.time() - record["fetched_at"] > self.ttl else None
+                    if fetch is None:
+                        records[sweep_id] = record
+                        report["fresh"].append(sweep_id)
+                    else:
+                        futures[executor.submit(fetch, source, sweep_id)] = sweep_id
+                for future in concurrent.futures.as_completed(futures):
+                    sweep_id = futures[future]
+                    try:
+                        records[sweep_id] = future.result()
+                        report["fetched"].append(sweep_id)
+                    except Exception as e:
+                        logger.warning(f"Cannot fetch sweep {sweep_id}: {e}")
+                        report["failed"][sweep_id] = str(e)
+                frontier = list(dict.fromkeys(
+                    child for record in records.values() for child in record["additional_sweep_ids"]
+                    if child not in seen))
+        return report
+
+    def sweep_ids(self, sweep_id: str, source=None, runs: bool = True) -> List[str]:
+        """``sweep_id`` and the sweeps it continues, recursively, in the order of ``get_additional_sweep``.
+
+        Sweeps missing from the mirror, or without their runs if ``runs``, are synced from ``source`` if given,
+        otherwise :class:`SweepNotMirroredError` is raised. Pass ``runs=False`` when only :meth:`test_accs` is read.
+
+        """
+        records = {}
+        frontier = [sweep_id]
+        while frontier:
+            records.update(self.records(frontier))
+            missing = [current for current in frontier if not self._complete(records.get(current), runs)]
+            if missing and source is not None:
+                self.sync(source, missing, runs=runs)
+                records.update(self.records(missing))
+                missing = [current for current in missing if not self._complete(records.get(current), runs)]
+            if missing:
+                raise SweepNotMirroredError(missing[0])
+            frontier = list(dict.fromkeys(
+                child for current in frontier for child in records[current]["additional_sweep_ids"]
+                if child not in records))
+        order = []
+
+        def visit(current):
+            if current in order:
+                return
+            order.append(current)
+            for child in records[current]["additional_sweep_ids"]:
+                visit(child)
+
+        visit(sweep_id)
+        return order
+
+    def runs(self, sweep_ids: Iterable[str]) -> List[MirroredRun]:
+        """Runs of all ``sweep_ids``, which must be mirrored."""
+        sweep_ids = list(sweep_ids)
+        records = self.records(sweep_ids)
+        runs = []
+        for sweep_id in sweep_ids:
+            if not self._complete(records.get(sweep_id)):
+                raise SweepNotMirroredError(sweep_id)
+            runs.extend(MirroredRun.from_dict(run) for run in records[sweep_id]["runs"])
+        return runs
+
+    def test_accs(self, sweep_ids: Iterable[str]) -> List[float]:
+        """``test_acc`` of every run of ``sweep_ids``, 0 for runs that did not log it."""
+        sweep_ids = list(sweep_ids)
+        records = self.records(sweep_ids)
+        accs = []
+        for sweep_id in sweep_ids:
+            if sweep_id not in records:
+                raise SweepNotMirroredError(sweep_id)
+            accs.extend(records[sweep_id]["test_accs"])
+        return accs
+
+    def migrate_json(self, json_path: str, force: bool = False) -> int:
+        """Import the ``{sweep_id: [test_acc, ...]}`` cache of ``get_runs`` (``cache/sweep_cache.json``).
+
+        The JSON cache has the ``test_acc`` of every run but neither the sweep graph nor the run configs. Imported
+        sweeps serve :meth:`test_accs` once :meth:`fetch_graph` fetched their graph, and are fully fetched only by a
+        :meth:`sync` that needs their runs. Sweeps already mirrored are kept.
+
+        The import is recorded in the mirror, importing the same file again is a no-op unless ``force``.
+
+        Returns
+        -------
+        int
+            Number of imported sweeps
+
+        """
+        source = os.path.realpath(json_path)
+        conn = self._connection()
+        if not force and conn.execute("SELECT 1 FROM migrations WHERE source = ?", (source, )).fetchone():
+            return 0
+        with open(json_path) as f:
+            sweep_cache = json.load(f)
+        with conn:
+            imported = conn.executemany(
+                "INSERT OR IGNORE INTO sweeps (sweep_id, fetched_at, test_accs) VALUES (?, 0, ?)",
+                [(sweep_id, json.dumps(accs)) for sweep_id, accs in sweep_cache.items()]).rowcount
+            conn.execute("INSERT OR REPLACE INTO migrations (source, migrated_at, sweeps) VALUES (?, ?, ?)",
+                         (source, time.time(), imported))
+        logger.info(f"Imported {imported} of {len(sweep_cache)} sweeps from {json_path}")
+        return imported
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        n_sweeps, n_partial, n_expired, oldest = self._connection().execute(
+            "SELECT COUNT(*), SUM(runs IS NULL), SUM(runs IS NOT NULL AND ? - fetched_at > ?), "
+            "MAX(CASE WHEN runs IS NOT NULL THEN ? - fetched_at END) FROM sweeps",
+            (now, self.ttl, now)).fetchone()
+        return {
+            "sweeps": n_sweeps,
+            "migrated_only": n_partial or 0,
+            "expired": n_expired or 0,
+            "oldest_age": oldest,
+            "ttl": self.ttl,
+        }
+
+
+def atlas_config_sweep_ids(atlas_config) -> List[str]:
+    """Step 2 sweep ids referenced by the ``<method>`` columns of the atlas configuration workbook."""
+    sweep_ids = []
+    for tissue in atlas_config.tissues():
+        conf_data = atlas_config.sheet(tissue)
+        for column in conf_data.columns:
+            if not column.startswith("cta_") or column.count("_") != 1:
+                continue
+            for step_str in conf_data[column].dropna():
+                if "step2:" not in str(step_str):
+                    continue
+                parsed = spilt_web(str(step_str).split("step2:")[1].split("|")[0])
+                if parsed is not None:
+                    sweep_ids.append(parsed[2])
+    return list(dict.fromkeys(sweep_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync the local mirror of W&B sweeps")
+    parser.add_argument("--sweep-ids", nargs="*", default=[])
+    parser.add_argument("--from-atlas-config", action="store_true",
+                        help="Also sync the step 2 sweeps referenced by the atlas configuration workbook")
+    parser.add_argument("--conf-path", default=None)
+    parser.add_argument("--mirror-path", default=DEFAULT_MIRROR_PATH)
+    parser.add_argument("--migrate-json", default=None,
+                        help="Import the test_acc lists of a sweep_cache.json first, unless it was imported before")
+    parser.add_argument("--source-dir", default=None, help="Read sweeps from a FileWandbSource directory")
+    parser.add_argument("--ttl", type=float, default=DEFAULT_TTL)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    sweep_ids = list(args.sweep_ids)
+    if args.from_atlas_config:
+        from demos.atlas_config import DEFAULT_ATLAS_CONF_PATH, AtlasConfigRepository
+        sweep_ids += atlas_config_sweep_ids(AtlasConfigRepository(args.conf_path or DEFAULT_ATLAS_CONF_PATH))
+    mirror = SweepMirror(args.mirror_path, ttl=args.ttl)
+    if args.migrate_json is not None:
+        mirror.migrate_json(args.migrate_json)
+    source = WandbSource() if args.source_dir is None else FileWandbSource(args.source_dir)
+    t_start = time.perf_counter()
+    report = mirror.sync(source, sweep_ids, max_workers=args.workers, force=args.force)
+    logger.info(f"Fetched {len(report['fetched'])} sweeps, {len(report['fresh'])} still fresh, "
+                f"{len(report['failed'])} failed in {time.perf_counter() - t_start:.1f}s")
+    if report["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 similarity_names = {
     "wasserstein": "Wasserstein similarity",
+    "wasserstein_sliced": "Sliced Wasserstein similarity",
     "Hausdorff": "Hausdorff similarity",
     "chamfer": "Chamfer similarity",
     "energy": "Energy similarity",
@@ -1,49 +1,40 @@
-import json
 import os
 from matplotlib import pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
 
-from demos.pipeline import get_additional_sweep
-from demos.utils import spilt_web,try_import
+from demos.utils import spilt_web
 from demos.settings import entity,project
+from demos.sweep_mirror import SweepMirror, WandbSource
 from demos.vis_sim_v2_data import get_atlas_ans
-wandb =try_import("wandb")
-def get_runs(conf_data, query_dataset, method):
-    cache_file =  "cache/sweep_cache.json"
+LEGACY_SWEEP_CACHE = os.path.join(os.path.dirname(__file__), "cache", "sweep_cache.json")
+_default_mirror = None
+
+
+def default_sweep_mirror():
+    """Sweep mirror at the default path, importing the legacy ``cache/sweep_cache.json`` once."""
+    global _default_mirror
+    if _default_mirror is None:
+        _default_mirror = SweepMirror()
+        if os.path.exists(LEGACY_SWEEP_CACHE):
+            _default_mirror.migrate_json(LEGACY_SWEEP_CACHE)
+    return _default_mirror
+
+
+def get_runs(conf_data, query_dataset, method, mirror=None):
+    """``test_acc`` of the runs of the step 2 sweeps of ``method`` for ``query_dataset``, read from the sweep mirror.
+
+    Sweeps missing from the mirror (:class:`demos.sweep_mirror.SweepMirror`) are fetched from the W&B API first.
+    """
     step_str = conf_data[conf_data["dataset_id"] == query_dataset][method].iloc[0]
     if pd.isna(step_str):
         return None
     step2_str = step_str.split("step2:")[1].split("|")[0]
     _, _, sweep_id = spilt_web(step2_str)
-    if os.path.exists(cache_file):
-        with open(cache_file) as f:
-            sweep_cache = json.load(f)
-    else:
-        sweep_cache = {}
-    # print(sweep_id)
-    sweep_ids = get_additional_sweep(entity=entity, project=project, sweep_id=sweep_id)
-    runs = []
-
-    for sweep_id in sweep_ids:
-        if sweep_id in sweep_cache:
-            runs.extend(sweep_cache[sweep_id])
-        else:
-            sweep = wandb.Api(timeout=1000).sweep(f"{entity}/{project}/{sweep_id}")
-            sweep_runs = []
-            for run in sweep.runs:
-                if "test_acc" in run.summary:
-                    sweep_runs.append(run.summary["test_acc"])
-                else:
-                    # sweep_runs.append(-0.01)
-                    sweep_runs.append(0)
-
-            sweep_cache[sweep_id] = sweep_runs
-            with open(cache_file, 'w') as f:
-                json.dump(sweep_cache, f)
-            runs.extend(sweep_runs)
-    return runs
+    mirror = default_sweep_mirror() if mirror is None else mirror
+    sweep_ids = mirror.sweep_ids(sweep_id, source=WandbSource(entity, project, timeout=1000), runs=False)
+    return mirror.test_accs(sweep_ids)
 def plot_combined_methods(data, query_dataset, methods, tissue,feature_name,conf_data,save=True,method_runs_cache=None,overall_data_tissue=None):
     fig, ax = plt.subplots(figsize=(4, 3))  # Slightly larger for clarity
 
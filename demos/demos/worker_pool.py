@@ -0,0 +1,396 @@
+"""Persistent pool of warm worker processes for the similarity service.
+
+Scoring a query against the atlas datasets of a tissue with a fresh ``joblib.Parallel`` pays for process start-up,
+for importing scanpy, POT and torch, and for loading every atlas dataset again on each request. :class:`WorkerPool`
+keeps its worker processes alive between requests:
+
+* workers import the heavy modules once, when they start
+* workers keep the atlas datasets they loaded last resident, up to ``atlas_cache_mb / size`` each, so that the
+  resident atlases of the whole pool stay within ``atlas_cache_mb`` (see
+  :func:`resident_atlases` and :class:`demos.atlas_cache.AtlasCache`), and tasks are preferably dispatched to a
+  worker that already holds the atlas dataset they need (``affinity``)
+* a worker whose resident set size exceeds ``max_memory_mb`` after a task drops its resident atlas datasets and, if
+  that is not enough, retires and is replaced; ``max_tasks_per_worker`` recycles workers after a number of tasks
+* :meth:`WorkerPool.restart` replaces all workers without failing the tasks they are running
+
+Every worker runs one task at a time; pending tasks wait in the parent process until a worker is idle.
+:meth:`WorkerPool.broadcast` runs a task on every worker, e.g. :func:`drop_resident_atlases`.
+
+"""
+import collections
+import concurrent.futures
+import gc
+import importlib
+import itertools
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import resource
+import threading
+import traceback
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence
+
+from demos import logger
+from demos.atlas_cache import AtlasCache
+
+DEFAULT_PRELOAD = ("numpy", "scipy.sparse", "anndata", "scanpy", "ot", "demos.anndata_similarity")
+
+# State of the current worker process, empty in the parent process
+_worker_state: Dict[str, Any] = {}
+
+
+class WorkerDiedError(RuntimeError):
+    """The worker process running a task exited before returning its result."""
+
+
+def resident_atlases() -> Optional[AtlasCache]:
+    """Atlas datasets kept resident by the current worker process, None outside of pool workers."""
+    return _worker_state.get("resident_atlases")
+
+
+def drop_resident_atlases() -> Dict[str, Any]:
+    """Drop the resident atlas datasets of the current worker process, see :meth:`WorkerPool.broadcast`."""
+    cache = resident_atlases()
+    cache.clear()
+    gc.collect()
+    return cache.stats()
+
+
+def rss_bytes() -> int:
+    """Resident set size of the current process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak instead of current resident set size where procfs is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _dumps_result(ok: bool, value) -> bytes:
+    try:
+        return pickle.dumps((ok, value), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return pickle.dumps((False, RuntimeError(f"Cannot pickle the task result: {e!r}")))
+
+
+def _worker_main(worker_id: int, tasks, results, preload: Sequence[str], max_memory_bytes: Optional[int],
+                 atlas_cache_bytes: int):
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning(f"Worker {worker_id} cannot preload {module}: {e}")
+    cache = AtlasCache(atlas_cache_bytes)
+    _worker_state["resident_atlases"] = cache
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, payload = task
+        try:
+            fn, args, kwargs = pickle.loads(payload)
+            result = _dumps_result(True, fn(*args, **kwargs))
+        except Exception as e:
+            logger.error(f"Task {task_id} failed in worker {worker_id}: {e}")
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError("".join(traceback.format_exception(e)))
+            result = _dumps_result(False, e)
+        del task, payload
+        retire = False
+        if max_memory_bytes is not None and rss_bytes() > max_memory_bytes:
+            cache.clear()
+            gc.collect()
+            retire = rss_bytes() > max_memory_bytes
+        results.put((worker_id, task_id, result, {
+            "rss": rss_bytes(),
+            "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "resident": cache.keys(),
+            "atlas_cache": cache.stats(),
+            "retire": retire,
+        }))
+        if retire:
+            logger.warning(f"Worker {worker_id} exceeds its memory limit and retires")
+            break
+
+
+class _Worker:
+
+    def __init__(self, worker_id: int, process, tasks):
+        self.id = worker_id
+        self.process = process
+        self.tasks = tasks
+        self.task = None
+        self.n_tasks = 0
+        self.rss = None
+        self.max_rss = None
+        self.resident = set()
+        self.atlas_cache = None
+        self.retiring = False
+
+
+class WorkerPool:
+    """Pool of long-lived worker processes.
+
+    Parameters
+    ----------
+    size : int
+        Number of worker processes
+    max_memory_mb : Optional[int]
+        Resident set size above which a worker drops its resident atlas datasets after a task, and retires if it is
+        still above the limit
+    max_tasks_per_worker : Optional[int]
+        Number of tasks after which a worker is replaced
+    atlas_cache_mb : int
+        Total size of the atlas datasets the workers keep in memory, divided evenly across the workers
+    preload : Sequence[str]
+        Modules imported by every worker when it starts
+    start_method : str
+        Multiprocessing start method of the workers. ``spawn`` is the default since the service process runs threads
+
+    """
+
+    def __init__(self, size: int, max_memory_mb: Optional[int] = None, max_tasks_per_worker: Optional[int] = None,
+                 atlas_cache_mb: int = 4096, preload: Sequence[str] = DEFAULT_PRELOAD, start_method: str = "spawn"):
+        self.size = size
+        self.max_memory_bytes = None if max_memory_mb is None else max_memory_mb * 1024**2
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.atlas_cache_bytes = atlas_cache_mb * 1024**2
+        # Budget of every worker, replaced workers get the same share
+        self.worker_atlas_cache_bytes = self.atlas_cache_bytes // max(size, 1)
+        self.preload = tuple(preload)
+        self._context = mp.get_context(start_method)
+        self._lock = threading.Lock()
+        self._workers: Dict[int, _Worker] = {}
+        self._pending = collections.deque()
+        self._futures: Dict[int, concurrent.futures.Future] = {}
+        self._task_ids = itertools.count()
+        self._worker_ids = itertools.count()
+        self._results = None
+        self._supervisor = None
+        self._shutdown = False
+        self.completed = 0
+        self.failed = 0
+        self.replaced = 0
+
+    @property
+    def running(self) -> bool:
+        return self._supervisor is not None and not self._shutdown
+
+    def start(self):
+        """Start the workers and the thread collecting their results."""
+        with self._lock:
+            if self._supervisor is not None:
+                return
+            self._results = self._context.Queue()
+            for _ in range(self.size):
+                self._spawn()
+            self._supervisor = threading.Thread(target=self._supervise, name="worker-pool-supervisor", daemon=True)
+            self._supervisor.start()
+        logger.info(f"Started {self.size} similarity workers")
+
+    def _spawn(self):
+        worker_id = next(self._worker_ids)
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, name=f"similarity-worker-{worker_id}", daemon=True,
+            args=(worker_id, tasks, self._results, self.preload, self.max_memory_bytes, self.worker_atlas_cache_bytes))
+        process.start()
+        self._workers[worker_id] = _Worker(worker_id, process, tasks)
+
+    def _retire(self, worker: _Worker):
+        worker.retiring = True
+        if worker.task is None:
+            worker.tasks.put(None)
+        self._fail_targeted(worker)
+
+    def _fail_targeted(self, worker: _Worker):
+        for task in [task for task in self._pending if task[3] == worker.id]:
+            self._pending.remove(task)
+            self._futures.pop(task[0]).set_exception(WorkerDiedError(f"Similarity worker {worker.id} is gone"))
+
+    def _replace(self, worker: _Worker):
+        self._retire(worker)
+        if not self._shutdown:
+            self.replaced += 1
+            self._spawn()
+
+    def submit(self, fn: Callable, *args, affinity: Optional[Hashable] = None, **kwargs) -> concurrent.futures.Future:
+        """Run ``fn(*args, **kwargs)`` in a worker.
+
+        ``fn`` and its arguments are pickled right away, so later changes to the arguments do not affect the task.
+        ``affinity`` is the key of the atlas dataset the task loads, see :func:`resident_atlases`: an idle worker
+        prefers the pending tasks whose atlas dataset it holds.
+
+        """
+        return self._submit(fn, args, kwargs, affinity=affinity)[0]
+
+    def broadcast(self, fn: Callable, *args, **kwargs) -> List[concurrent.futures.Future]:
+        """Run ``fn(*args, **kwargs)`` once in every worker that is not retiring."""
+        return self._submit(fn, args, kwargs, broadcast=True)
+
+    def _submit(self, fn: Callable, args, kwargs, affinity=None, broadcast=False) -> List[concurrent.futures.Future]:
+        payload = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if not self.running:
+                raise RuntimeError("Worker pool is not running")
+            targets = [worker.id for worker in self._workers.values() if not worker.retiring] if broadcast else [None]
+            futures = []
+            for target in targets:
+                task_id = next(self._task_ids)
+                futures.append(self._futures.setdefault(task_id, concurrent.futures.Future()))
+                self._pending.append((task_id, payload, affinity, target))
+            self._dispatch()
+        return futures
+
+    def _dispatch(self):
+        for worker in self._workers.values():
+            if not self._pending:
+                return
+            if worker.task is not None or worker.retiring:
+                continue
+            # Tasks for this worker first, then the ones whose atlas dataset it holds, then the oldest one
+            candidates = [task for task in self._pending if task[3] in (None, worker.id)]
+            if not candidates:
+                continue
+            task = next((task for task in candidates if task[3] == worker.id), None) or next(
+                (task for task in candidates if task[2] is not None and task[2] in worker.resident), candidates[0])
+            self._pending.remove(task)
+            task_id, payload, _, _ = task
+            if not self._futures[task_id].set_running_or_notify_cancel():
+                del self._futures[task_id]
+                continue
+            worker.task = task_id
+            worker.tasks.put((task_id, payload))
+
+    def _supervise(self):
+        while True:
+            try:
+                message = self._results.get(timeout=0.5)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                if message is not None:
+                    self._complete(*message)
+                self._reap()
+                self._dispatch()
+                if self._shutdown and not self._workers:
+                    return
+
+    def _complete(self, worker_id: int, task_id: int, result: bytes, info: dict):
+        future = self._futures.pop(task_id)
+        ok, value = pickle.loads(result)
+        if ok:
+            self.completed += 1
+            future.set_result(value)
+        else:
+            self.failed += 1
+            future.set_exception(value)
+        worker = self._workers[worker_id]
+        worker.task = None
+        worker.n_tasks += 1
+        worker.rss = info["rss"]
+        worker.max_rss = info["max_rss"]
+        worker.resident = set(info["resident"])
+        worker.atlas_cache = info["atlas_cache"]
+        if worker.retiring:
+            worker.tasks.put(None)
+        elif info["retire"] or (self.max_tasks_per_worker is not None and worker.n_tasks >= self.max_tasks_per_worker):
+            self._replace(worker)
+
+    def _reap(self):
+        dead = [worker for worker in self._workers.values() if not worker.process.is_alive()]
+        if any(worker.task is not None for worker in dead):
+            # A worker flushes its last result before it exits, collect it before failing the task
+            while True:
+                try:
+                    self._complete(*self._results.get_nowait())
+                except queue.Empty:
+                    break
+        for worker in dead:
+            worker.process.join()
+            del self._workers[worker.id]
+            if worker.task is not None:
+                self.failed += 1
+                self._futures.pop(worker.task).set_exception(WorkerDiedError(
+                    f"Similarity worker {worker.id} exited with code {worker.process.exitcode}"))
+            self._fail_targeted(worker)
+            if not worker.retiring:
+                logger.error(f"Similarity worker {worker.id} died with exit code {worker.process.exitcode}")
+                if not self._shutdown:
+                    self.replaced += 1
+                    self._spawn()
+
+    def restart(self):
+        """Replace all workers, e.g. to drop their resident atlas datasets.
+
+        New workers take the pending tasks right away; the old ones finish the task they are running and exit.
+
+        """
+        with self._lock:
+            if not self.running:
+                raise RuntimeError("Worker pool is not running")
+            retiring = list(self._workers.values())
+            for worker in retiring:
+                self._retire(worker)
+            for _ in range(self.size):
+                self._spawn()
+            self._dispatch()
+        logger.info(f"Restarting {len(retiring)} similarity workers")
+
+    def shutdown(self, wait: bool = True, timeout: float = 30):
+        """Cancel the pending tasks and stop the workers after their current task."""
+        with self._lock:
+            if self._supervisor is None or self._shutdown:
+                return
+            self._shutdown = True
+            while self._pending:
+                task_id = self._pending.popleft()[0]
+                self._futures.pop(task_id).cancel()
+            for worker in self._workers.values():
+                self._retire(worker)
+            workers = list(self._workers.values())
+        if wait:
+            self._supervisor.join(timeout)
+            for worker in workers:
+                if worker.process.is_alive():
+                    logger.warning(f"Terminating similarity worker {worker.id}")
+                    worker.process.terminate()
+                    worker.process.join()
+
+    def atlas_cache_stats(self) -> Dict[str, Any]:
+        """Resident atlas statistics summed over the current workers, as of their last task."""
+        with self._lock:
+            caches = [worker.atlas_cache for worker in self._workers.values() if worker.atlas_cache is not None]
+        totals = {
+            key: sum(cache[key] for cache in caches)
+            for key in ("hits", "misses", "evictions", "entries", "bytes", "max_bytes")
+        }
+        lookups = totals["hits"] + totals["misses"]
+        return {**totals, "hit_rate": totals["hits"] / lookups if lookups else None, "workers": len(caches)}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "running": self.running,
+                "pending": len(self._pending),
+                "busy": sum(worker.task is not None for worker in self._workers.values()),
+                "completed": self.completed,
+                "failed": self.failed,
+                "replaced": self.replaced,
+                "workers": [{
+                    "pid": worker.process.pid,
+                    "busy": worker.task is not None,
+                    "retiring": worker.retiring,
+                    "n_tasks": worker.n_tasks,
+                    "rss": worker.rss,
+                    "max_rss": worker.max_rss,
+                    "resident": [list(key) if isinstance(key, tuple) else key for key in worker.resident],
+                    "atlas_cache": worker.atlas_cache,
+                } for worker in self._workers.values()],
+            }
@@ -0,0 +1,59 @@
+import itertools
+import random
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+from demos.analyze_atlas_accuracy import is_matching_dict, match_runs
+
+TARGETS = {"cell": ["CellPCA", "CellSVD"], "filter.gene": ["FilterGenesTopK", "FilterGenesPercentile"],
+           "normalize": ["ScaleFeature", "NormalizeTotal"]}
+
+
+def _yaml(targets):
+    pipeline = [{"type": "misc", "target": "SetConfig"}]
+    pipeline += [{"type": step_type, "target": target} for step_type, target in targets]
+    pipeline.append({"type": "graph.cell", "target": "CellFeatureGraph"})
+    return yaml.safe_dump(pipeline)
+
+
+def _config(targets):
+    return {f"pipeline.{i + 1}.{step_type}": target for i, (step_type, target) in enumerate(targets)}
+
+
+def _nested_loop(best_yamls, runs):
+    # Matching of the rank_similarity endpoint before match_runs
+    matches = {}
+    for key, best_yaml in best_yamls.items():
+        match_run = None
+        for run in runs:
+            if is_matching_dict(best_yaml, run.config):
+                if match_run is not None:
+                    raise ValueError("Multiple matching runs found when only one expected")
+                match_run = run
+        matches[key] = match_run
+    return matches
+
+
+def test_match_runs_agrees_with_the_nested_loop():
+    rng = random.Random(0)
+    combinations = [list(zip(TARGETS, targets)) for targets in itertools.product(*TARGETS.values())]
+    # Half of the configurations have a run, keys are order insensitive
+    runs = [SimpleNamespace(id=str(i), config=dict(reversed(list(_config(targets).items()))))
+            for i, targets in enumerate(combinations) if i % 2 == 0]
+    rng.shuffle(runs)
+    best_yamls = {f"atlas_{i}": _yaml(targets) for i, targets in enumerate(combinations)}
+    matches = match_runs(best_yamls, runs)
+    assert matches == _nested_loop(best_yamls, runs)
+    assert sum(match is not None for match in matches.values()) == len(runs)
+
+
+def test_match_runs_rejects_duplicate_matches_like_the_nested_loop():
+    targets = list(zip(TARGETS, ["CellPCA", "FilterGenesTopK", "ScaleFeature"]))
+    runs = [SimpleNamespace(id="1", config=_config(targets)), SimpleNamespace(id="2", config=_config(targets))]
+    best_yamls = {"atlas": _yaml(targets)}
+    with pytest.raises(ValueError):
+        _nested_loop(best_yamls, runs)
+    with pytest.raises(ValueError):
+        match_runs(best_yamls, runs)
@@ -0,0 +1,86 @@
+import gzip
+import io
+import os
+
+import numpy as np
+import pytest
+
+from demos.h5ad_upload import (H5adUploadWriter, UploadRejectedError, UploadStore, decoded_chunks, file_sha256,
+                               resolve_shared_path, shared_file_sha256)
+
+
+def _add(store, content_hash, size, mtime=None):
+    temp_path = store.temp_path()
+    with open(temp_path, "wb") as f:
+        f.write(b"x" * size)
+    path = store.add(temp_path, content_hash)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_upload_store_evicts_least_recently_used_files(tmp_path):
+    store = UploadStore(str(tmp_path), max_bytes=250)
+    _add(store, "a" * 64, 100, mtime=1000)
+    _add(store, "b" * 64, 100, mtime=1001)
+    # A hit refreshes the recency of "a"
+    assert store.path("a" * 64) is not None
+    _add(store, "c" * 64, 100)
+    assert store.path("b" * 64) is None
+    assert store.path("a" * 64) is not None and store.path("c" * 64) is not None
+    assert store.stats()["evictions"] == 1
+
+
+def test_upload_store_keeps_pinned_files_until_released(tmp_path):
+    store = UploadStore(str(tmp_path), max_bytes=150)
+    _add(store, "a" * 64, 100, mtime=1000)
+    path = store.path("a" * 64, pin=True)
+    _add(store, "b" * 64, 100)
+    assert os.path.exists(path)
+    assert store.stats()["pinned"] == 1
+    store.release("a" * 64)
+    _add(store, "c" * 64, 100)
+    assert not os.path.exists(path)
+    assert store.stats()["pinned"] == 0
+
+
+def test_upload_store_without_budget_keeps_nothing(tmp_path):
+    store = UploadStore(str(tmp_path), max_bytes=0)
+    temp_path = store.temp_path()
+    open(temp_path, "wb").close()
+    assert store.add(temp_path, "a" * 64) == temp_path
+
+
+def test_shared_file_sha256_follows_file_changes(tmp_path):
+    path = str(tmp_path / "query.h5ad")
+    with open(path, "wb") as f:
+        f.write(b"first")
+    assert shared_file_sha256(path) == file_sha256(path)
+    with open(path, "wb") as f:
+        f.write(b"second version")
+    assert shared_file_sha256(path) == file_sha256(path)
+
+
+def test_resolve_shared_path_rejects_paths_outside_the_roots(tmp_path):
+    root = tmp_path / "shared"
+    root.mkdir()
+    (root / "q.h5ad").write_bytes(b"")
+    (tmp_path / "other.h5ad").write_bytes(b"")
+    assert resolve_shared_path(str(root / "q.h5ad"), [str(root)]) == os.path.realpath(root / "q.h5ad")
+    assert resolve_shared_path(str(root / ".." / "other.h5ad"), [str(root)]) is None
+    assert resolve_shared_path(str(root / "missing.h5ad"), [str(root)]) is None
+
+
+def test_gzip_upload_is_decoded_and_limited_by_its_decompressed_size():
+    data = b"\x89HDF\r\n\x1a\n" + bytes(np.arange(5000, dtype=np.uint8))
+    buffer = io.BytesIO()
+    writer = H5adUploadWriter(buffer, max_bytes=len(data))
+    for chunk in decoded_chunks(io.BytesIO(gzip.compress(data)), "gzip", chunk_size=1024):
+        writer.write(chunk)
+    writer.close()
+    assert buffer.getvalue() == data
+    writer = H5adUploadWriter(io.BytesIO(), max_bytes=len(data) - 1)
+    with pytest.raises(UploadRejectedError) as excinfo:
+        for chunk in decoded_chunks(io.BytesIO(gzip.compress(data)), "gzip", chunk_size=1024):
+            writer.write(chunk)
+    assert excinfo.value.status_code == 413
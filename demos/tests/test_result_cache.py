@@ -0,0 +1,47 @@
+import os
+
+from demos.result_cache import ResultCache, cache_key
+
+
+def _age(cache, key, mtime):
+    os.utime(cache._path(key), (mtime, mtime))
+
+
+def test_cache_key_depends_on_content_and_parameters():
+    assert cache_key("a" * 64, tissue="brain", methods=["x", "y"]) == cache_key("a" * 64, methods=["x", "y"],
+                                                                                tissue="brain")
+    assert cache_key("a" * 64, tissue="brain") != cache_key("b" * 64, tissue="brain")
+    assert cache_key("a" * 64, tissue="brain") != cache_key("a" * 64, tissue="heart")
+
+
+def test_get_put_round_trip_and_stats(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get("k") is None
+    cache.put("k", {"bures": [0.5, 0.25], "atlas": "A"})
+    assert "k" in cache
+    assert cache.get("k") == {"bures": [0.5, 0.25], "atlas": "A"}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    for i, key in enumerate(["old", "used", "new"]):
+        cache.put(key, "x" * 100)
+        _age(cache, key, 1000 + i)
+    # A hit refreshes the recency of "used", "old" is now the least recently used entry
+    assert cache.get("used") is not None
+    entry_size = os.path.getsize(cache._path("new"))
+    cache.max_bytes = 3 * entry_size
+    cache.put("newest", "x" * 100)
+    assert "old" not in cache
+    assert all(key in cache for key in ["used", "new", "newest"])
+    assert cache.stats()["evictions"] == 1
+
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    with open(cache._path("k"), "w") as f:
+        f.write("{not json")
+    assert cache.get("k") is None
+    assert cache.stats()["misses"] == 1
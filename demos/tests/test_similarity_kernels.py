@@ -0,0 +1,125 @@
+import anndata as ad
+import numpy as np
+import ot
+import pytest
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist, jensenshannon
+
+from demos.anndata_similarity import AnnDataSimilarity
+from demos.similarity_kernels import covariance, js_divergence_matrix, pairwise_sums, sliced_wasserstein_distance
+
+
+def _counts(n, g, seed, density=0.5):
+    rng = np.random.default_rng(seed)
+    return rng.poisson(2.0, size=(n, g)) * (rng.random((n, g)) < density)
+
+
+def _anndata(n, g, seed):
+    adata = ad.AnnData(sp.csr_matrix(_counts(n, g, seed).astype(np.float32)))
+    adata.var_names = [f"gene_{i}" for i in range(g)]
+    return adata
+
+
+@pytest.mark.parametrize("base", [None, 2])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_js_divergence_matrix_matches_scipy(base, sparse):
+    X, Y = _counts(13, 20, seed=0), _counts(17, 20, seed=1)
+    expected = np.array([[jensenshannon(x, y, base=base) for y in Y] for x in X])
+    if sparse:
+        X, Y = sp.csr_matrix(X), sp.csr_matrix(Y)
+    # A budget of a few rows per tile exercises the tile boundaries
+    result = js_divergence_matrix(X, Y, max_tile_bytes=4 * 20 * 16 * 2, base=base)
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_js_divergence_matrix_identical_rows_are_zero():
+    X = _counts(5, 20, seed=2) + 1
+    np.testing.assert_allclose(np.diag(js_divergence_matrix(X, X)), 0.0, atol=1e-7)
+
+
+def test_js_divergence_matrix_rejects_mismatched_genes():
+    with pytest.raises(ValueError):
+        js_divergence_matrix(np.ones((2, 3)), np.ones((2, 4)))
+
+
+@pytest.mark.parametrize("metric", ["euclidean", "sqeuclidean", "cityblock"])
+def test_pairwise_sums_match_dense_cdist(metric):
+    X, Y = _counts(50, 20, seed=3).astype(float), _counts(37, 20, seed=4).astype(float)
+    funcs = {"sum": None, "exp": lambda d: np.exp(-d / 100)}
+    tile_bytes = 16 * 8 * 8 + 16 * 20 * 8
+    cross = pairwise_sums(X, Y, metric=metric, funcs=funcs, max_tile_bytes=tile_bytes)
+    self_sums = pairwise_sums(X, metric=metric, funcs=funcs, exclude_diagonal=True, max_tile_bytes=tile_bytes)
+    D_XY, D_XX = cdist(X, Y, metric), cdist(X, X, metric)
+    np.testing.assert_allclose(cross["sum"], D_XY.sum(), rtol=1e-12)
+    np.testing.assert_allclose(cross["exp"], np.exp(-D_XY / 100).sum(), rtol=1e-12)
+    off_diagonal = ~np.eye(len(X), dtype=bool)
+    np.testing.assert_allclose(self_sums["sum"], D_XX[off_diagonal].sum(), rtol=1e-12)
+    np.testing.assert_allclose(self_sums["exp"], np.exp(-D_XX / 100)[off_diagonal].sum(), rtol=1e-12)
+
+
+def test_pairwise_sums_sparse_euclidean_matches_dense():
+    X, Y = _counts(50, 20, seed=5).astype(float), _counts(40, 20, seed=6).astype(float)
+    dense = pairwise_sums(X, Y, max_tile_bytes=4096)
+    sparse = pairwise_sums(sp.csr_matrix(X), sp.csr_matrix(Y), max_tile_bytes=4096)
+    np.testing.assert_allclose(sparse["sum"], dense["sum"], rtol=1e-10)
+    np.testing.assert_allclose(dense["sum"], cdist(X, Y).sum(), rtol=1e-12)
+
+
+def test_pairwise_sums_rejects_diagonal_exclusion_between_sets():
+    with pytest.raises(ValueError):
+        pairwise_sums(np.ones((3, 2)), np.ones((3, 2)), exclude_diagonal=True)
+
+
+def _baseline_energy(X, Y):
+    # energy_distance_metric before the tiled kernels
+    distance = 2 * np.mean(cdist(X, Y)) - np.mean(cdist(X, X)) - np.mean(cdist(Y, Y))
+    return 1 / (1 + distance)
+
+
+def _baseline_mmd(X, Y, gamma=1.0):
+    # compute_mmd with the rbf kernel before the tiled kernels
+    K_X = np.exp(-gamma * cdist(X, X, "sqeuclidean"))
+    K_Y = np.exp(-gamma * cdist(Y, Y, "sqeuclidean"))
+    K_XY = np.exp(-gamma * cdist(X, Y, "sqeuclidean"))
+    m, n = len(X), len(Y)
+    mmd_squared = ((K_X.sum() - np.trace(K_X)) / (m * (m - 1)) + (K_Y.sum() - np.trace(K_Y)) / (n * (n - 1))
+                   - 2 * K_XY.sum() / (m * n))
+    return 1 / (1 + np.sqrt(max(mmd_squared, 0)))
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_energy_and_mmd_match_baseline_formulas(sparse):
+    # Highly variable gene selection needs more cells, the 20 genes are kept as they are
+    calculator = AnnDataSimilarity(_anndata(50, 20, seed=7), _anndata(50, 20, seed=8), init_random_state=0,
+                                   n_runs=1, max_tile_bytes=4096, sparse=sparse, adata1_hvg_selected=True,
+                                   adata2_hvg_selected=True)
+    results = calculator.compute_similarity(random_state=0, methods=["energy", "mmd"])
+    X, Y = (Z.toarray() if sp.issparse(Z) else Z for Z in (calculator.X, calculator.Y))
+    np.testing.assert_allclose(results["energy"], _baseline_energy(X, Y), rtol=1e-10)
+    np.testing.assert_allclose(results["mmd"], _baseline_mmd(X, Y), rtol=1e-10)
+
+
+def test_sparse_mode_matches_dense_mode():
+    methods = ["wasserstein", "Hausdorff", "chamfer", "energy", "sinkhorn2", "bures", "spectral", "mmd"]
+    results = {}
+    for sparse in (False, True):
+        calculator = AnnDataSimilarity(_anndata(40, 20, seed=9), _anndata(30, 20, seed=10), init_random_state=0,
+                                       n_runs=1, max_tile_bytes=4096, sparse=sparse, adata1_hvg_selected=True,
+                                       adata2_hvg_selected=True)
+        results[sparse] = calculator.compute_similarity(random_state=0, methods=methods)
+    for method in methods:
+        np.testing.assert_allclose(np.real(results[True][method]), np.real(results[False][method]), rtol=1e-7,
+                                   err_msg=method)
+
+
+def test_covariance_of_sparse_input_matches_numpy():
+    X = _counts(30, 20, seed=11).astype(float)
+    np.testing.assert_allclose(covariance(sp.csr_matrix(X)), np.cov(X, rowvar=False), rtol=1e-12)
+
+
+def test_sliced_wasserstein_of_one_feature_matches_exact_wasserstein():
+    # With a single feature every direction is +-1, so the sliced distance is the exact W1 of the default ``p=1``
+    X, Y = _counts(13, 1, seed=0).astype(np.float64), _counts(17, 1, seed=1).astype(np.float64)
+    exact = ot.emd2(np.full(13, 1 / 13), np.full(17, 1 / 17), ot.dist(X, Y, metric="euclidean"))
+    assert np.isclose(sliced_wasserstein_distance(X, Y, n_projections=5), exact)
+    assert sliced_wasserstein_distance(X, Y, seed=3) == sliced_wasserstein_distance(X, Y, seed=3)
@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+from demos.sweep_mirror import FileWandbSource, SweepMirror, SweepNotMirroredError
+
+# a continues b, which continues c
+GRAPH = {"a": ["b"], "b": ["c"], "c": []}
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / "source"
+    for sweep_id, children in GRAPH.items():
+        runs = [{"id": f"{sweep_id}{i}", "state": "finished", "config": {"i": i}, "summary": {"test_acc": i / 10}}
+                for i in range(3)]
+        (root / "sweeps").mkdir(parents=True, exist_ok=True)
+        (root / "sweeps" / f"{sweep_id}.json").write_text(json.dumps({"runs": runs}))
+        for run in runs:
+            (root / "files" / run["id"]).mkdir(parents=True)
+            args = ["main.py"] + [arg for child in children for arg in ("--additional_sweep_ids", child)]
+            (root / "files" / run["id"] / "wandb-metadata.json").write_text(json.dumps({"args": args}))
+    return FileWandbSource(str(root))
+
+
+def test_database_is_created_on_first_use(tmp_path):
+    path = str(tmp_path / "cache" / "mirror.sqlite")
+    mirror = SweepMirror(path)
+    assert not os.path.exists(path)
+    assert mirror.stats()["sweeps"] == 0
+    assert os.path.exists(path)
+
+
+def test_sync_follows_the_sweep_graph_and_skips_fresh_sweeps(tmp_path, source):
+    mirror = SweepMirror(str(tmp_path / "mirror.sqlite"))
+    assert sorted(mirror.sync(source, ["a"])["fetched"]) == ["a", "b", "c"]
+    calls = source.calls
+    report = mirror.sync(source, ["a"])
+    assert report["fetched"] == [] and sorted(report["fresh"]) == ["a", "b", "c"]
+    assert source.calls == calls
+    assert mirror.sweep_ids("a") == ["a", "b", "c"]
+    assert [run.id for run in mirror.runs(["c"])] == ["c0", "c1", "c2"]
+
+
+def test_expired_sweeps_are_fetched_again_and_upserted(tmp_path, source):
+    mirror = SweepMirror(str(tmp_path / "mirror.sqlite"), ttl=0)
+    mirror.sync(source, ["c"])
+    # The source changes: the upsert replaces the row instead of adding one
+    runs_path = os.path.join(source.root, "sweeps", "c.json")
+    with open(runs_path) as f:
+        runs = json.load(f)["runs"][:1]
+    with open(runs_path, "w") as f:
+        json.dump({"runs": runs}, f)
+    assert mirror.sync(source, ["c"])["fetched"] == ["c"]
+    assert mirror.test_accs(["c"]) == [0.0]
+    assert mirror.stats()["sweeps"] == 1
+
+
+def test_missing_sweeps_raise_unless_a_source_is_given(tmp_path, source):
+    mirror = SweepMirror(str(tmp_path / "mirror.sqlite"))
+    with pytest.raises(SweepNotMirroredError):
+        mirror.sweep_ids("a")
+    assert mirror.sweep_ids("a", source=source) == ["a", "b", "c"]
+
+
+def test_migrated_sweeps_only_fetch_their_graph_and_migrate_once(tmp_path, source):
+    json_path = tmp_path / "sweep_cache.json"
+    json_path.write_text(json.dumps({sweep_id: [0.5, 0.6] for sweep_id in GRAPH}))
+    mirror = SweepMirror(str(tmp_path / "mirror.sqlite"))
+    assert mirror.migrate_json(str(json_path)) == 3
+    assert SweepMirror(mirror.path).migrate_json(str(json_path)) == 0
+    assert mirror.sweep_ids("a", source=source, runs=False) == ["a", "b", "c"]
+    # One finished run lookup and one metadata read per sweep, no run paging
+    assert source.calls == 6
+    assert mirror.test_accs(["a", "b", "c"]) == [0.5, 0.6] * 3
+    assert mirror.sweep_ids("a", source=source, runs=False) == ["a", "b", "c"]
+    assert source.calls == 6
+    with pytest.raises(SweepNotMirroredError):
+        mirror.runs(["a"])
+    mirror.sweep_ids("a", source=source)
+    assert len(mirror.runs(["a", "b", "c"])) == 9
@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+
+import anndata as ad
+import numpy as np
+import pytest
+
+from demos.worker_pool import WorkerDiedError, WorkerPool, resident_atlases
+
+# Tasks run in spawned workers, so they are module-level functions
+
+
+def _pid():
+    return os.getpid()
+
+
+def _hold(key):
+    """Make ``key`` a resident atlas dataset of the worker."""
+    resident_atlases().put(key, ad.AnnData(np.zeros((1, 1), dtype=np.float32)))
+    return os.getpid()
+
+
+def _wait_for(gate):
+    """Block until the file ``<gate>/<pid>`` or ``<gate>/all`` exists."""
+    while not (os.path.exists(os.path.join(gate, str(os.getpid()))) or os.path.exists(os.path.join(gate, "all"))):
+        time.sleep(0.01)
+    return os.getpid()
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def _die():
+    os._exit(3)
+
+
+def _open(gate, name="all"):
+    with open(os.path.join(gate, str(name)), "w"):
+        pass
+
+
+def _wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def make_pool(tmp_path):
+    pools = []
+
+    def make(size, **kwargs):
+        pool = WorkerPool(size, preload=(), **kwargs)
+        pool.start()
+        pools.append(pool)
+        return pool
+
+    yield make
+    # Release blocked tasks of failed tests
+    _open(str(tmp_path))
+    for pool in pools:
+        pool.shutdown(timeout=5)
+
+
+def test_pending_tasks_prefer_the_worker_holding_their_atlas(make_pool, tmp_path):
+    pool = make_pool(2)
+    holder = pool.submit(_hold, "A").result(timeout=30)
+    blockers = [pool.submit(_wait_for, str(tmp_path)) for _ in range(2)]
+    _wait_until(lambda: pool.stats()["busy"] == 2)
+    second_gate = tmp_path / "second"
+    second_gate.mkdir()
+    # The older task blocks, so the task needing "A" only completes if the holder skips the older task for it
+    oldest = pool.submit(_wait_for, str(second_gate), affinity="B")
+    preferred = pool.submit(_pid, affinity="A")
+    _open(str(tmp_path), holder)
+    assert preferred.result(timeout=10) == holder
+    _open(str(tmp_path))
+    _open(str(second_gate))
+    assert oldest.result(timeout=30) > 0
+    assert holder in {blocker.result(timeout=30) for blocker in blockers}
+
+
+def test_workers_are_replaced_after_max_tasks(make_pool):
+    pool = make_pool(1, max_tasks_per_worker=2)
+    pids = [pool.submit(_pid).result(timeout=30) for _ in range(3)]
+    assert pids[0] == pids[1] != pids[2]
+    assert pool.stats()["replaced"] == 1
+
+
+def test_crashed_worker_fails_only_its_task_and_is_replaced(make_pool):
+    pool = make_pool(2)
+    survivor = pool.submit(_sleep, 0.5)
+    crashed = pool.submit(_die)
+    with pytest.raises(WorkerDiedError):
+        crashed.result(timeout=30)
+    survivor_pid = survivor.result(timeout=30)
+    _wait_until(lambda: len(pool.stats()["workers"]) == 2)
+    stats = pool.stats()
+    assert (stats["replaced"], stats["failed"], stats["completed"]) == (1, 1, 1)
+    assert survivor_pid in [worker["pid"] for worker in stats["workers"]]
+    assert pool.submit(_pid).result(timeout=30) in [worker["pid"] for worker in stats["workers"]]
+
+
+def test_restart_replaces_workers_without_failing_running_tasks(make_pool, tmp_path):
+    pool = make_pool(1)
+    old = pool.submit(_pid).result(timeout=30)
+    running = pool.submit(_wait_for, str(tmp_path))
+    _wait_until(lambda: pool.stats()["busy"] == 1)
+    pool.restart()
+    # The new worker takes new tasks while the old one finishes its task
+    assert pool.submit(_pid).result(timeout=30) != old
+    _open(str(tmp_path))
+    assert running.result(timeout=30) == old
+    _wait_until(lambda: len(pool.stats()["workers"]) == 1)
+    assert pool.stats()["workers"][0]["pid"] != old
+
+
+def test_broadcast_tasks_aimed_at_retiring_workers_fail(make_pool, tmp_path):
+    pool = make_pool(1)
+    running = pool.submit(_wait_for, str(tmp_path))
+    _wait_until(lambda: pool.stats()["busy"] == 1)
+    old = pool.stats()["workers"][0]["pid"]
+    (queued,) = pool.broadcast(_pid)
+    pool.restart()
+    with pytest.raises(WorkerDiedError):
+        queued.result(timeout=30)
+    # Only the new worker is a broadcast target while the old one is retiring
+    (fresh,) = pool.broadcast(_pid)
+    assert fresh.result(timeout=30) != old
+    _open(str(tmp_path))
+    assert running.result(timeout=30) == old
+
+
+def test_shutdown_cancels_pending_tasks(make_pool, tmp_path):
+    pool = make_pool(1)
+    running = pool.submit(_wait_for, str(tmp_path))
+    _wait_until(lambda: pool.stats()["busy"] == 1)
+    pending = [pool.submit(_pid) for _ in range(2)]
+    threading.Timer(0.2, _open, args=(str(tmp_path),)).start()
+    pool.shutdown(timeout=10)
+    assert all(future.cancelled() for future in pending)
+    assert running.result(timeout=0) > 0
+    assert not pool.running
+    with pytest.raises(RuntimeError):
+        pool.submit(_pid)